@@ -277,7 +277,8 @@ def main(_):
                                           data_format=DATA_FORMAT)
             with slim.arg_scope(arg_scope):
                 predictions, localisations, logits, end_points = \
-                    ssd_net.net(b_image, is_training=True,DSSD_FLAG = FLAGS.DSSD_FLAG)
+                    ssd_net.net(b_image, is_training=True,DSSD_FLAG = FLAGS.DSSD_FLAG,
+                                data_format=DATA_FORMAT)
             # Add loss function.
             ssd_net.losses(logits, localisations,
                            b_gclasses, b_glocalisations, b_gscores,
@@ -0,0 +1,139 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Groundtruth encoding time on crowded images: TF encoders (while_loop,
+vectorized) vs the Numpy encoder, in process and in a multiprocessing pool.
+
+Random images with --num_objects objects of VisDrone-like sizes are used.
+The targets of all the encoders are checked against the while_loop ones.
+
+Usage:
+    python benchmark_encoder.py --num_objects 200 --num_workers 4
+"""
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from nets import np_methods
+from nets import ssd_vgg_512
+
+
+# Numpy encoder of the pool workers.
+_ENCODER = None
+
+
+def init_worker(encoder):
+    global _ENCODER
+    _ENCODER = encoder
+
+
+def encode_worker(labels, bboxes):
+    return _ENCODER.encode(labels, bboxes)
+
+
+def random_objects(rng, num_images, num_objects, num_classes):
+    """List of (labels, bboxes) of random objects.
+    """
+    l_objects = []
+    for _ in range(num_images):
+        centers = rng.rand(num_objects, 2)
+        sizes = 0.005 + 0.08 * rng.rand(num_objects, 2) ** 2
+        bboxes = np.clip(np.concatenate([centers - sizes / 2.,
+                                         centers + sizes / 2.], axis=1), 0., 1.)
+        labels = rng.randint(1, num_classes, size=num_objects)
+        l_objects.append((labels.astype(np.int64), bboxes.astype(np.float32)))
+    return l_objects
+
+
+def check(name, targets, ref_targets):
+    """Compare flat targets with the reference ones.
+    """
+    labels, localizations, scores = targets
+    ref_labels, ref_localizations, ref_scores = ref_targets
+    print('%12s | labels equal: %s | max scores diff: %.2e | max loc diff: %.2e'
+          % (name, np.array_equal(labels, ref_labels),
+             np.max(np.abs(scores - ref_scores)),
+             np.max(np.abs(localizations - ref_localizations))))
+
+
+def run(name, fn, l_objects):
+    """Time an encoding function on all the images.
+    """
+    start = time.time()
+    r = fn(l_objects)
+    duration = time.time() - start
+    print('%12s | %9.2f ms / image | %8.1f images/s'
+          % (name, 1000. * duration / len(l_objects), len(l_objects) / duration))
+    return r
+
+
+def main(args):
+    rng = np.random.RandomState(0)
+    ssd_net = ssd_vgg_512.SSDNet()
+    num_classes = ssd_net.params.num_classes
+    anchors = ssd_net.anchors(ssd_net.params.img_shape)
+    l_objects = random_objects(rng, args.num_images, args.num_objects, num_classes)
+
+    # TF encoders, flattened targets.
+    labels = tf.placeholder(tf.int64, shape=(None, ))
+    bboxes = tf.placeholder(tf.float32, shape=(None, 4))
+    tf_targets = {}
+    for method in ['while_loop', 'vectorized']:
+        targets = ssd_net.bboxes_encode(labels, bboxes, anchors, method=method)
+        tf_targets[method] = [tf.concat([tf.reshape(t, [-1] + t.get_shape().as_list()[3:])
+                                         for t in l], axis=0) for l in targets]
+    encoder = np_methods.SSDTargetEncoder(anchors, num_classes,
+                                          ssd_net.params.prior_scaling)
+
+    config = tf.ConfigProto(device_count={'GPU': 0})
+    with tf.Session(config=config) as sess:
+        def tf_encode(method):
+            return lambda objects: [sess.run(tf_targets[method],
+                                             feed_dict={labels: l, bboxes: b})
+                                    for l, b in objects]
+        # Warm-up.
+        for method in tf_targets:
+            tf_encode(method)(l_objects[:1])
+
+        print('%i images, %i objects, %i anchors.'
+              % (args.num_images, args.num_objects, anchors.num_anchors))
+        r_loop = run('while_loop', tf_encode('while_loop'), l_objects)
+        r_vect = run('vectorized', tf_encode('vectorized'), l_objects)
+        r_np = run('numpy', lambda objects: [encoder.encode(l, b) for l, b in objects],
+                   l_objects)
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(args.num_workers, initializer=init_worker,
+                      initargs=(encoder, )) as pool:
+            pool.starmap(encode_worker, l_objects[:args.num_workers])
+            r_pool = run('numpy x%i' % args.num_workers,
+                         lambda objects: pool.starmap(encode_worker, objects),
+                         l_objects)
+
+    for name, r in [('vectorized', r_vect), ('numpy', r_np), ('numpy pool', r_pool)]:
+        check(name, [np.concatenate(t) for t in zip(*r)],
+              [np.concatenate(t) for t in zip(*r_loop)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_images', type=int, default=50,
+                        help='Number of images.')
+    parser.add_argument('--num_objects', type=int, default=200,
+                        help='Number of objects per image.')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='Numpy encoder processes.')
+    main(parser.parse_args())
@@ -0,0 +1,82 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmark of the NumPy NMS implementations on dense scenes of small
+objects, similar to VisDrone crowd and parking-lot images.
+
+Usage:
+    python benchmark_nms.py --num_bboxes 1000 5000 20000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from nets import np_methods
+
+
+def random_scene(num_bboxes, num_classes=11, num_clusters=20, seed=0):
+    """Random dense scene: small boxes around a few cluster centers, with a
+    few duplicates around every object. Sorted by decreasing score.
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0.1, 0.9, size=(num_clusters, 2))
+    cy, cx = np.transpose(centers[rng.randint(num_clusters, size=num_bboxes)])
+    cy = np.clip(cy + rng.normal(scale=0.08, size=num_bboxes), 0., 1.)
+    cx = np.clip(cx + rng.normal(scale=0.08, size=num_bboxes), 0., 1.)
+    h = rng.uniform(0.005, 0.03, size=num_bboxes)
+    w = rng.uniform(0.005, 0.03, size=num_bboxes)
+    bboxes = np.stack([cy - h / 2., cx - w / 2., cy + h / 2., cx + w / 2.], axis=-1)
+    bboxes = bboxes.astype(np.float32)
+    classes = rng.randint(1, num_classes, size=num_bboxes)
+    scores = np.sort(rng.uniform(size=num_bboxes).astype(np.float32))[::-1]
+    return classes, scores, bboxes
+
+
+def timeit(fn, repeat):
+    """Best wall time of a few runs, in milliseconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        r = fn()
+        timings.append(time.time() - start)
+    return 1000. * min(timings), r
+
+
+def main(args):
+    print('%8s | %12s | %12s | %8s | %s' % ('N', 'dense (ms)', 'grid (ms)', 'speedup', 'same'))
+    for n in args.num_bboxes:
+        classes, scores, bboxes = random_scene(n, seed=args.seed)
+        t_dense, r_dense = timeit(lambda: np_methods.bboxes_nms_fast(
+            classes, scores, bboxes, nms_threshold=args.nms_threshold), args.repeat)
+        t_grid, r_grid = timeit(lambda: np_methods.bboxes_nms_grid(
+            classes, scores, bboxes, nms_threshold=args.nms_threshold), args.repeat)
+        same = all(np.array_equal(a, b) for a, b in zip(r_dense, r_grid))
+        print('%8i | %12.1f | %12.1f | %7.1fx | %s'
+              % (n, t_dense, t_grid, t_dense / t_grid, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_bboxes', type=int, nargs='+',
+                        default=[1000, 5000, 20000],
+                        help='Number of candidate boxes.')
+    parser.add_argument('--nms_threshold', type=float, default=0.45,
+                        help='NMS threshold.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs per measure.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed.')
+    main(parser.parse_args())
@@ -0,0 +1,63 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Throughput of the multi-process CPU inference pool, as a function of the
+number of workers (each one pinned to #cores / #workers cores).
+
+Usage:
+    python benchmark_pool.py --frozen_graph ./checkpoints/ssd_512_vgg_frozen.pb \
+        --image_dir ./VisDrone2018-DET-val/images --num_workers 1 2 4 8 16
+"""
+import argparse
+import os
+import time
+
+from inference import pool
+
+
+def main(args):
+    names = sorted(os.listdir(args.image_dir))[:args.num_images]
+    paths = [os.path.join(args.image_dir, n) for n in names]
+    print('%8s | %14s | %10s | %s' % ('workers', 'cores/worker', 'images/s', 'speedup'))
+    reference = None
+    for num_workers in args.num_workers:
+        cores = pool.worker_cores(0, num_workers)
+        with pool.InferencePool(args.frozen_graph, num_workers=num_workers,
+                                batch_size=args.batch_size) as p:
+            # Warm-up: one batch per worker.
+            for _ in p.map(paths[:num_workers * args.batch_size]):
+                pass
+            start = time.time()
+            for _ in p.map(paths):
+                pass
+            throughput = len(paths) / (time.time() - start)
+        reference = reference or throughput
+        print('%8i | %14i | %10.2f | %6.2fx'
+              % (num_workers, len(cores), throughput, throughput / reference))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frozen_graph', type=str, required=True,
+                        help='Frozen inference graph, c.f. export_inference_graph.py.')
+    parser.add_argument('--image_dir', type=str, required=True,
+                        help='Directory of images.')
+    parser.add_argument('--num_images', type=int, default=200,
+                        help='Number of images per measure.')
+    parser.add_argument('--num_workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16],
+                        help='Numbers of workers to benchmark.')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='Images per batch.')
+    main(parser.parse_args())
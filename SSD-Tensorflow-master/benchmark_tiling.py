@@ -0,0 +1,120 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Throughput of tiled inference on frames of mixed sizes: per-frame tiles
+batching vs cross-frame tiles packing.
+
+Without --image_dir, random frames alternating between 1360x765 and
+2000x1500 are used. Without --checkpoint, the network is randomly
+initialized (timings only).
+
+Usage:
+    python benchmark_tiling.py --image_dir ./detection_image/images \
+        --checkpoint ./checkpoints/model.ckpt-44019 --batch_size 16
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+import matplotlib.image as mpimg
+
+from inference import tiling
+from nets import ssd_vgg_512
+
+
+def load_frames(args):
+    """List of (name, image) frames.
+    """
+    if args.image_dir:
+        names = sorted(os.listdir(args.image_dir))[:args.num_frames]
+        return [(n, mpimg.imread(os.path.join(args.image_dir, n))) for n in names]
+    rng = np.random.RandomState(0)
+    shapes = [(765, 1360, 3), (1500, 2000, 3)]
+    return [('random_%i' % i, rng.randint(0, 255, size=shapes[i % 2]).astype(np.uint8))
+            for i in range(args.num_frames)]
+
+
+def per_frame(detector, frames):
+    """Baseline: the tiles of every frame are batched separately.
+    """
+    for key, image in frames:
+        yield key, detector.detect([image])[0]
+
+
+def run(name, fn, frames, detector):
+    """Time a detection function and print the throughput.
+    """
+    num_tiles = 0
+    for _, image in frames:
+        offsets, _ = tiling.tiles_geometry(image.shape[:2], detector.tile_shape,
+                                           detector.stride)
+        num_tiles += len(offsets)
+    num_batches = [0]
+    run_tiles = detector.run_tiles
+
+    def counted_run_tiles(tiles):
+        num_batches[0] += 1
+        return run_tiles(tiles)
+    detector.run_tiles = counted_run_tiles
+
+    start = time.time()
+    for _ in fn(detector, frames):
+        pass
+    duration = time.time() - start
+    detector.run_tiles = run_tiles
+    occupancy = num_tiles / float(num_batches[0] * detector.batch_size)
+    print('%12s | %8.2f | %9.2f | %8i | %8.1f%%'
+          % (name, len(frames) / duration, num_tiles / duration,
+             num_batches[0], 100. * occupancy))
+
+
+def main(args):
+    frames = load_frames(args)
+    config = tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))
+    with tf.Session(config=config) as sess:
+        ssd_net = ssd_vgg_512.SSDNet()
+        detector = tiling.TiledDetector(sess, ssd_net,
+                                        stride=(args.stride, args.stride),
+                                        batch_size=args.batch_size,
+                                        data_format=args.data_format)
+        if args.checkpoint:
+            tf.train.Saver().restore(sess, args.checkpoint)
+        else:
+            sess.run(tf.global_variables_initializer())
+        # Warm-up.
+        detector.detect([frames[0][1]])
+
+        print('%12s | %8s | %9s | %8s | %9s'
+              % ('scheduler', 'frames/s', 'tiles/s', 'batches', 'occupancy'))
+        run('per-frame', per_frame, frames, detector)
+        run('cross-frame', lambda d, f: d.detect_stream(f), frames, detector)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=str, default=None,
+                        help='Directory of frames.')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='SSD 512 checkpoint.')
+    parser.add_argument('--num_frames', type=int, default=20,
+                        help='Number of frames.')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='Tiles batch size.')
+    parser.add_argument('--stride', type=int, default=384,
+                        help='Tiles stride, in pixels.')
+    parser.add_argument('--data_format', type=str, default='NHWC',
+                        help='NHWC or NCHW.')
+    main(parser.parse_args())
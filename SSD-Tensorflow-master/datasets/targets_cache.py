@@ -0,0 +1,209 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Cache of the encoded groundtruth targets of evaluation runs.
+
+Evaluation preprocessing is deterministic, hence so are the SSD targets of
+every record. They are stored as sparse positive rows (c.f.
+`ssd_common.tf_ssd_bboxes_encode_sparse`) in a sidecar file next to every
+TFRecords shard:
+
+    <shard>.targets-<config hash>.npz
+
+where the hash covers the anchors and the encoding parameters. Every record
+is keyed by its TFRecord key, and stores a digest of its preprocessed
+labels and bboxes: stale entries are encoded again. Updated sidecar files
+are written once all the records of the dataset have been looked up, and
+at the end of every evaluation (c.f. `TargetsCacheHook`), e.g. when only
+a part of the dataset is evaluated.
+"""
+import hashlib
+import io
+import os
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from file_utils import atomic_write
+from nets import np_methods
+
+
+def config_hash(anchors, *params):
+    """Short SHA-1 hex digest of an AnchorTable and encoding parameters.
+    """
+    h = hashlib.sha1(np.ascontiguousarray(anchors.centers).tobytes())
+    h.update(repr(params).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def sidecar_name(shard, chash):
+    """Sidecar file name of a TFRecords shard.
+    """
+    return '%s.targets-%s.npz' % (shard, chash)
+
+
+def objects_digest(labels, bboxes):
+    """SHA-1 hex digest of the groundtruth of a record.
+    """
+    h = hashlib.sha1(np.ascontiguousarray(labels, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(bboxes, dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+class TargetsCache(object):
+    """Sparse targets of the records of a dataset, backed by sidecar files.
+
+    Args:
+      anchors: AnchorTable of the network;
+      num_classes, prior_scaling: Encoding parameters of the network;
+      num_samples: Number of records in the dataset;
+      max_positives: Number of sparse rows P per record;
+      positive_threshold: Minimum score of the stored anchors, at most the
+        matching threshold of the losses.
+    """
+    def __init__(self, anchors, num_classes, num_samples,
+                 prior_scaling=[0.1, 0.1, 0.2, 0.2],
+                 max_positives=2048, positive_threshold=0.5):
+        self.encoder = np_methods.SSDTargetEncoder(anchors, num_classes, prior_scaling)
+        self.hash = config_hash(anchors, num_classes, list(prior_scaling),
+                                positive_threshold)
+        self.num_samples = num_samples
+        self.max_positives = max_positives
+        self.positive_threshold = positive_threshold
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.shards = {}
+        self.dirty = set()
+        self.checked = set()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def load_shard(self, shard):
+        """Load the entries of a shard sidecar file, if any.
+        """
+        self.shards[shard] = set()
+        fname = sidecar_name(shard, self.hash)
+        if not os.path.exists(fname):
+            return
+        with np.load(fname, allow_pickle=False) as f:
+            data = {k: f[k] for k in f.files}
+        offsets = np.concatenate([[0], np.cumsum(data['counts'])])
+        for i, key in enumerate(data['keys']):
+            key = str(key)
+            rows = slice(offsets[i], offsets[i+1])
+            self.entries[key] = (str(data['digests'][i]),
+                                 data['indexes'][rows], data['labels'][rows],
+                                 data['localizations'][rows], data['scores'][rows])
+            self.shards[shard].add(key)
+
+    def save_shard(self, shard):
+        """Write the sidecar file of a shard.
+        """
+        keys = sorted(self.shards[shard])
+        entries = [self.entries[k] for k in keys]
+        buf = io.BytesIO()
+        np.savez(buf,
+                 keys=np.array(keys),
+                 digests=np.array([e[0] for e in entries]),
+                 counts=np.array([len(e[1]) for e in entries], dtype=np.int32),
+                 indexes=np.concatenate([e[1] for e in entries]),
+                 labels=np.concatenate([e[2] for e in entries]),
+                 localizations=np.concatenate([e[3] for e in entries]),
+                 scores=np.concatenate([e[4] for e in entries]))
+        atomic_write(sidecar_name(shard, self.hash), buf.getvalue())
+
+    def flush_locked(self):
+        for shard in self.dirty:
+            self.save_shard(shard)
+        self.dirty = set()
+
+    def flush(self):
+        """Write the sidecar files of the shards with new entries.
+        """
+        with self.lock:
+            self.flush_locked()
+
+    def encode(self, labels, bboxes):
+        """Encode a record: positive rows, by decreasing score.
+        """
+        t_labels, t_loc, t_scores = self.encoder.encode(labels, bboxes)
+        idxes = np.where(t_scores > self.positive_threshold)[0]
+        idxes = idxes[np.argsort(-t_scores[idxes], kind='stable')]
+        return (idxes.astype(np.int32), t_labels[idxes].astype(np.int16),
+                t_loc[idxes], t_scores[idxes])
+
+    def lookup(self, key, labels, bboxes):
+        """Sparse targets of a record, from the cache or encoded.
+
+        Return:
+          (indexes, labels, localizations, scores) arrays of P rows, padded
+          with zeros.
+        """
+        key = key.decode('utf-8') if isinstance(key, bytes) else key
+        shard = key.rsplit(':', 1)[0]
+        digest = objects_digest(labels, bboxes)
+        with self.lock:
+            if shard not in self.shards:
+                self.load_shard(shard)
+            entry = self.entries.get(key)
+        if entry is None or entry[0] != digest:
+            entry = (digest, ) + self.encode(labels, bboxes)
+            with self.lock:
+                self.num_misses += 1
+                self.entries[key] = entry
+                self.shards[shard].add(key)
+                self.dirty.add(shard)
+        else:
+            with self.lock:
+                self.num_hits += 1
+        with self.lock:
+            self.checked.add(key)
+            # Complete dataset: write the updated sidecar files.
+            if len(self.checked) >= self.num_samples:
+                self.flush_locked()
+
+        # Pad / truncate to P rows.
+        num_rows = min(len(entry[1]), self.max_positives)
+        indexes = np.zeros((self.max_positives, ), dtype=np.int64)
+        t_labels = np.zeros((self.max_positives, ), dtype=np.int64)
+        t_loc = np.zeros((self.max_positives, 4), dtype=np.float32)
+        t_scores = np.zeros((self.max_positives, ), dtype=np.float32)
+        indexes[:num_rows] = entry[1][:num_rows]
+        t_labels[:num_rows] = entry[2][:num_rows]
+        t_loc[:num_rows] = entry[3][:num_rows]
+        t_scores[:num_rows] = entry[4][:num_rows]
+        return indexes, t_labels, t_loc, t_scores
+
+    def lookup_op(self, key, labels, bboxes, dtype=tf.float32):
+        """TF op of `lookup`: same outputs as `SSDNet.bboxes_encode_sparse`.
+        """
+        indexes, t_labels, t_loc, t_scores = tf.py_func(
+            self.lookup, [key, labels, bboxes],
+            [tf.int64, tf.int64, tf.float32, tf.float32], stateful=True)
+        indexes.set_shape([self.max_positives])
+        t_labels.set_shape([self.max_positives])
+        t_loc = tf.cast(tf.reshape(t_loc, [self.max_positives, 4]), dtype)
+        t_scores = tf.cast(tf.reshape(t_scores, [self.max_positives]), dtype)
+        return indexes, t_labels, t_loc, t_scores
+
+
+class TargetsCacheHook(tf.train.SessionRunHook):
+    """Flush a TargetsCache at the end of every evaluation.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+
+    def end(self, session):
+        self.cache.flush()
@@ -0,0 +1,150 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Compare frame-by-frame and sequence-aware inference on a VisDrone split:
+forward passes saved, frames reused and mAP delta, for the two reuse
+policies of inference/sequence.py:
+  - whole frames (`FrameReuse`), on frames warped to the network shape, as
+    `run_inference.py --sequence_threshold`;
+  - tiles (`SequenceTiledDetector`), with tiled inference.
+
+Usage:
+    python eval_sequence.py --dataset_dir ./VisDrone2018-VID-val \
+        --checkpoint ./checkpoints/model.ckpt-44019 --threshold 0.02
+"""
+import argparse
+import itertools
+import os
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+import matplotlib.image as mpimg
+
+from inference import evaluation
+from inference import sequence
+from inference import tiling
+from nets import ssd_vgg_512
+
+
+class WarpedDetector(object):
+    """Detector on frames already warped to the network shape, run in
+    batches, as in run_inference.py.
+    """
+    def __init__(self, detector):
+        self.detector = detector
+
+    def detect_stream(self, frames):
+        frames = iter(frames)
+        while True:
+            batch = list(itertools.islice(frames, self.detector.batch_size))
+            if not batch:
+                return
+            results = self.detector.run_tiles(np.stack([im for _, im in batch], axis=0))
+            for (key, _), r in zip(batch, results):
+                yield key, r
+
+
+def evaluate(detector, names, args, warp_shape=None):
+    """Run a detector on the split and compute its mAP. Frames are first
+    warped to `warp_shape`, if any.
+    """
+    shapes = {}
+
+    def frames():
+        for name in names:
+            image = mpimg.imread(os.path.join(args.dataset_dir, 'images', name))
+            shapes[name] = image.shape[:2]
+            if warp_shape is not None:
+                image = cv2.resize(image, (warp_shape[1], warp_shape[0]),
+                                   interpolation=cv2.INTER_LINEAR)
+            yield name, image
+
+    detections = []
+    groundtruths = []
+    start = time.time()
+    for name, (classes, scores, bboxes) in detector.detect_stream(frames()):
+        # Relative bboxes to pixels, as the annotations.
+        detections.append((classes, scores, bboxes * np.tile(shapes.pop(name), 2)))
+        groundtruths.append(evaluation.visdrone_load(
+            os.path.join(args.dataset_dir, 'annotations', name[:-4] + '.txt')))
+    duration = time.time() - start
+    _, mAP = evaluation.visdrone_average_precision(detections, groundtruths)
+    return mAP, duration
+
+
+def main(args):
+    # Frames sorted by sequence, then frame number.
+    names = sorted(os.listdir(os.path.join(args.dataset_dir, 'images')))
+    names = names[:args.num_images] if args.num_images else names
+    config = tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))
+    with tf.Session(config=config) as sess:
+        ssd_net = ssd_vgg_512.SSDNet()
+        detector = tiling.TiledDetector(sess, ssd_net,
+                                        stride=(args.stride, args.stride),
+                                        batch_size=args.batch_size,
+                                        data_format=args.data_format)
+        tf.train.Saver().restore(sess, args.checkpoint)
+
+        # Whole frames, warped to the network shape (run_inference.py).
+        warped = WarpedDetector(detector)
+        mAP_frames_ref, duration_frames_ref = evaluate(
+            warped, names, args, warp_shape=detector.tile_shape)
+        frame_detector = sequence.SequenceFrameDetector(warped, threshold=args.threshold)
+        mAP_frames, duration_frames = evaluate(
+            frame_detector, names, args, warp_shape=detector.tile_shape)
+        # Tiled inference.
+        mAP_tiles_ref, duration_tiles_ref = evaluate(detector, names, args)
+        tile_detector = sequence.SequenceTiledDetector(detector, threshold=args.threshold)
+        mAP_tiles, duration_tiles = evaluate(tile_detector, names, args)
+
+    num_images = len(names)
+    print('Whole frames (run_inference.py --sequence_threshold):')
+    print('%12s | mAP: %.4f | %.2f images/s'
+          % ('per-frame', mAP_frames_ref, num_images / duration_frames_ref))
+    print('%12s | mAP: %.4f | %.2f images/s'
+          % ('sequence', mAP_frames, num_images / duration_frames))
+    reuse = frame_detector.reuse
+    print('Frames reused: %i / %i. mAP delta: %+.4f'
+          % (reuse.num_frames_reused, reuse.num_frames, mAP_frames - mAP_frames_ref))
+
+    print('Tiles:')
+    print('%12s | mAP: %.4f | %.2f images/s'
+          % ('per-frame', mAP_tiles_ref, num_images / duration_tiles_ref))
+    print('%12s | mAP: %.4f | %.2f images/s'
+          % ('sequence', mAP_tiles, num_images / duration_tiles))
+    print('Frames reused: %i / %i. Tiles passes saved: %i / %i (%.1f%%).'
+          % (tile_detector.num_frames_reused, tile_detector.num_frames,
+             tile_detector.num_tiles - tile_detector.num_tiles_run, tile_detector.num_tiles,
+             100. * (1. - tile_detector.num_tiles_run / float(max(tile_detector.num_tiles, 1)))))
+    print('mAP delta: %+.4f' % (mAP_tiles - mAP_tiles_ref))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', type=str, required=True,
+                        help='VisDrone split, with images/ and annotations/.')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='SSD 512 checkpoint.')
+    parser.add_argument('--num_images', type=int, default=0,
+                        help='Number of images to evaluate (0: all).')
+    parser.add_argument('--threshold', type=float, default=0.02,
+                        help='Difference score over which a frame / tile is run again.')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='Tiles batch size.')
+    parser.add_argument('--stride', type=int, default=384,
+                        help='Tiles stride, in pixels.')
+    parser.add_argument('--data_format', type=str, default='NHWC',
+                        help='NHWC or NCHW.')
+    main(parser.parse_args())
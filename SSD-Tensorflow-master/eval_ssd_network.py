@@ -26,6 +26,7 @@ import tf_utils
 from tensorflow.python.framework import ops
 
 from datasets import dataset_factory
+from datasets import targets_cache
 from nets import nets_factory
 from preprocessing import preprocessing_factory
 
@@ -58,6 +59,19 @@ tf.app.flags.DEFINE_integer(
     'eval_image_size', None, 'Eval image size.')
 tf.app.flags.DEFINE_boolean(
     'remove_difficult', True, 'Remove difficult objects from evaluation.')
+tf.app.flags.DEFINE_string(
+    'encode_method', 'vectorized',
+    'Groundtruth encoding: vectorized / while_loop / numpy (same targets).')
+tf.app.flags.DEFINE_boolean(
+    'compute_losses', True,
+    'Encode the groundtruth and compute the SSD losses, for reporting.')
+tf.app.flags.DEFINE_boolean(
+    'targets_cache', False,
+    'Cache the encoded groundtruth in sidecar files next to the TFRecords, '
+    'reused by later evaluations.')
+tf.app.flags.DEFINE_integer(
+    'targets_cache_max_positives', 2048,
+    'Number of sparse rows (positive anchors) of the cached groundtruth.')
 
 # =========================================================================== #
 # Main evaluation flags.
@@ -162,21 +176,33 @@ def main(_):
                                        resize=FLAGS.eval_resize,
                                        difficults=None)
 
-            # Encode groundtruth labels and bboxes.
-            gclasses, glocalisations, gscores = \
-                ssd_net.bboxes_encode(glabels, gbboxes, ssd_anchors)
-            batch_shape = [1] * 5 + [len(ssd_anchors)] * 3
+            # Encode groundtruth labels and bboxes, or get them from the cache.
+            if not FLAGS.compute_losses:
+                gtargets = []
+                batch_shape = [1] * 5
+            elif FLAGS.targets_cache:
+                [record_key] = provider.get(['record_key'])
+                cache = targets_cache.TargetsCache(
+                    ssd_anchors, ssd_params.num_classes, dataset.num_samples,
+                    prior_scaling=ssd_params.prior_scaling,
+                    max_positives=FLAGS.targets_cache_max_positives)
+                gtargets = list(cache.lookup_op(record_key, glabels, gbboxes))
+                batch_shape = [1] * 9
+            else:
+                gtargets = ssd_net.bboxes_encode(glabels, gbboxes, ssd_anchors,
+                                                 method=FLAGS.encode_method)
+                batch_shape = [1] * 5 + [len(ssd_anchors)] * 3
 
             # Evaluation batch.
             r = tf.train.batch(
-                tf_utils.reshape_list([image, glabels, gbboxes, gdifficults, gbbox_img,
-                                       gclasses, glocalisations, gscores]),
+                tf_utils.reshape_list([image, glabels, gbboxes, gdifficults, gbbox_img] +
+                                      list(gtargets)),
                 batch_size=FLAGS.batch_size,
                 num_threads=FLAGS.num_preprocessing_threads,
                 capacity=5 * FLAGS.batch_size,
                 dynamic_pad=True)
-            (b_image, b_glabels, b_gbboxes, b_gdifficults, b_gbbox_img, b_gclasses,
-             b_glocalisations, b_gscores) = tf_utils.reshape_list(r, batch_shape)
+            b_inputs = tf_utils.reshape_list(r, batch_shape)
+            b_image, b_glabels, b_gbboxes, b_gdifficults, b_gbbox_img = b_inputs[:5]
 
         # =================================================================== #
         # SSD Network + Ouputs decoding.
@@ -187,8 +213,14 @@ def main(_):
             predictions, localisations, logits, end_points = \
                 ssd_net.net(b_image, is_training=False)
         # Add losses functions.
-        ssd_net.losses(logits, localisations,
-                       b_gclasses, b_glocalisations, b_gscores)
+        if FLAGS.compute_losses:
+            if FLAGS.targets_cache:
+                b_gclasses, b_glocalisations, b_gscores = \
+                    ssd_net.bboxes_densify(*b_inputs[5:], anchors=ssd_anchors)
+            else:
+                b_gclasses, b_glocalisations, b_gscores = b_inputs[5:]
+            ssd_net.losses(logits, localisations,
+                           b_gclasses, b_glocalisations, b_gscores)
 
         # Performing post-processing on CPU: loop-intensive, usually more efficient.
         with tf.device('/device:CPU:0'):
@@ -295,6 +327,10 @@ def main(_):
         gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=FLAGS.gpu_memory_fraction)
         config = tf.ConfigProto(log_device_placement=False, gpu_options=gpu_options)
         # config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+        # Write the cached targets at the end of every evaluation.
+        hooks = []
+        if FLAGS.compute_losses and FLAGS.targets_cache:
+            hooks.append(targets_cache.TargetsCacheHook(cache))
 
         # Number of batches...
         if FLAGS.max_num_batches:
@@ -318,6 +354,7 @@ def main(_):
                 num_evals=num_batches,
                 eval_op=list(names_to_updates.values()),
                 variables_to_restore=variables_to_restore,
+                hooks=hooks,
                 session_config=config)
             # Log time spent.
             elapsed = time.time()
@@ -339,6 +376,7 @@ def main(_):
                 variables_to_restore=variables_to_restore,
                 eval_interval_secs=60,
                 max_number_of_evaluations=np.inf,
+                hooks=hooks,
                 session_config=config,
                 timeout=None)
 
@@ -0,0 +1,108 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Compare uniform and two-stage (density-adaptive) tiled inference on a
+VisDrone split: fraction of tiles skipped, timings and mAP delta.
+
+Usage:
+    python eval_tiling.py --dataset_dir ./VisDrone2018-DET-val \
+        --checkpoint ./checkpoints/model.ckpt-44019
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+import matplotlib.image as mpimg
+
+from inference import evaluation
+from inference import tiling
+from nets import ssd_vgg_512
+
+
+def evaluate(detector, names, args):
+    """Run the detector on the split and compute its mAP.
+    """
+    def frames():
+        for name in names:
+            image = mpimg.imread(os.path.join(args.dataset_dir, 'images', name))
+            yield (name, image.shape[:2]), image
+
+    detections = []
+    groundtruths = []
+    start = time.time()
+    for (name, shape), (classes, scores, bboxes) in detector.detect_stream(frames()):
+        # Relative bboxes to pixels, as the annotations.
+        bboxes = bboxes * np.tile(shape, 2)
+        detections.append((classes, scores, bboxes))
+        groundtruths.append(evaluation.visdrone_load(
+            os.path.join(args.dataset_dir, 'annotations', name[:-4] + '.txt')))
+    duration = time.time() - start
+    aps, mAP = evaluation.visdrone_average_precision(
+        detections, groundtruths, num_classes=detector.ssd_net.params.num_classes)
+    return mAP, aps, duration
+
+
+def main(args):
+    names = sorted(os.listdir(os.path.join(args.dataset_dir, 'images')))
+    names = names[:args.num_images] if args.num_images else names
+    config = tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True))
+    with tf.Session(config=config) as sess:
+        ssd_net = ssd_vgg_512.SSDNet()
+        detector = tiling.TiledDetector(sess, ssd_net,
+                                        stride=(args.stride, args.stride),
+                                        batch_size=args.batch_size,
+                                        data_format=args.data_format,
+                                        select_threshold=args.select_threshold,
+                                        coarse_threshold=args.coarse_threshold,
+                                        coarse_margin=args.coarse_margin)
+        tf.train.Saver().restore(sess, args.checkpoint)
+
+        results = []
+        for two_stage in [False, True]:
+            detector.two_stage = two_stage
+            detector.num_tiles = 0
+            detector.num_tiles_skipped = 0
+            mAP, aps, duration = evaluate(detector, names, args)
+            skipped = detector.num_tiles_skipped / float(max(detector.num_tiles, 1))
+            results.append(mAP)
+            print('%10s | mAP: %.4f | tiles skipped: %5.1f%% | %.2f images/s'
+                  % ('two-stage' if two_stage else 'uniform', mAP,
+                     100. * skipped, len(names) / duration))
+            print('    AP per class: %s' % np.array2string(aps[1:], precision=4))
+        print('mAP delta: %+.4f' % (results[1] - results[0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', type=str, required=True,
+                        help='VisDrone split, with images/ and annotations/.')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='SSD 512 checkpoint.')
+    parser.add_argument('--num_images', type=int, default=0,
+                        help='Number of images to evaluate (0: all).')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='Tiles batch size.')
+    parser.add_argument('--stride', type=int, default=384,
+                        help='Tiles stride, in pixels.')
+    parser.add_argument('--data_format', type=str, default='NHWC',
+                        help='NHWC or NCHW.')
+    parser.add_argument('--select_threshold', type=float, default=0.5,
+                        help='Selection threshold of the tiles pass.')
+    parser.add_argument('--coarse_threshold', type=float, default=0.2,
+                        help='Selection threshold of the coarse pass.')
+    parser.add_argument('--coarse_margin', type=int, default=32,
+                        help='Margin around coarse detections, in pixels.')
+    main(parser.parse_args())
@@ -0,0 +1,122 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Export a SSD model as a frozen inference GraphDef.
+
+The graph takes a uint8 batch of images at the network shape and embeds the
+network, the bboxes decoding, selection, sort and per-class NMS. It returns
+zero padded `detection_classes`, `detection_scores`, `detection_boxes` and
+`num_detections` Tensors. Load it with `inference.frozen`.
+
+Usage:
+    python export_inference_graph.py \
+        --checkpoint_path ./checkpoints/model.ckpt-44019 \
+        --output_file ./checkpoints/ssd_512_vgg_frozen.pb
+"""
+import os
+
+import tensorflow as tf
+import tf_extended as tfe
+
+from inference import frozen
+from nets import nets_factory
+from preprocessing import ssd_vgg_preprocessing
+
+slim = tf.contrib.slim
+
+# =========================================================================== #
+# Export Flags.
+# =========================================================================== #
+tf.app.flags.DEFINE_string(
+    'checkpoint_path', './checkpoints/model.ckpt-44019',
+    'The directory where the model was written to or an absolute path to a '
+    'checkpoint file.')
+tf.app.flags.DEFINE_string(
+    'output_file', './checkpoints/ssd_512_vgg_frozen.pb',
+    'Frozen GraphDef file.')
+tf.app.flags.DEFINE_string(
+    'model_name', 'ssd_512_vgg', 'The name of the architecture to export.')
+tf.app.flags.DEFINE_integer(
+    'num_classes', 11, 'Number of classes to use in the dataset.')
+tf.app.flags.DEFINE_string(
+    'data_format', 'NHWC', 'Network data format: NHWC or NCHW.')
+tf.app.flags.DEFINE_float(
+    'select_threshold', 0.5, 'Selection threshold.')
+tf.app.flags.DEFINE_integer(
+    'select_top_k', 400, 'Select top-k detected bounding boxes.')
+tf.app.flags.DEFINE_integer(
+    'keep_top_k', 200, 'Keep top-k detected objects.')
+tf.app.flags.DEFINE_float(
+    'nms_threshold', 0.45, 'Non-Maximum Selection threshold.')
+tf.app.flags.DEFINE_boolean(
+    'soft_nms', False, 'Use Soft-NMS instead of NMS.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def main(_):
+    ssd_class = nets_factory.get_network(FLAGS.model_name)
+    ssd_params = ssd_class.default_params._replace(num_classes=FLAGS.num_classes)
+    ssd_net = ssd_class(ssd_params)
+    net_shape = ssd_net.params.img_shape
+
+    with tf.Graph().as_default() as graph:
+        # Batched uint8 input, whitened and transposed if necessary.
+        image_tensor = tf.placeholder(tf.uint8, shape=(None, net_shape[0], net_shape[1], 3),
+                                      name=frozen.INPUT_NODE)
+        image = tf.to_float(image_tensor)
+        image = image - tf.constant([ssd_vgg_preprocessing._R_MEAN,
+                                     ssd_vgg_preprocessing._G_MEAN,
+                                     ssd_vgg_preprocessing._B_MEAN],
+                                    dtype=image.dtype)
+        if FLAGS.data_format == 'NCHW':
+            image = tf.transpose(image, perm=(0, 3, 1, 2))
+        with slim.arg_scope(ssd_net.arg_scope(data_format=FLAGS.data_format)):
+            predictions, localisations, _, _ = \
+                ssd_net.net(image, is_training=False, data_format=FLAGS.data_format)
+
+        # Post-processing: decode, select, sort, NMS and merge classes.
+        ssd_anchors = ssd_net.anchors(net_shape)
+        localisations = ssd_net.bboxes_decode(localisations, ssd_anchors)
+        rscores, rbboxes = \
+            ssd_net.detected_bboxes(predictions, localisations,
+                                    select_threshold=FLAGS.select_threshold,
+                                    nms_threshold=FLAGS.nms_threshold,
+                                    top_k=FLAGS.select_top_k,
+                                    keep_top_k=FLAGS.keep_top_k,
+                                    soft_nms=FLAGS.soft_nms)
+        classes, scores, bboxes, num_detections = \
+            tfe.bboxes_flatten_classes(rscores, rbboxes, keep_top_k=FLAGS.keep_top_k)
+        bboxes = tfe.bboxes_clip(tf.constant([0., 0., 1., 1.]), bboxes)
+        outputs = [classes, scores, bboxes, num_detections]
+        for name, tensor in zip(frozen.OUTPUT_NODES, outputs):
+            tf.identity(tensor, name=name)
+
+        # Restore weights and freeze.
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, FLAGS.checkpoint_path)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), frozen.OUTPUT_NODES)
+
+    output_dir = os.path.dirname(FLAGS.output_file)
+    if output_dir and not tf.gfile.Exists(output_dir):
+        tf.gfile.MakeDirs(output_dir)
+    with tf.gfile.GFile(FLAGS.output_file, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('Frozen graph with %i nodes written to %s.'
+          % (len(graph_def.node), FLAGS.output_file))
+
+
+if __name__ == '__main__':
+    tf.app.run()
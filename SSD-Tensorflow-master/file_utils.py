@@ -0,0 +1,30 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""File tools shared by the datasets and inference code, without any
+TensorFlow dependency.
+"""
+import os
+
+
+def atomic_write(fname, data):
+    """Write bytes to a file atomically: temporary file in the same
+    directory, flushed to disk, then renamed.
+    """
+    tmp_fname = '%s.tmp.%i' % (fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
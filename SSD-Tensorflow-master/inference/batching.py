@@ -0,0 +1,143 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Dynamic batching of concurrent requests.
+
+Requests submitted from several threads are grouped in batches of at most
+`max_batch_size` items, waiting at most `max_wait` seconds after the first
+item of a batch, and processed together by a single thread.
+"""
+import collections
+import queue
+import threading
+import time
+from concurrent import futures
+
+import numpy as np
+
+
+class BatchingMetrics(object):
+    """Thread-safe latency and batch size statistics.
+    """
+    def __init__(self, max_samples=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=max_samples)
+        self.batch_sizes = collections.Counter()
+        self.num_requests = 0
+        self.num_errors = 0
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batch_sizes[size] += 1
+
+    def add_request(self, latency, error=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_requests += 1
+            self.num_errors += int(error)
+
+    def summary(self, percentiles=(50, 90, 95, 99)):
+        """Dictionary of metrics: requests counts, latency percentiles (ms)
+        and histogram of batch sizes.
+        """
+        with self.lock:
+            latencies = 1000. * np.asarray(self.latencies)
+            r = {'num_requests': self.num_requests,
+                 'num_errors': self.num_errors,
+                 'batch_size_histogram': {str(k): v for k, v in
+                                          sorted(self.batch_sizes.items())}}
+        r['latency_ms'] = {'p%i' % p: float(np.percentile(latencies, p))
+                           if latencies.size else None for p in percentiles}
+        return r
+
+
+class DynamicBatcher(object):
+    """Group concurrently submitted items into batches.
+
+    Args:
+      process_fn: Function processing a list of items, returning the list
+        of their results;
+      max_batch_size: Maximum number of items in a batch;
+      max_wait: Maximum waiting time, in seconds, after the first item of a
+        batch.
+    """
+    def __init__(self, process_fn, max_batch_size=16, max_wait=0.01,
+                 metrics=None):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics or BatchingMetrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        """Submit an item. Return a Future of its result.
+        """
+        future = futures.Future()
+        self.queue.put((item, future, time.time()))
+        return future
+
+    def next_batch(self):
+        """Block until a batch is available, and return it.
+        """
+        batch = [self.queue.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is None:
+                # Stop after this batch.
+                self.queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def run(self):
+        """Batching loop.
+        """
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            self.metrics.add_batch(len(batch))
+            try:
+                results = list(self.process_fn([item for item, _, _ in batch]))
+                if len(results) != len(batch):
+                    raise ValueError('process_fn returned %i results for %i items'
+                                     % (len(results), len(batch)))
+                error = None
+            except Exception as e:
+                results = [None] * len(batch)
+                error = e
+            for (_, future, start), r in zip(batch, results):
+                if error is None:
+                    future.set_result(r)
+                else:
+                    future.set_exception(error)
+                self.metrics.add_request(time.time() - start, error is not None)
+
+    def close(self):
+        """Stop the batching thread, once the pending items are processed.
+        """
+        self.queue.put(None)
+        self.thread.join()
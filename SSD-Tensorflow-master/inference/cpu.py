@@ -0,0 +1,100 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""CPU inference profile: NHWC layout and threads configuration.
+
+Most CPU convolution kernels only support (or are much faster in) the NHWC
+layout: use `CPU_DATA_FORMAT` for the inputs, `ssd_arg_scope` and `net`.
+"""
+import os
+import time
+
+import tensorflow as tf
+
+CPU_DATA_FORMAT = 'NHWC'
+
+
+def default_data_format():
+    """NCHW if a GPU is available, NHWC otherwise.
+    """
+    return 'NCHW' if tf.test.is_gpu_available() else CPU_DATA_FORMAT
+
+
+def cpu_session_config(intra_op_threads=0, inter_op_threads=0,
+                       per_session_threads=False):
+    """Session configuration running on CPU only.
+
+    Args:
+      intra_op_threads: Threads used inside an op (0: TensorFlow default);
+      inter_op_threads: Ops run in parallel (0: TensorFlow default);
+      per_session_threads: Use threads pools owned by the session, instead
+        of the global ones created with the first session configuration.
+    Return:
+      tf.ConfigProto.
+    """
+    return tf.ConfigProto(device_count={'GPU': 0},
+                          intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads,
+                          use_per_session_threads=per_session_threads)
+
+
+def threads_candidates(num_cores=None):
+    """Default (intra_op, inter_op) threads configurations to try.
+    """
+    num_cores = num_cores or os.cpu_count() or 1
+    intra = sorted(set([num_cores, max(num_cores // 2, 1), max(num_cores // 4, 1)]),
+                   reverse=True)
+    candidates = []
+    for n in intra:
+        for m in [1, 2, max(num_cores // n, 1)]:
+            if (n, m) not in candidates:
+                candidates.append((n, m))
+    return candidates
+
+
+def autotune_threads(graph, fetches, feed_dict, init_fn=None,
+                     candidates=None, num_runs=5, verbose=True):
+    """Pick the fastest threads configuration on the host.
+
+    Every candidate runs the graph in its own session, with per-session
+    threads pools: one warm-up run, then the best of `num_runs` is kept.
+
+    Args:
+      graph: Graph containing the fetches;
+      fetches, feed_dict: Arguments of `Session.run`;
+      init_fn: Function initializing a new session, e.g. restoring weights;
+      candidates: List of (intra_op, inter_op) configurations.
+    Return:
+      (intra_op, inter_op) fastest configuration, and dictionary of timings
+        (in seconds) per configuration.
+    """
+    candidates = candidates or threads_candidates()
+    timings = {}
+    for intra, inter in candidates:
+        config = cpu_session_config(intra, inter, per_session_threads=True)
+        with tf.Session(graph=graph, config=config) as sess:
+            if init_fn is not None:
+                init_fn(sess)
+            sess.run(fetches, feed_dict=feed_dict)
+            durations = []
+            for _ in range(num_runs):
+                start = time.time()
+                sess.run(fetches, feed_dict=feed_dict)
+                durations.append(time.time() - start)
+        timings[(intra, inter)] = min(durations)
+        if verbose:
+            print('intra_op %3i | inter_op %3i | %8.2f ms'
+                  % (intra, inter, 1000. * timings[(intra, inter)]))
+    best = min(timings, key=timings.get)
+    return best, timings
@@ -0,0 +1,124 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Numpy evaluation of detections against VisDrone annotations.
+
+Annotations rows are: bbox_left, bbox_top, bbox_width, bbox_height, score,
+object_category, truncation, occlusion. Rows with a zero score or the
+'ignored regions' (0) / 'others' (11) categories are ignored regions:
+detections inside them are neither true nor false positives.
+"""
+import numpy as np
+
+from nets import np_methods
+
+
+def visdrone_load(fname):
+    """Load a VisDrone annotations file.
+
+    Return:
+      classes: (N,) Numpy array of categories;
+      bboxes: (N, 4) Numpy array of bboxes (ymin, xmin, ymax, xmax), in pixels;
+      ignored: (N,) boolean array, ignored regions.
+    """
+    rows = np.loadtxt(fname, delimiter=',', ndmin=2, usecols=range(8))
+    rows = np.reshape(rows, (-1, 8))
+    bboxes = np.stack([rows[:, 1], rows[:, 0],
+                       rows[:, 1] + rows[:, 3], rows[:, 0] + rows[:, 2]], axis=-1)
+    classes = rows[:, 5].astype(np.int64)
+    ignored = np.logical_or(rows[:, 4] == 0,
+                            np.logical_or(classes == 0, classes == 11))
+    return classes, bboxes, ignored
+
+
+def average_precision(tp, scores, num_gt):
+    """VOC style average precision (area under the interpolated
+    precision / recall curve) of a collection of scored detections.
+    """
+    if num_gt == 0:
+        return np.nan
+    idxes = np.argsort(-scores, kind='stable')
+    tp = tp[idxes].astype(np.float64)
+    tp_cum = np.cumsum(tp)
+    fp_cum = np.cumsum(1. - tp)
+    recall = np.concatenate([[0.], tp_cum / num_gt, [1.]])
+    precision = np.concatenate([[0.], tp_cum / np.maximum(tp_cum + fp_cum, 1e-12), [0.]])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    return np.sum((recall[1:] - recall[:-1]) * precision[1:])
+
+
+def visdrone_average_precision(detections, groundtruths,
+                               num_classes=11, iou_threshold=0.5):
+    """Compute per class average precision of detections.
+
+    Arguments:
+      detections: List of (classes, scores, bboxes) per image;
+      groundtruths: List of (classes, bboxes, ignored) per image, c.f.
+        `visdrone_load`. Bboxes in the same coordinates as detections.
+    Return:
+      aps: (num_classes,) array of average precisions, NaN for classes
+        without groundtruth;
+      mAP: Mean of the defined average precisions.
+    """
+    l_tp = [[] for _ in range(num_classes)]
+    l_scores = [[] for _ in range(num_classes)]
+    num_gt = np.zeros((num_classes, ), dtype=np.int64)
+    for (classes, scores, bboxes), (gclasses, gbboxes, gignored) in \
+            zip(detections, groundtruths):
+        ignored_bboxes = gbboxes[gignored]
+        for c in range(1, num_classes):
+            gmask = np.logical_and(gclasses == c, ~gignored)
+            num_gt[c] += np.sum(gmask)
+            dmask = classes == c
+            if not np.any(dmask):
+                continue
+            c_scores = scores[dmask]
+            c_bboxes = bboxes[dmask]
+            order = np.argsort(-c_scores, kind='stable')
+            c_scores = c_scores[order]
+            c_bboxes = c_bboxes[order]
+            overlap = np_methods.bboxes_jaccard(c_bboxes[np.newaxis], gbboxes[gmask])
+            overlap = np.reshape(overlap, (len(c_scores), -1))
+            if len(ignored_bboxes):
+                inside = np_methods.bboxes_intersection(c_bboxes[np.newaxis],
+                                                        ignored_bboxes)
+                inside = np.any(np.reshape(inside, (len(c_scores), -1)) > 0.5, axis=1)
+            else:
+                inside = np.zeros((len(c_scores), ), dtype=np.bool_)
+
+            # Greedy matching by decreasing score.
+            matched = np.zeros((overlap.shape[1], ), dtype=np.bool_)
+            tp = np.zeros((len(c_scores), ), dtype=np.bool_)
+            keep = np.ones((len(c_scores), ), dtype=np.bool_)
+            for i in range(len(c_scores)):
+                candidates = np.where(matched, -1., overlap[i])
+                j = np.argmax(candidates) if candidates.size else -1
+                if j >= 0 and candidates[j] >= iou_threshold:
+                    matched[j] = True
+                    tp[i] = True
+                elif inside[i]:
+                    keep[i] = False
+            l_tp[c].append(tp[keep])
+            l_scores[c].append(c_scores[keep])
+
+    aps = np.full((num_classes, ), np.nan)
+    for c in range(1, num_classes):
+        if l_tp[c]:
+            tp = np.concatenate(l_tp[c])
+            scores = np.concatenate(l_scores[c])
+        else:
+            tp = np.zeros((0, ), dtype=np.bool_)
+            scores = np.zeros((0, ))
+        aps[c] = average_precision(tp, scores, num_gt[c])
+    return aps, np.nanmean(aps)
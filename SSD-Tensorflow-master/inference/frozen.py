@@ -0,0 +1,64 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Loading of frozen SSD inference graphs (c.f. export_inference_graph.py).
+
+The frozen graph embeds the network, the bboxes decoding, selection, sort
+and NMS: no `nets` module or checkpoint is required to run it.
+"""
+import tensorflow as tf
+
+# Input and outputs tensors names of the frozen graph.
+INPUT_NODE = 'image_tensor'
+OUTPUT_NODES = ['detection_classes',
+                'detection_scores',
+                'detection_boxes',
+                'num_detections']
+
+
+def load_frozen_graph(fname):
+    """Load a frozen GraphDef file in a new graph.
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(fname, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+    return graph
+
+
+class FrozenDetector(object):
+    """SSD detector running a frozen inference graph.
+    """
+    def __init__(self, fname, config=None):
+        self.graph = load_frozen_graph(fname)
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.image_tensor = self.graph.get_tensor_by_name(INPUT_NODE + ':0')
+        self.outputs = [self.graph.get_tensor_by_name(n + ':0')
+                        for n in OUTPUT_NODES]
+
+    def detect(self, images):
+        """Run the detector on a batch of images.
+
+        Args:
+          images: Batch x H x W x 3 uint8 RGB images, at the network shape.
+        Return:
+          classes, scores, bboxes, num_detections: zero padded Numpy arrays,
+            bboxes relative to the images.
+        """
+        return self.sess.run(self.outputs,
+                             feed_dict={self.image_tensor: images})
+
+    def close(self):
+        self.sess.close()
@@ -0,0 +1,86 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Progress manifest and atomic writes of long-running inference.
+
+Result files are written to a temporary file, then renamed: a killed run
+never leaves truncated results. Every completed image is then appended to
+a manifest with the SHA-1 of its result file, so that a restarted run can
+skip the images whose results are present and intact.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from file_utils import atomic_write
+
+
+def file_digest(fname):
+    """SHA-1 hex digest of a file content.
+    """
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class ProgressManifest(object):
+    """Append-only manifest of completed images: one JSON line per image,
+    with its result file and the SHA-1 of its content. Result files are
+    recorded relatively to the manifest directory, hence independently of
+    the working directory of the runs.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.root = os.path.dirname(os.path.abspath(fname))
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(fname):
+            with open(fname, 'r') as f:
+                content = f.read()
+            for line in content.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Truncated last line of a killed run.
+                    continue
+                self.entries[entry['image']] = entry
+            if content and not content.endswith('\n'):
+                with open(fname, 'a') as f:
+                    f.write('\n')
+
+    def is_done(self, image):
+        """Check that an image was completed, and that its result file is
+        still present and intact.
+        """
+        entry = self.entries.get(image)
+        if entry is None:
+            return False
+        fname = os.path.join(self.root, entry['output'])
+        if not os.path.exists(fname):
+            return False
+        return file_digest(fname) == entry['sha1']
+
+    def write(self, image, fname, data):
+        """Atomically write the result file of an image, and record it.
+        """
+        atomic_write(fname, data)
+        entry = {'image': image,
+                 'output': os.path.relpath(os.path.abspath(fname), self.root),
+                 'sha1': hashlib.sha1(data).hexdigest()}
+        with self.lock:
+            with open(self.fname, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[image] = entry
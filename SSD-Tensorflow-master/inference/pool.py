@@ -0,0 +1,212 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Multi-process CPU inference pool.
+
+Every worker process loads the frozen inference graph (c.f.
+export_inference_graph.py) in its own session, pinned to a slice of the
+host cores, and pulls batches of image paths from a shared queue. Results
+are merged back in the order of the inputs.
+"""
+import multiprocessing
+import os
+import pickle
+import queue
+
+import cv2
+import numpy as np
+
+# Queue messages.
+READY = 'ready'
+FAILED = 'failed'
+STOP = None
+
+
+def worker_cores(worker_id, num_workers, cores=None):
+    """Slice of the host cores assigned to a worker.
+    """
+    if cores is None:
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+    size = max(len(cores) // num_workers, 1)
+    start = (worker_id * size) % len(cores)
+    return cores[start:start+size]
+
+
+def load_image(path, net_shape):
+    """Decode an image and warp it to the network shape.
+
+    Return:
+      original image shape, (H, W, 3) RGB uint8 resized image.
+    """
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Can not read the image %s' % path)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    resized = cv2.resize(image, (net_shape[1], net_shape[0]),
+                         interpolation=cv2.INTER_LINEAR)
+    return image.shape[:2], resized
+
+
+def picklable_error(e):
+    """Exception sent back to the parent process: the original one if it
+    can be pickled, a RuntimeError with its description otherwise.
+    """
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError('%s: %s' % (type(e).__name__, e))
+
+
+def worker_main(worker_id, frozen_graph, cores, net_shape, tasks, results):
+    """Worker loop: load the frozen model, then process batches of paths
+    until the STOP message. Errors are sent back on the results queue.
+    """
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        # TensorFlow only imported in the workers, after pinning.
+        from inference import cpu
+        from inference import frozen
+        config = cpu.cpu_session_config(intra_op_threads=len(cores), inter_op_threads=1)
+        detector = frozen.FrozenDetector(frozen_graph, config=config)
+    except Exception as e:
+        results.put((FAILED, picklable_error(e)))
+        return
+    results.put((READY, worker_id))
+
+    while True:
+        task = tasks.get()
+        if task is STOP:
+            break
+        idx, paths = task
+        try:
+            images = [load_image(p, net_shape) for p in paths]
+            classes, scores, bboxes, num_detections = detector.detect(
+                np.stack([im for _, im in images], axis=0))
+            r = [(images[i][0], classes[i, :n], scores[i, :n], bboxes[i, :n])
+                 for i, n in enumerate(num_detections)]
+        except Exception as e:
+            r = picklable_error(e)
+        results.put((idx, r))
+    detector.close()
+
+
+class InferencePool(object):
+    """Pool of inference worker processes, one session each.
+
+    Usage:
+        with InferencePool('ssd_512_vgg_frozen.pb', num_workers=8) as pool:
+            for path, (shape, classes, scores, bboxes) in zip(paths, pool.map(paths)):
+                ...
+    """
+    def __init__(self, frozen_graph, num_workers=4, batch_size=1,
+                 net_shape=(512, 512), poll_interval=1.):
+        self.frozen_graph = frozen_graph
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.net_shape = tuple(net_shape)
+        self.poll_interval = poll_interval
+        self.workers = []
+        self.num_tasks = 0
+
+    def start(self):
+        """Start the workers, and wait until all of them loaded the model.
+        """
+        # Spawn: no TensorFlow state inherited from the parent process.
+        ctx = multiprocessing.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        for i in range(self.num_workers):
+            cores = worker_cores(i, self.num_workers)
+            p = ctx.Process(target=worker_main,
+                            args=(i, self.frozen_graph, cores, self.net_shape,
+                                  self.tasks, self.results))
+            p.daemon = True
+            p.start()
+            self.workers.append(p)
+        for _ in range(self.num_workers):
+            msg, r = self.next_result()
+            if msg == FAILED:
+                self.terminate()
+                raise r
+
+    def next_result(self):
+        """Next message of the results queue. Raise a RuntimeError if a
+        worker died meanwhile.
+        """
+        while True:
+            try:
+                return self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+            for i, p in enumerate(self.workers):
+                if not p.is_alive():
+                    self.terminate()
+                    raise RuntimeError('Inference worker %i died (exit code %s).'
+                                       % (i, p.exitcode))
+
+    def map(self, paths):
+        """Detect objects in a list of images.
+
+        Return:
+          Generator of (image shape, classes, scores, bboxes) per image, in
+          the order of `paths`, bboxes relative to the images. Errors of
+          the workers are raised in order as well.
+        """
+        paths = list(paths)
+        first = self.num_tasks
+        for i in range(0, len(paths), self.batch_size):
+            self.tasks.put((self.num_tasks, paths[i:i+self.batch_size]))
+            self.num_tasks += 1
+
+        # Reorder buffer: yield batches in order of submission.
+        buffer = {}
+        for idx in range(first, self.num_tasks):
+            while idx not in buffer:
+                r_idx, r = self.next_result()
+                buffer[r_idx] = r
+            r = buffer.pop(idx)
+            if isinstance(r, Exception):
+                raise r
+            for item in r:
+                yield item
+
+    def terminate(self):
+        """Kill the workers.
+        """
+        for p in self.workers:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        self.workers = []
+
+    def close(self):
+        """Stop the workers.
+        """
+        for _ in self.workers:
+            self.tasks.put(STOP)
+        for p in self.workers:
+            p.join()
+        self.workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,216 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Sequence-aware inference: reuse detections between similar frames.
+
+VisDrone frames are named `<sequence>_<frame>`, e.g. frame `0000111` of the
+sequence `0000193_01497_d`. Frames are compared with the last processed
+frame of their sequence on small grayscale thumbnails. Two reuse policies
+are provided:
+  - `FrameReuse`: the detections of a whole frame are reused when it is
+    similar to the reference one (c.f. run_inference.py);
+  - `SequenceTiledDetector`: the network is only run on the tiles of a
+    frame which changed.
+"""
+import collections
+import os
+
+import numpy as np
+
+from inference import tiling
+
+
+def sequence_id(name):
+    """Sequence id of a VisDrone frame file name.
+    """
+    name = os.path.splitext(os.path.basename(name))[0]
+    return name.rsplit('_', 1)[0]
+
+
+def thumbnail(image, factor=8):
+    """Grayscale thumbnail of an image, subsampled by `factor`.
+    """
+    return np.mean(image[::factor, ::factor], axis=-1, dtype=np.float32)
+
+
+def difference(thumb1, thumb2):
+    """Frame difference score: mean absolute difference, in [0, 1].
+    """
+    return float(np.mean(np.abs(thumb1 - thumb2))) / 255.
+
+
+class FrameReuse(object):
+    """Whole-frame reuse policy: every sequence keeps its last processed
+    frame as reference, and a frame whose difference score with it is under
+    `threshold` reuses its detections. Frames of a sequence are supposed to
+    be in order. Counters of frames and frames reused are kept for
+    reporting.
+    """
+    def __init__(self, threshold=0.02, factor=8):
+        self.threshold = threshold
+        self.factor = factor
+        self.references = {}
+        self.num_frames = 0
+        self.num_frames_reused = 0
+
+    def reference(self, name, image, payload, img_shape=None):
+        """Reference of a frame, given the `payload` of its results (e.g. a
+        future of its detections).
+
+        Args:
+          image: Frame compared with the reference, possibly resized;
+          img_shape: Original shape of the frame, by default `image` shape.
+        Return:
+          Payload of the reference frame if similar, otherwise `payload`,
+          the frame becoming the new reference of its sequence.
+        """
+        img_shape = tuple(image.shape[:2] if img_shape is None else img_shape)
+        seq = sequence_id(name)
+        thumb = thumbnail(image, self.factor)
+        ref = self.references.get(seq)
+        self.num_frames += 1
+        if ref is not None and ref[1] == img_shape and \
+                difference(thumb, ref[0]) < self.threshold:
+            self.num_frames_reused += 1
+            return ref[2]
+        self.references[seq] = (thumb, img_shape, payload)
+        return payload
+
+
+class SequenceFrameDetector(object):
+    """Sequence-aware wrapper of a detector, with the `FrameReuse` policy:
+    only the frames which are not reused are streamed to the detector.
+    """
+    def __init__(self, detector, threshold=0.02, factor=8):
+        self.detector = detector
+        self.reuse = FrameReuse(threshold, factor)
+
+    def detect_stream(self, frames):
+        """Detect objects in a stream of (name, image) frames. Frames of a
+        sequence are supposed to be in order.
+
+        Return:
+          Generator of (name, (classes, scores, bboxes)) pairs.
+        """
+        # Frames in order, with the [detections] of their reference.
+        order = collections.deque()
+
+        def run_frames():
+            for name, image in frames:
+                source = [None]
+                ref = self.reuse.reference(name, image, source)
+                order.append((name, ref))
+                if ref is source:
+                    yield source, image
+
+        for source, r in self.detector.detect_stream(run_frames()):
+            source[0] = r
+            # A reference always comes before the frames reusing it.
+            while order and order[0][1][0] is not None:
+                name, ref = order.popleft()
+                yield name, ref[0]
+        for name, ref in order:
+            yield name, ref[0]
+
+
+def tiles_thumbnails(thumb, offsets, tile_shape, padded_shape, factor=8):
+    """Thumbnails of the tiles of an image, from the image thumbnail.
+
+    Return:
+      (N, tile_height / factor, tile_width / factor) array.
+    """
+    padded = np.zeros(((padded_shape[0] + factor - 1) // factor,
+                       (padded_shape[1] + factor - 1) // factor), dtype=thumb.dtype)
+    padded[:thumb.shape[0], :thumb.shape[1]] = thumb
+    th = tile_shape[0] // factor
+    tw = tile_shape[1] // factor
+    return np.stack([padded[y // factor:y // factor + th, x // factor:x // factor + tw]
+                     for y, x in offsets], axis=0)
+
+
+class SequenceTiledDetector(object):
+    """Sequence-aware wrapper of a `tiling.TiledDetector`.
+
+    Every tile keeps the thumbnail it was last processed on and its
+    detections. A tile is only run again when its difference score with
+    this thumbnail is over `threshold`: a frame with no changed tile reuses
+    the previous detections without any forward pass. Counters of frames
+    and tiles processed / reused are kept for reporting.
+    """
+    def __init__(self, detector, threshold=0.02, factor=8):
+        self.detector = detector
+        self.threshold = threshold
+        self.factor = factor
+        self.states = {}
+        self.num_frames = 0
+        self.num_frames_reused = 0
+        self.num_tiles = 0
+        self.num_tiles_run = 0
+
+    def detect_frame(self, name, image):
+        """Detect objects in a frame of a sequence.
+
+        Return:
+          classes, scores, bboxes: Numpy arrays, bboxes relative to the frame.
+        """
+        detector = self.detector
+        img_shape = image.shape[:2]
+        offsets, padded_shape = tiling.tiles_geometry(
+            img_shape, detector.tile_shape, detector.stride)
+        thumbs = tiles_thumbnails(thumbnail(image, self.factor), offsets,
+                                  detector.tile_shape, padded_shape, self.factor)
+
+        # Changed tiles, compared with the last processed ones.
+        seq = sequence_id(name)
+        state = self.states.get(seq)
+        if state is None or state['img_shape'] != img_shape:
+            state = {'img_shape': img_shape,
+                     'thumbs': thumbs,
+                     'results': [None] * len(offsets),
+                     'detections': None}
+            self.states[seq] = state
+            changed = np.ones((len(offsets), ), dtype=np.bool_)
+        else:
+            diffs = np.mean(np.abs(thumbs - state['thumbs']), axis=(1, 2)) / 255.
+            changed = diffs >= self.threshold
+        self.num_frames += 1
+        self.num_tiles += len(offsets)
+        if not np.any(changed):
+            self.num_frames_reused += 1
+            return state['detections']
+
+        # Run the changed tiles only.
+        idxes = np.where(changed)[0]
+        tiles = tiling.tiles_extract(image, offsets[idxes], padded_shape,
+                                     detector.tile_shape)
+        for i in range(0, len(idxes), detector.batch_size):
+            results = detector.run_tiles(tiles[i:i+detector.batch_size])
+            for j, r in zip(idxes[i:i+detector.batch_size], results):
+                state['results'][j] = r
+        state['thumbs'][idxes] = thumbs[idxes]
+        self.num_tiles_run += len(idxes)
+
+        state['detections'] = detector.merge_tiles(state['results'], offsets,
+                                                   img_shape, padded_shape)
+        return state['detections']
+
+    def detect_stream(self, frames):
+        """Detect objects in a stream of (name, image) frames. Frames of a
+        sequence are supposed to be in order.
+
+        Return:
+          Generator of (name, (classes, scores, bboxes)) pairs.
+        """
+        for name, image in frames:
+            yield name, self.detect_frame(name, image)
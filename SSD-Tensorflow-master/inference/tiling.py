@@ -0,0 +1,310 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tiled inference on large images.
+
+Large VisDrone frames are cut into overlapping tiles at the SSD network
+resolution, instead of being warped to it. Tiles of one or several frames
+are packed in a single batch, run in one `session.run`, and the detections
+are shifted back to the frames and merged with weighted box fusion.
+"""
+import functools
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from nets import np_methods
+from preprocessing import ssd_vgg_preprocessing
+
+slim = tf.contrib.slim
+
+
+# =========================================================================== #
+# Tiles geometry.
+# =========================================================================== #
+def tiles_positions(size, tile_size, stride):
+    """Positions of the tiles along one dimension: regularly spaced with
+    `stride`, the last tile being aligned on the image border.
+    """
+    if size <= tile_size:
+        return [0]
+    positions = list(range(0, size - tile_size, stride))
+    positions.append(size - tile_size)
+    return positions
+
+
+@functools.lru_cache(maxsize=32)
+def tiles_geometry(img_shape, tile_shape=(512, 512), stride=(384, 384)):
+    """Compute the tiles covering an image. Cached per input resolution.
+
+    Images smaller than a tile are padded on the bottom / right sides.
+
+    Args:
+      img_shape: (height, width) of the image;
+      tile_shape: (height, width) of the tiles;
+      stride: (vertical, horizontal) stride between tiles.
+    Return:
+      offsets: (N, 2) read-only array, (y, x) pixel offsets of the tiles;
+      padded_shape: (height, width) of the padded image.
+    """
+    padded_shape = (max(img_shape[0], tile_shape[0]),
+                    max(img_shape[1], tile_shape[1]))
+    ys = tiles_positions(padded_shape[0], tile_shape[0], stride[0])
+    xs = tiles_positions(padded_shape[1], tile_shape[1], stride[1])
+    offsets = np.stack(np.meshgrid(ys, xs, indexing='ij'), axis=-1)
+    offsets = np.reshape(offsets, (-1, 2)).astype(np.int64)
+    offsets.setflags(write=False)
+    return offsets, padded_shape
+
+
+def tiles_extract(image, offsets, padded_shape, tile_shape=(512, 512)):
+    """Extract the tiles of an image, padding it with the mean color
+    if necessary.
+
+    Return:
+      (N, tile_height, tile_width, C) array of tiles.
+    """
+    height, width = image.shape[:2]
+    if (height, width) != tuple(padded_shape):
+        padded = np.empty(tuple(padded_shape) + image.shape[2:],
+                          dtype=image.dtype)
+        padded[...] = np.asarray([ssd_vgg_preprocessing._R_MEAN,
+                                  ssd_vgg_preprocessing._G_MEAN,
+                                  ssd_vgg_preprocessing._B_MEAN],
+                                 dtype=image.dtype)
+        padded[:height, :width] = image
+        image = padded
+    tiles = np.empty((len(offsets), tile_shape[0], tile_shape[1]) + image.shape[2:],
+                     dtype=image.dtype)
+    for i, (y, x) in enumerate(offsets):
+        tiles[i] = image[y:y+tile_shape[0], x:x+tile_shape[1]]
+    return tiles
+
+
+def tiles_select(offsets, tile_shape, img_shape, bboxes, margin=32):
+    """Select the tiles overlapping candidate regions.
+
+    Args:
+      offsets: (N, 2) pixel offsets of the tiles;
+      img_shape: (height, width) of the image;
+      bboxes: (M, 4) candidate bboxes, relative to the image;
+      margin: Margin added around the candidates, in pixels.
+    Return:
+      (N,) boolean mask of the selected tiles.
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64) * np.tile(img_shape[:2], 2)
+    bboxes += [-margin, -margin, margin, margin]
+    offsets = offsets[:, np.newaxis]
+    overlap = np.logical_and(
+        np.logical_and(bboxes[:, 0] < offsets[..., 0] + tile_shape[0],
+                       bboxes[:, 2] > offsets[..., 0]),
+        np.logical_and(bboxes[:, 1] < offsets[..., 1] + tile_shape[1],
+                       bboxes[:, 3] > offsets[..., 1]))
+    return np.any(overlap, axis=1)
+
+
+# =========================================================================== #
+# Tiled detector.
+# =========================================================================== #
+class TiledDetector(object):
+    """Tiled SSD detector on large images.
+
+    The network graph is built once, with a batched uint8 tiles placeholder.
+    Restore the network weights in `sess` after building the detector, e.g.
+    with `tf.train.Saver().restore(sess, ckpt_filename)`.
+
+    In two-stage mode, a coarse pass is first run on the frame warped to the
+    tile shape, and only the tiles overlapping its detections (with score
+    over `coarse_threshold`) are then processed. Tiles counters are kept in
+    `num_tiles` and `num_tiles_skipped`.
+    """
+    def __init__(self, sess, ssd_net,
+                 tile_shape=(512, 512),
+                 stride=(384, 384),
+                 batch_size=16,
+                 data_format='NHWC',
+                 select_threshold=0.5,
+                 nms_threshold=0.45,
+                 nms_method='greedy',
+                 iou_threshold=0.55,
+                 top_k=400,
+                 two_stage=False,
+                 coarse_threshold=0.2,
+                 coarse_margin=32):
+        self.sess = sess
+        self.ssd_net = ssd_net
+        self.tile_shape = tuple(tile_shape)
+        self.stride = tuple(stride)
+        self.batch_size = batch_size
+        self.select_threshold = select_threshold
+        self.nms_threshold = nms_threshold
+        self.nms_method = nms_method
+        self.iou_threshold = iou_threshold
+        self.top_k = top_k
+        self.two_stage = two_stage
+        self.coarse_threshold = coarse_threshold
+        self.coarse_margin = coarse_margin
+        self.num_tiles = 0
+        self.num_tiles_skipped = 0
+
+        # Batched tiles input, whitened and transposed if necessary.
+        self.tiles_input = tf.placeholder(
+            tf.uint8, shape=(None, tile_shape[0], tile_shape[1], 3))
+        image = tf.to_float(self.tiles_input)
+        image = image - tf.constant([ssd_vgg_preprocessing._R_MEAN,
+                                     ssd_vgg_preprocessing._G_MEAN,
+                                     ssd_vgg_preprocessing._B_MEAN],
+                                    dtype=image.dtype)
+        if data_format == 'NCHW':
+            image = tf.transpose(image, perm=(0, 3, 1, 2))
+        arg_scope = ssd_net.arg_scope(data_format=data_format)
+        with slim.arg_scope(arg_scope):
+            predictions, localisations, _, _ = \
+                ssd_net.net(image, is_training=False, data_format=data_format)
+        self.predictions = predictions
+        self.localisations = localisations
+        self.anchors = ssd_net.anchors(self.tile_shape)
+
+    def run_tiles(self, tiles, select_threshold=None):
+        """Run the network on a batch of tiles, and post-process every tile
+        with clipping, sorting and NMS.
+
+        Return:
+          List of (classes, scores, bboxes) per tile, bboxes relative to it.
+        """
+        if select_threshold is None:
+            select_threshold = self.select_threshold
+        rpredictions, rlocalisations = self.sess.run(
+            [self.predictions, self.localisations],
+            feed_dict={self.tiles_input: tiles})
+        rclasses, rscores, rbboxes, offsets = np_methods.ssd_bboxes_select_batch(
+            rpredictions, rlocalisations, self.anchors,
+            select_threshold=select_threshold,
+            img_shape=self.tile_shape,
+            num_classes=self.ssd_net.params.num_classes, decode=True)
+        rbboxes = np_methods.bboxes_clip([0., 0., 1., 1.], rbboxes)
+
+        results = []
+        for i in range(len(tiles)):
+            classes = rclasses[offsets[i]:offsets[i+1]]
+            scores = rscores[offsets[i]:offsets[i+1]]
+            bboxes = rbboxes[offsets[i]:offsets[i+1]]
+            classes, scores, bboxes = np_methods.bboxes_sort(
+                classes, scores, bboxes, top_k=self.top_k)
+            classes, scores, bboxes = np_methods.bboxes_nms_method(
+                classes, scores, bboxes, method=self.nms_method,
+                nms_threshold=self.nms_threshold)
+            results.append((classes, scores, bboxes))
+        return results
+
+    def coarse_tiles(self, image, offsets):
+        """Coarse pass on the warped frame, selecting the tiles to process.
+
+        Return:
+          (N,) boolean mask of the selected tiles.
+        """
+        warped = cv2.resize(image, (self.tile_shape[1], self.tile_shape[0]),
+                            interpolation=cv2.INTER_AREA)
+        _, _, bboxes = self.run_tiles(warped[np.newaxis],
+                                      select_threshold=self.coarse_threshold)[0]
+        return tiles_select(offsets, self.tile_shape, image.shape[:2], bboxes,
+                            margin=self.coarse_margin)
+
+    def merge_tiles(self, results, offsets, img_shape, padded_shape):
+        """Merge the tiles detections of one frame.
+
+        Return:
+          classes, scores, bboxes: Numpy arrays, bboxes relative to the frame.
+        """
+        tiles = [r + (o, ) for r, o in zip(results, offsets)]
+        classes, scores, bboxes = np_methods.bboxes_merge_tiles(
+            tiles, self.tile_shape, padded_shape,
+            iou_threshold=self.iou_threshold)
+        if tuple(img_shape) != tuple(padded_shape):
+            # Padded frame coordinates to frame coordinates.
+            bbox_ref = [0., 0.,
+                        float(img_shape[0]) / padded_shape[0],
+                        float(img_shape[1]) / padded_shape[1]]
+            bboxes = np_methods.bboxes_clip(bbox_ref, bboxes)
+            bboxes = np_methods.bboxes_resize(bbox_ref, bboxes)
+        return classes, scores, bboxes
+
+    def detect_stream(self, frames):
+        """Detect objects in a stream of frames. Tiles are packed in
+        batches of `batch_size` whatever frame they come from, and the
+        detections of a frame are yielded as soon as its last tile is
+        processed (i.e. in the order of the stream).
+
+        Args:
+          frames: Iterable of (key, image) pairs.
+        Return:
+          Generator of (key, (classes, scores, bboxes)) pairs, bboxes
+          relative to the frame.
+        """
+        # Pending frames: [key, geometry, tiles results, remaining tiles].
+        pending = []
+        q_tiles = []
+        q_frames = []
+        frames = iter(frames)
+        exhausted = False
+        while not exhausted or q_tiles or pending:
+            # Fill the tiles queue up to a full batch.
+            while not exhausted and len(q_tiles) < self.batch_size:
+                try:
+                    key, image = next(frames)
+                except StopIteration:
+                    exhausted = True
+                    break
+                img_shape = image.shape[:2]
+                offsets, padded_shape = tiles_geometry(
+                    img_shape, self.tile_shape, self.stride)
+                self.num_tiles += len(offsets)
+                if self.two_stage:
+                    mask = self.coarse_tiles(image, offsets)
+                    self.num_tiles_skipped += len(offsets) - np.sum(mask)
+                    offsets = offsets[mask]
+                frame = [key, (offsets, img_shape, padded_shape),
+                         [None] * len(offsets), len(offsets)]
+                pending.append(frame)
+                tiles = tiles_extract(image, offsets, padded_shape,
+                                      self.tile_shape)
+                q_tiles.extend(tiles)
+                q_frames.extend((frame, i) for i in range(len(tiles)))
+
+            # Run a batch and dispatch tiles results to their frames.
+            if q_tiles:
+                tiles = np.stack(q_tiles[:self.batch_size], axis=0)
+                results = self.run_tiles(tiles)
+                for (frame, i), r in zip(q_frames[:self.batch_size], results):
+                    frame[2][i] = r
+                    frame[3] -= 1
+                del q_tiles[:self.batch_size]
+                del q_frames[:self.batch_size]
+
+            # Emit completed frames.
+            while pending and pending[0][3] == 0:
+                key, geometry, results, _ = pending.pop(0)
+                offsets, img_shape, padded_shape = geometry
+                yield key, self.merge_tiles(results, offsets,
+                                            img_shape, padded_shape)
+
+    def detect(self, images):
+        """Detect objects in a list of frames. Tiles of all the frames are
+        packed together in batches of `batch_size`.
+
+        Return:
+          List of (classes, scores, bboxes) per frame, bboxes relative to it.
+        """
+        return [r for _, r in self.detect_stream(enumerate(images))]
@@ -17,6 +17,84 @@
 import numpy as np
 
 
+# =========================================================================== #
+# Flattened anchors table.
+# =========================================================================== #
+class AnchorTable(object):
+    """Anchor boxes of all the feature layers of a SSD network, flattened
+    once in a contiguous (num_anchors, 4) table, in both center
+    (cy, cx, h, w) and corner (ymin, xmin, ymax, xmax) forms.
+
+    Also behaves as the usual list of per-layer (y, x, h, w) anchors,
+    hence can be used wherever the latter is expected.
+    """
+    def __init__(self, layers_anchors):
+        self.layers = list(layers_anchors)
+        self.shapes = []
+        self._grids = []
+        l_centers = []
+        for yref, xref, href, wref in self.layers:
+            grid = np.broadcast_arrays(yref, xref, href, wref)
+            self.shapes.append(grid[0].shape)
+            self._grids.append(tuple(np.ascontiguousarray(g) for g in grid))
+            l_centers.append(np.stack([np.reshape(g, [-1]) for g in grid], axis=-1))
+        self.offsets = np.cumsum([0] + [np.prod(s) for s in self.shapes])
+        self.centers = np.ascontiguousarray(np.concatenate(l_centers, axis=0))
+        cy, cx, h, w = np.transpose(self.centers)
+        self.corners = np.stack([cy - h / 2., cx - w / 2.,
+                                 cy + h / 2., cx + w / 2.], axis=-1)
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, i):
+        return self.layers[i]
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    @property
+    def num_anchors(self):
+        return self.offsets[-1]
+
+    def layer_slice(self, i):
+        """Slice of the anchors of layer i in the flattened table.
+        """
+        return slice(self.offsets[i], self.offsets[i+1])
+
+    def layer_centers(self, i):
+        """(N_i, 4) center form anchors of layer i.
+        """
+        return self.centers[self.layer_slice(i)]
+
+    def layer_corners(self, i):
+        """(N_i, 4) corner form anchors of layer i.
+        """
+        return self.corners[self.layer_slice(i)]
+
+    def layer_grid(self, i):
+        """Anchors (y, x, h, w) of layer i, broadcasted to the (H, W, A) grid.
+        """
+        return self._grids[i]
+
+
+_ANCHOR_TABLES = {}
+
+
+def ssd_anchor_table(key, anchors_fn):
+    """Return the AnchorTable associated to a key, computing it from
+    `anchors_fn` (list of layers anchors) only once per process.
+
+    Arguments:
+      key: Description of the anchors, typically (img_shape, SSDParams, dtype).
+        Does not need to be hashable, its representation is used.
+    """
+    key = repr(key)
+    if key not in _ANCHOR_TABLES:
+        _ANCHOR_TABLES[key] = AnchorTable(anchors_fn())
+    return _ANCHOR_TABLES[key]
+
+
 # =========================================================================== #
 # Numpy implementations of SSD boxes functions.
 # =========================================================================== #
@@ -26,11 +104,21 @@ def ssd_bboxes_decode(feat_localizations,
     """Compute the relative bounding boxes from the layer features and
     reference anchor bounding boxes.
 
+    Arguments:
+      anchor_bboxes: Layer anchors (y, x, h, w), or flattened (N, 4) center
+        form anchors of the layer (c.f. `AnchorTable.layer_centers`).
     Return:
       numpy array Nx4: ymin, xmin, ymax, xmax
     """
-    # Reshape for easier broadcasting.
     l_shape = feat_localizations.shape
+    if isinstance(anchor_bboxes, np.ndarray):
+        feat_localizations = np.reshape(feat_localizations, (-1, l_shape[-1]))
+        idxes = np.arange(feat_localizations.shape[0]) % anchor_bboxes.shape[0]
+        bboxes = ssd_bboxes_decode_selected(feat_localizations, anchor_bboxes,
+                                            idxes, prior_scaling)
+        return np.reshape(bboxes, l_shape)
+
+    # Reshape for easier broadcasting.
     feat_localizations = np.reshape(feat_localizations,
                                     (-1, l_shape[-2], l_shape[-1]))
     yref, xref, href, wref = anchor_bboxes
@@ -53,22 +141,62 @@ def ssd_bboxes_decode(feat_localizations,
     return bboxes
 
 
-def ssd_bboxes_select_layer(predictions_layer,
-                            localizations_layer,
-                            anchors_layer,
-                            select_threshold=0.5,
-                            img_shape=(300, 300),
-                            num_classes=21,
-                            decode=True):
-    """Extract classes, scores and bounding boxes from features in one layer.
+def ssd_bboxes_decode_selected(feat_localizations,
+                               anchors_layer,
+                               idxes,
+                               prior_scaling=[0.1, 0.1, 0.2, 0.2]):
+    """Compute the relative bounding boxes of a subset of the anchors of
+    a layer. Same result as `ssd_bboxes_decode` on these anchors, without
+    decoding the full layer.
 
+    Arguments:
+      feat_localizations: Nx4 localization features of the selected anchors;
+      anchors_layer: Layer anchors (y, x, h, w), or flattened (N, 4) center
+        form anchors of the layer (c.f. `AnchorTable.layer_centers`);
+      idxes: (N,) flat indexes of the selected anchors in the layer.
     Return:
-      classes, scores, bboxes: Numpy arrays...
+      numpy array Nx4: ymin, xmin, ymax, xmax
     """
-    # First decode localizations features if necessary.
-    if decode:
-        localizations_layer = ssd_bboxes_decode(localizations_layer, anchors_layer)
+    # Gather the anchors table of the selection.
+    if isinstance(anchors_layer, np.ndarray):
+        yref, xref, href, wref = np.transpose(anchors_layer[idxes])
+    else:
+        yref, xref, href, wref = anchors_layer
+        num_anchors = href.size
+        yref = np.reshape(yref, [-1])[idxes // num_anchors]
+        xref = np.reshape(xref, [-1])[idxes // num_anchors]
+        href = href[idxes % num_anchors]
+        wref = wref[idxes % num_anchors]
+
+    # Compute center, height and width
+    cx = feat_localizations[:, 0] * wref * prior_scaling[0] + xref
+    cy = feat_localizations[:, 1] * href * prior_scaling[1] + yref
+    w = wref * np.exp(feat_localizations[:, 2] * prior_scaling[2])
+    h = href * np.exp(feat_localizations[:, 3] * prior_scaling[3])
+    # bboxes: ymin, xmin, xmax, ymax.
+    bboxes = np.zeros_like(feat_localizations)
+    bboxes[:, 0] = cy - h / 2.
+    bboxes[:, 1] = cx - w / 2.
+    bboxes[:, 2] = cy + h / 2.
+    bboxes[:, 3] = cx + w / 2.
+    return bboxes
 
+
+def ssd_bboxes_select_layer_batch(predictions_layer,
+                                  localizations_layer,
+                                  anchors_layer,
+                                  select_threshold=0.5,
+                                  img_shape=(300, 300),
+                                  num_classes=21,
+                                  decode=True):
+    """Extract classes, scores and bounding boxes from features in one layer,
+    keeping track of the image in the batch each of them belongs to.
+    Anchors are first selected on their scores, and only the localizations
+    of the selected ones are decoded.
+
+    Return:
+      classes, scores, bboxes, images: Numpy arrays, sorted by image index.
+    """
     # Reshape features to: Batches x N x N_labels | 4.
     p_shape = predictions_layer.shape
     batch_size = p_shape[0] if len(p_shape) == 5 else 1
@@ -83,17 +211,50 @@ def ssd_bboxes_select_layer(predictions_layer,
         # Class prediction and scores: assign 0. to 0-class
         classes = np.argmax(predictions_layer, axis=2)
         scores = np.amax(predictions_layer, axis=2)
-        mask = (classes > 0)
-        classes = classes[mask]
-        scores = scores[mask]
-        bboxes = localizations_layer[mask]
+        idxes = np.where(classes > 0)
+        classes = classes[idxes]
+        scores = scores[idxes]
+        images = idxes[0]
+        sidxes = np.arange(classes.size)
     else:
         sub_predictions = predictions_layer[:, :, 1:]
         idxes = np.where(sub_predictions > select_threshold)
         classes = idxes[-1]+1
         scores = sub_predictions[idxes]
-        bboxes = localizations_layer[idxes[:-1]]
+        images = idxes[0]
+        # Anchors with at least one class over the threshold: idxes are
+        # sorted, hence only compare with the previous entry.
+        first = np.ones(classes.shape, dtype=np.bool_)
+        first[1:] = np.logical_or(idxes[0][1:] != idxes[0][:-1],
+                                  idxes[1][1:] != idxes[1][:-1])
+        sidxes = np.cumsum(first) - 1
+        idxes = (idxes[0][first], idxes[1][first])
 
+    # Decode localizations features of selected anchors only.
+    localizations = localizations_layer[idxes]
+    if decode:
+        localizations = ssd_bboxes_decode_selected(localizations,
+                                                   anchors_layer, idxes[1])
+    bboxes = localizations[sidxes]
+    return classes, scores, bboxes, images
+
+
+def ssd_bboxes_select_layer(predictions_layer,
+                            localizations_layer,
+                            anchors_layer,
+                            select_threshold=0.5,
+                            img_shape=(300, 300),
+                            num_classes=21,
+                            decode=True):
+    """Extract classes, scores and bounding boxes from features in one layer.
+    Results of all images in the batch are returned together.
+
+    Return:
+      classes, scores, bboxes: Numpy arrays...
+    """
+    classes, scores, bboxes, _ = ssd_bboxes_select_layer_batch(
+        predictions_layer, localizations_layer, anchors_layer,
+        select_threshold, img_shape, num_classes, decode)
     return classes, scores, bboxes
 
 
@@ -106,6 +267,8 @@ def ssd_bboxes_select(predictions_net,
                       decode=True):
     """Extract classes, scores and bounding boxes from network output layers.
 
+    Arguments:
+      anchors_net: List of layers anchors or AnchorTable.
     Return:
       classes, scores, bboxes: Numpy arrays...
     """
@@ -115,8 +278,12 @@ def ssd_bboxes_select(predictions_net,
     # l_layers = []
     # l_idxes = []
     for i in range(len(predictions_net)):
+        if isinstance(anchors_net, AnchorTable):
+            anchors_layer = anchors_net.layer_centers(i)
+        else:
+            anchors_layer = anchors_net[i]
         classes, scores, bboxes = ssd_bboxes_select_layer(
-            predictions_net[i], localizations_net[i], anchors_net[i],
+            predictions_net[i], localizations_net[i], anchors_layer,
             select_threshold, img_shape, num_classes, decode)
         l_classes.append(classes)
         l_scores.append(scores)
@@ -131,11 +298,202 @@ def ssd_bboxes_select(predictions_net,
     return classes, scores, bboxes
 
 
+def ssd_bboxes_select_batch(predictions_net,
+                            localizations_net,
+                            anchors_net,
+                            select_threshold=0.5,
+                            img_shape=(300, 300),
+                            num_classes=21,
+                            decode=True):
+    """Extract classes, scores and bounding boxes from network output layers,
+    keeping the results of every image in the batch separate.
+
+    Results are returned as ragged arrays: the detections of image i are
+    classes[offsets[i]:offsets[i+1]], and similarly for scores and bboxes.
+
+    Arguments:
+      anchors_net: List of layers anchors or AnchorTable.
+    Return:
+      classes, scores, bboxes: Flat Numpy arrays, grouped by image;
+      offsets: (batch_size+1,) array of offsets of every image.
+    """
+    p_shape = predictions_net[0].shape
+    batch_size = p_shape[0] if len(p_shape) == 5 else 1
+    l_classes = []
+    l_scores = []
+    l_bboxes = []
+    l_images = []
+    for i in range(len(predictions_net)):
+        if isinstance(anchors_net, AnchorTable):
+            anchors_layer = anchors_net.layer_centers(i)
+        else:
+            anchors_layer = anchors_net[i]
+        classes, scores, bboxes, images = ssd_bboxes_select_layer_batch(
+            predictions_net[i], localizations_net[i], anchors_layer,
+            select_threshold, img_shape, num_classes, decode)
+        l_classes.append(classes)
+        l_scores.append(scores)
+        l_bboxes.append(bboxes)
+        l_images.append(images)
+
+    # Group layers outputs by image (stable: keep the layers order).
+    images = np.concatenate(l_images, 0)
+    idxes = np.argsort(images, kind='stable')
+    classes = np.concatenate(l_classes, 0)[idxes]
+    scores = np.concatenate(l_scores, 0)[idxes]
+    bboxes = np.concatenate(l_bboxes, 0)[idxes]
+    offsets = np.zeros((batch_size+1, ), dtype=np.int64)
+    np.cumsum(np.bincount(images, minlength=batch_size), out=offsets[1:])
+    return classes, scores, bboxes, offsets
+
+
+# =========================================================================== #
+# Numpy SSD groundtruth encoding.
+# =========================================================================== #
+class SSDTargetEncoder(object):
+    """Numpy encoding of groundtruth labels and bounding boxes on the anchors
+    of an AnchorTable, following `ssd_common.tf_ssd_bboxes_encode_layer`:
+    only 0 < label <= num_classes objects are matched, and an anchor keeps
+    the first object with the best strictly positive jaccard.
+
+    Anchors centers lie on a regular grid per layer: for every object, only
+    the block of rows / columns whose anchors can intersect it is looked
+    at. Picklable, hence usable in multiprocessing data loaders.
+    """
+    def __init__(self, anchors, num_classes, prior_scaling=[0.1, 0.1, 0.2, 0.2]):
+        self.anchors = anchors
+        self.num_classes = num_classes
+        self.prior_scaling = prior_scaling
+        self.dtype = anchors.centers.dtype
+        self.corners = tuple(np.ascontiguousarray(c)
+                             for c in np.transpose(anchors.corners))
+        ymin, xmin, ymax, xmax = self.corners
+        self.volumes = (xmax - xmin) * (ymax - ymin)
+        # Grid index: rows / columns centers and anchors half sizes.
+        self.index = []
+        for i in range(len(anchors)):
+            yref, xref, href, wref = anchors.layer_grid(i)
+            self.index.append((yref[:, 0, 0], xref[0, :, 0],
+                               np.max(href, axis=(0, 1)) / 2.,
+                               np.max(wref, axis=(0, 1)) / 2.))
+
+    def layer_pairs(self, i, a, bboxes):
+        """(anchor, object) pairs of layer i, anchor type a, which can
+        intersect: blocks of rows and columns around every bbox, with one
+        more row / column on each side against rounding.
+
+        Return:
+          anchors indexes (in the table) and objects indexes, by objects.
+        """
+        ys, xs, dy, dx = self.index[i]
+        height, width, num_anchors = self.anchors.shapes[i]
+        r0 = np.maximum(np.searchsorted(ys, bboxes[:, 0] - dy[a]) - 1, 0)
+        r1 = np.minimum(np.searchsorted(ys, bboxes[:, 2] + dy[a], side='right') + 1,
+                        height)
+        c0 = np.maximum(np.searchsorted(xs, bboxes[:, 1] - dx[a]) - 1, 0)
+        c1 = np.minimum(np.searchsorted(xs, bboxes[:, 3] + dx[a], side='right') + 1,
+                        width)
+        ncols = np.maximum(c1 - c0, 0)
+        counts = np.maximum(r1 - r0, 0) * ncols
+        objects = np.repeat(np.arange(len(bboxes)), counts)
+        pos = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cols = c0[objects] + pos % ncols[objects]
+        rows = r0[objects] + pos // ncols[objects]
+        idxes = self.anchors.offsets[i] + (rows * width + cols) * num_anchors + a
+        return idxes, objects
+
+    def match(self, labels, bboxes):
+        """Match anchors with groundtruth objects.
+
+        Return:
+          (N,) scores and indexes of the matched objects (-1 if none).
+        """
+        num_anchors = self.anchors.num_anchors
+        scores = np.zeros((num_anchors, ), dtype=self.dtype)
+        idxes = np.full((num_anchors, ), -1, dtype=np.int64)
+        # Mask: no annotations + num_classes.
+        valid = np.where(np.logical_and(labels > 0, labels <= self.num_classes))[0]
+        if valid.size == 0:
+            return scores, idxes
+        pairs = [self.layer_pairs(i, a, bboxes[valid])
+                 for i in range(len(self.anchors))
+                 for a in range(self.anchors.shapes[i][-1])]
+        a_idxes = np.concatenate([p[0] for p in pairs])
+        o_idxes = valid[np.concatenate([p[1] for p in pairs])]
+
+        # Jaccard scores, as in the TF encoder.
+        ymin, xmin, ymax, xmax = [c[a_idxes] for c in self.corners]
+        bboxes = bboxes[o_idxes]
+        h = np.maximum(np.minimum(ymax, bboxes[:, 2]) - np.maximum(ymin, bboxes[:, 0]), 0.)
+        w = np.maximum(np.minimum(xmax, bboxes[:, 3]) - np.maximum(xmin, bboxes[:, 1]), 0.)
+        inter_vol = h * w
+        union_vol = self.volumes[a_idxes] - inter_vol \
+            + (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+        jaccard = inter_vol / union_vol
+        mask = jaccard > 0.
+        a_idxes = a_idxes[mask]
+        o_idxes = o_idxes[mask]
+        jaccard = jaccard[mask]
+
+        # Best object per anchor, the first one on ties.
+        np.maximum.at(scores, a_idxes, jaccard)
+        mask = jaccard == scores[a_idxes]
+        idxes[:] = len(labels)
+        np.minimum.at(idxes, a_idxes[mask], o_idxes[mask])
+        idxes[idxes == len(labels)] = -1
+        return scores, idxes
+
+    def encode(self, labels, bboxes, flat=True):
+        """Encode groundtruth labels and bounding boxes.
+
+        Arguments:
+          labels: (K,) groundtruth labels;
+          bboxes: (K, 4) bboxes relative coordinates.
+        Return:
+          (target_labels, target_localizations, target_scores): flat (N,),
+            (N, 4) and (N,) arrays, or lists of per-layer arrays if not `flat`.
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        bboxes = np.asarray(bboxes, dtype=self.dtype).reshape(-1, 4)
+        scores, idxes = self.match(labels, bboxes)
+        # Unmatched anchors: background label, bbox (0, 0, 1, 1).
+        mask = idxes >= 0
+        feat_labels = np.zeros(idxes.shape, dtype=np.int64)
+        feat_labels[mask] = labels[idxes[mask]]
+        feat_bboxes = np.empty(idxes.shape + (4, ), dtype=self.dtype)
+        feat_bboxes[:] = np.array([0., 0., 1., 1.], dtype=self.dtype)
+        feat_bboxes[mask] = bboxes[idxes[mask]]
+
+        # Encode features, SSD ordering: x / y / w / h.
+        yref, xref, href, wref = np.transpose(self.anchors.centers)
+        feat_ymin, feat_xmin, feat_ymax, feat_xmax = np.transpose(feat_bboxes)
+        feat_localizations = np.stack([
+            ((feat_xmax + feat_xmin) / 2. - xref) / wref / self.prior_scaling[1],
+            ((feat_ymax + feat_ymin) / 2. - yref) / href / self.prior_scaling[0],
+            np.log((feat_xmax - feat_xmin) / wref) / self.prior_scaling[3],
+            np.log((feat_ymax - feat_ymin) / href) / self.prior_scaling[2]],
+            axis=-1).astype(self.dtype, copy=False)
+        if flat:
+            return feat_labels, feat_localizations, scores
+        return self.split(feat_labels, feat_localizations, scores)
+
+    def split(self, *arrays):
+        """Split flat anchors arrays into per-layer (H, W, A, ...) arrays.
+        """
+        l_splits = []
+        for a in arrays:
+            l_splits.append([a[self.anchors.layer_slice(i)].reshape(
+                tuple(self.anchors.shapes[i]) + a.shape[1:])
+                for i in range(len(self.anchors))])
+        return l_splits
+
+
 # =========================================================================== #
 # Common functions for bboxes handling and selection.
 # =========================================================================== #
 def bboxes_sort(classes, scores, bboxes, top_k=400):
-    """Sort bounding boxes by decreasing order and keep only the top_k
+    """Sort bounding boxes by decreasing order and keep only the top_k.
+    Partial selection of the top_k first, then sorting of the latter only.
     """
     # if priority_inside:
     #     inside = (bboxes[:, 0] > margin) & (bboxes[:, 1] > margin) & \
@@ -143,13 +501,66 @@ def bboxes_sort(classes, scores, bboxes, top_k=400):
     #     idxes = np.argsort(-scores)
     #     inside = inside[idxes]
     #     idxes = np.concatenate([idxes[inside], idxes[~inside]])
-    idxes = np.argsort(-scores)
-    classes = classes[idxes][:top_k]
-    scores = scores[idxes][:top_k]
-    bboxes = bboxes[idxes][:top_k]
+    if scores.size > top_k:
+        idxes = np.argpartition(-scores, top_k)[:top_k]
+        idxes = idxes[np.argsort(-scores[idxes])]
+    else:
+        idxes = np.argsort(-scores)
+    return classes[idxes], scores[idxes], bboxes[idxes]
+
+
+def bboxes_sort_batch(classes, scores, bboxes, top_k=400):
+    """Sort bounding boxes by decreasing order and keep only the top_k.
+    Batched version of `bboxes_sort`, on zero-padded inputs.
+
+    Args:
+      classes: B x N array of classes;
+      scores: B x N array of scores, padded with zeros;
+      bboxes: B x N x 4 array of boxes coordinates.
+    Return:
+      classes, scores, bboxes: Sorted arrays of shape B x min(N, top_k) (x 4).
+    """
+    if scores.shape[1] > top_k:
+        idxes = np.argpartition(-scores, top_k, axis=1)[:, :top_k]
+        sub_scores = np.take_along_axis(scores, idxes, axis=1)
+        idxes = np.take_along_axis(idxes, np.argsort(-sub_scores, axis=1), axis=1)
+    else:
+        idxes = np.argsort(-scores, axis=1)
+    classes = np.take_along_axis(classes, idxes, axis=1)
+    scores = np.take_along_axis(scores, idxes, axis=1)
+    bboxes = np.take_along_axis(bboxes, idxes[:, :, np.newaxis], axis=1)
     return classes, scores, bboxes
 
 
+def bboxes_pad_batch(offsets, classes, scores, bboxes, top_k=None):
+    """Convert ragged batch outputs (c.f. `ssd_bboxes_select_batch`) into
+    zero padded arrays, e.g. for `bboxes_sort_batch`. The first top_k
+    bboxes of every image are kept.
+
+    Args:
+      top_k: Padded size. Largest number of bboxes of an image if None.
+    Return:
+      classes, scores: (batch_size, top_k) arrays, 0 class for padding;
+      bboxes: (batch_size, top_k, 4) array.
+    """
+    counts = np.diff(offsets)
+    if top_k is None:
+        top_k = np.amax(counts) if counts.size else 0
+    images = np.repeat(np.arange(counts.size), counts)
+    positions = np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+    mask = positions < top_k
+    idxes = (images[mask], positions[mask])
+
+    shape = (counts.size, top_k)
+    p_classes = np.zeros(shape, dtype=classes.dtype)
+    p_scores = np.zeros(shape, dtype=scores.dtype)
+    p_bboxes = np.zeros(shape + (4, ), dtype=bboxes.dtype)
+    p_classes[idxes] = classes[offsets[0]:offsets[-1]][mask]
+    p_scores[idxes] = scores[offsets[0]:offsets[-1]][mask]
+    p_bboxes[idxes] = bboxes[offsets[0]:offsets[-1]][mask]
+    return p_classes, p_scores, p_bboxes
+
+
 def bboxes_clip(bbox_ref, bboxes):
     """Clip bounding boxes with respect to reference bbox.
     """
@@ -183,6 +594,48 @@ def bboxes_resize(bbox_ref, bboxes):
     return bboxes
 
 
+def bboxes_visdrone_rows(classes, scores, bboxes, img_shape, bbox_ref=None):
+    """Finalize relative bounding boxes into VisDrone result rows, in a
+    single pass: clip and resize with respect to a reference bbox (c.f.
+    `bboxes_clip` and `bboxes_resize`) and scale to pixels.
+
+    Args:
+      img_shape: (height, width) of the original image;
+      bbox_ref: Reference bbox, [0, 0, 1, 1] if None.
+    Return:
+      Nx8 float32 array: bbox_left, bbox_top, bbox_width, bbox_height, score,
+        object_category, truncation (-1), occlusion (-1). All columns but
+        the score hold integer values.
+    """
+    if bbox_ref is None:
+        bbox_ref = [0., 0., 1., 1.]
+    ymin, xmin, ymax, xmax = bbox_ref
+    height, width = img_shape[:2]
+    pixels = np.clip(bboxes, [ymin, xmin, -np.inf, -np.inf],
+                     [np.inf, np.inf, ymax, xmax])
+    pixels -= [ymin, xmin, ymin, xmin]
+    pixels *= [height / (ymax - ymin), width / (xmax - xmin),
+               height / (ymax - ymin), width / (xmax - xmin)]
+    np.floor(pixels, out=pixels)
+
+    rows = np.empty((scores.size, 8), dtype=np.float32)
+    rows[:, 0] = pixels[:, 1]
+    rows[:, 1] = pixels[:, 0]
+    np.subtract(pixels[:, 3], pixels[:, 1], out=rows[:, 2])
+    np.subtract(pixels[:, 2], pixels[:, 0], out=rows[:, 3])
+    rows[:, 4] = scores
+    rows[:, 5] = classes
+    rows[:, 6:] = -1
+    return rows
+
+
+def bboxes_write_visdrone(fname, rows):
+    """Write VisDrone result rows (c.f. `bboxes_visdrone_rows`) to a text
+    file (or file object), in a single bulk call.
+    """
+    np.savetxt(fname, rows, fmt='%d,%d,%d,%d,%.6f,%d,%d,%d')
+
+
 def bboxes_jaccard(bboxes1, bboxes2):
     """Computing jaccard index between bboxes1 and bboxes2.
     Note: bboxes1 and bboxes2 can be multi-dimensional, but should broacastable.
@@ -229,7 +682,7 @@ def bboxes_intersection(bboxes_ref, bboxes2):
 def bboxes_nms(classes, scores, bboxes, nms_threshold=0.45):
     """Apply non-maximum selection to bounding boxes.
     """
-    keep_bboxes = np.ones(scores.shape, dtype=np.bool)
+    keep_bboxes = np.ones(scores.shape, dtype=bool)
     for i in range(scores.size-1):
         if keep_bboxes[i]:
             # Computer overlap with bboxes which are following.
@@ -242,11 +695,408 @@ def bboxes_nms(classes, scores, bboxes, nms_threshold=0.45):
     return classes[idxes], scores[idxes], bboxes[idxes]
 
 
-def bboxes_nms_fast(classes, scores, bboxes, threshold=0.45):
-    """Apply non-maximum selection to bounding boxes.
+def bboxes_nms_fast(classes, scores, bboxes, nms_threshold=0.45, block_size=256):
+    """Apply non-maximum selection to bounding boxes. Vectorized version
+    of `bboxes_nms`, returning exactly the same selection.
+
+    Classes being independent, the boxes of every class are selected
+    separately. They are processed by blocks growing up to `block_size`: a
+    block is first suppressed by the boxes kept in the previous blocks,
+    using a single IoU matrix, and the greedy selection between its
+    remaining boxes is then a single sequential pass over their suppression
+    matrix, each kept box removing its row at once (O(block^2)). With a
+    positive threshold, only the previous boxes intersecting the extent of
+    a block are compared with it, e.g. along chains of boxes. The IoU computation
+    is `bboxes_jaccard`, hence the same as `bboxes_nms`.
+    """
+    keep_bboxes = np.zeros(scores.shape, dtype=np.bool_)
+    for c in np.unique(classes):
+        c_idxes = np.where(classes == c)[0]
+        c_bboxes = bboxes[c_idxes]
+        c_keep = np.ones(c_idxes.shape, dtype=np.bool_)
+        # Empty bboxes can have NaN IoUs without intersecting: always compared.
+        c_empty = np.logical_or(c_bboxes[:, 2] <= c_bboxes[:, 0],
+                                c_bboxes[:, 3] <= c_bboxes[:, 1])
+        # Growing blocks: the first boxes often suppress most of the others.
+        start = 0
+        size = min(16, block_size)
+        while start < c_idxes.size:
+            end = min(start + size, c_idxes.size)
+            size = min(2 * size, block_size)
+            b_bboxes = c_bboxes[start:end]
+            # Suppression by the bboxes kept in the previous blocks.
+            kept = c_keep[:start]
+            if nms_threshold > 0 and not np.any(c_empty[start:end]):
+                kept = np.logical_and(kept, np.logical_or(c_empty[:start], np.logical_and(
+                    np.all(c_bboxes[:start, :2] < np.amax(b_bboxes[:, 2:], axis=0), axis=1),
+                    np.all(c_bboxes[:start, 2:] > np.amin(b_bboxes[:, :2], axis=0), axis=1))))
+            idxes = np.where(kept)[0]
+            if idxes.size > 0:
+                overlap = bboxes_jaccard(c_bboxes[idxes][np.newaxis], b_bboxes)
+                c_keep[start:end] = np.all(overlap < nms_threshold, axis=0)
+            # Greedy selection between the remaining bboxes of the block:
+            # suppress[j, i] when the bbox j (j < i) would remove the bbox i.
+            idxes = start + np.where(c_keep[start:end])[0]
+            r_bboxes = c_bboxes[idxes]
+            overlap = bboxes_jaccard(r_bboxes[np.newaxis], r_bboxes)
+            suppress = np.triu(~(overlap < nms_threshold), k=1)
+            keep = np.ones(idxes.shape, dtype=np.bool_)
+            for i in range(idxes.size):
+                if keep[i]:
+                    keep &= ~suppress[i]
+            c_keep[idxes] = keep
+            start = end
+        keep_bboxes[c_idxes] = c_keep
+
+    idxes = np.where(keep_bboxes)
+    return classes[idxes], scores[idxes], bboxes[idxes]
+
+
+def bboxes_overlap_pairs(classes, bboxes, threshold=0.5, scale_percentile=99.):
+    """Find the pairs of bounding boxes of same class whose jaccard index is
+    higher than a threshold, without computing the dense NxN jaccard matrix.
+
+    Boxes are bucketed by center into a uniform grid whose cell size is given
+    by the box scales: two boxes smaller than the cell can only intersect if
+    they lie in neighbouring cells. The few boxes larger than the cell are
+    compared with all the boxes in their vertical range.
+
+    Args:
+      threshold: Jaccard threshold, strictly positive. Pairs with
+        overlap >= threshold are kept;
+      scale_percentile: Percentile of box sizes used as cell size.
+    Return:
+      idx_i, idx_j, overlap: Numpy arrays of pairs, with idx_i < idx_j.
     """
-    pass
+    if threshold <= 0:
+        # Non-intersecting pairs would match as well: not a sparse problem.
+        raise ValueError('Overlap pairs threshold must be positive: %s' % threshold)
+    n = bboxes.shape[0]
+    extent = np.maximum(bboxes[:, 2] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 1])
+    if n == 0:
+        return (np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64),
+                np.zeros((0,), dtype=bboxes.dtype))
+    cell_size = max(np.percentile(extent, scale_percentile), 1e-6)
+    large = extent > cell_size
+    small = np.where(~large)[0]
+    large = np.where(large)[0]
 
+    l_i = []
+    l_j = []
+    # Small boxes: grid of centers, with a border of empty cells.
+    if small.size > 0:
+        cy = (bboxes[small, 0] + bboxes[small, 2]) / 2.
+        cx = (bboxes[small, 1] + bboxes[small, 3]) / 2.
+        gy = np.floor((cy - np.amin(cy)) / cell_size).astype(np.int64)
+        gx = np.floor((cx - np.amin(cx)) / cell_size).astype(np.int64)
+        num_cols = np.amax(gx) + 3
+        keys = (gy + 1) * num_cols + (gx + 1)
+        order = np.argsort(keys, kind='stable')
+        skeys = keys[order]
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                # Range of boxes in the neighbouring cell, in sorted order.
+                nkeys = keys + dy * num_cols + dx
+                lo = np.searchsorted(skeys, nkeys, side='left')
+                hi = np.searchsorted(skeys, nkeys, side='right')
+                counts = hi - lo
+                idx_i = np.repeat(np.arange(small.size), counts)
+                idx_j = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                idx_j = order[idx_j + np.arange(idx_j.size)]
+                mask = idx_i < idx_j
+                l_i.append(small[idx_i[mask]])
+                l_j.append(small[idx_j[mask]])
+    # Large boxes: compared with all the boxes in their vertical range.
+    if large.size > 0:
+        cy = (bboxes[:, 0] + bboxes[:, 2]) / 2.
+        order = np.argsort(cy, kind='stable')
+        scy = cy[order]
+        radius = (extent[large] + np.amax(extent)) / 2.
+        lo = np.searchsorted(scy, cy[large] - radius, side='left')
+        hi = np.searchsorted(scy, cy[large] + radius, side='right')
+        counts = hi - lo
+        idx_k = np.repeat(large, counts)
+        idx_m = np.repeat(lo - np.cumsum(counts) + counts, counts)
+        idx_m = order[idx_m + np.arange(idx_m.size)]
+        # Pairs of large boxes appear twice: only keep one.
+        mask = np.logical_and(idx_k != idx_m,
+                              np.logical_or(extent[idx_m] <= cell_size, idx_k < idx_m))
+        idx_k = idx_k[mask]
+        idx_m = idx_m[mask]
+        l_i.append(np.minimum(idx_k, idx_m))
+        l_j.append(np.maximum(idx_k, idx_m))
+
+    idx_i = np.concatenate(l_i)
+    idx_j = np.concatenate(l_j)
+    mask = classes[idx_i] == classes[idx_j]
+    idx_i = idx_i[mask]
+    idx_j = idx_j[mask]
+    overlap = bboxes_jaccard(bboxes[idx_i], bboxes[idx_j])
+    mask = ~(overlap < threshold)
+    return idx_i[mask], idx_j[mask], overlap[mask]
+
+
+def bboxes_nms_grid(classes, scores, bboxes, nms_threshold=0.45,
+                    scale_percentile=99.):
+    """Apply non-maximum selection to bounding boxes, comparing only boxes
+    in neighbouring cells of a spatial hash grid (c.f. `bboxes_overlap_pairs`).
+    Same selection as `bboxes_nms`, but scales linearly with the number of
+    boxes in dense scenes of small objects. Falls back to `bboxes_nms_fast`
+    if `nms_threshold <= 0`, non-intersecting bboxes suppressing each other.
+    """
+    if nms_threshold <= 0:
+        return bboxes_nms_fast(classes, scores, bboxes, nms_threshold)
+    idx_i, idx_j, _ = bboxes_overlap_pairs(classes, bboxes, nms_threshold,
+                                           scale_percentile)
+    keep_bboxes = bboxes_nms_pairs(scores.size, idx_i, idx_j)
+    idxes = np.where(keep_bboxes)
+    return classes[idxes], scores[idxes], bboxes[idxes]
+
+
+def bboxes_nms_pairs(num_bboxes, idx_i, idx_j):
+    """Greedy non-maximum selection from a sparse list of overlapping pairs
+    (idx_i < idx_j, i.e. bbox i scored higher than bbox j).
+
+    Solved as a fixed-point: a box is kept iff no kept box with higher
+    score overlaps it. Every iteration is O(P) over the P pairs; the number
+    of iterations grows with the length of the suppression chains.
+
+    Return:
+      Boolean Numpy array of kept bboxes.
+    """
+    keep_bboxes = np.ones((num_bboxes, ), dtype=np.bool_)
+    while True:
+        suppressed = np.zeros((num_bboxes, ), dtype=np.bool_)
+        suppressed[idx_j[keep_bboxes[idx_i]]] = True
+        if np.array_equal(~suppressed, keep_bboxes):
+            return keep_bboxes
+        keep_bboxes = ~suppressed
+
+
+def bboxes_matrix_nms(classes, scores, bboxes,
+                      kernel='gaussian', sigma=2.0, score_threshold=0.05):
+    """Apply Matrix NMS to bounding boxes: every score is decayed in
+    parallel from a single IoU matrix, without any sequential dependency.
+    Inputs are supposed to be sorted by decreasing score (c.f. `bboxes_sort`).
+
+    Batch-compatible: inputs can be single entries (N, N x 4) or batches
+    (B x N, B x N x 4), zero-class entries being considered as padding.
+
+    Args:
+      kernel: Decay function, 'gaussian' or 'linear';
+      sigma: Gaussian kernel parameter, exp(-sigma * iou^2) as in SOLOv2
+        (inverse of the Soft-NMS one);
+      score_threshold: Minimum decayed score to keep a box.
+    Return:
+      classes, scores, bboxes: Single entries: kept boxes, sorted by
+        decreasing decayed score. Batches: same shapes as the inputs,
+        sorted per entry and zero-padded.
+    """
+    # No bboxes: nothing to decay (and empty reductions below).
+    if scores.shape[-1] == 0:
+        return classes, scores, bboxes
+    batched = scores.ndim == 2
+    if not batched:
+        classes = classes[np.newaxis]
+        scores = scores[np.newaxis]
+        bboxes = bboxes[np.newaxis]
+    # IoU matrix: overlap[b, i, j] between bboxes i and j of entry b.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlap = bboxes_jaccard(bboxes[:, np.newaxis], bboxes[:, :, np.newaxis])
+        overlap = np.transpose(overlap)
+    overlap = np.nan_to_num(overlap)
+    # Only keep pairs of same class, with i scored higher than j.
+    mask = np.logical_and(classes[:, :, np.newaxis] == classes[:, np.newaxis],
+                          classes[:, :, np.newaxis] > 0)
+    decay_iou = np.triu(overlap * mask, k=1)
+    # Max IoU of every bbox with a higher scored one.
+    compensate_iou = np.amax(decay_iou, axis=1)[:, :, np.newaxis]
+    if kernel == 'gaussian':
+        decay = np.exp(-sigma * (decay_iou**2 - compensate_iou**2))
+    elif kernel == 'linear':
+        decay = (1. - decay_iou) / np.maximum(1. - compensate_iou, 1e-12)
+    else:
+        raise ValueError('Unknown Matrix NMS kernel %s' % kernel)
+    decay = np.amin(decay, axis=1)
+    scores = (scores * decay).astype(scores.dtype)
+
+    # Remove low scores and sort again by decreasing order.
+    keep = np.logical_and(scores >= score_threshold, classes > 0)
+    scores = np.where(keep, scores, 0.)
+    idxes = np.argsort(-scores, axis=1, kind='stable')
+    scores = np.take_along_axis(scores, idxes, axis=1)
+    classes = np.take_along_axis(np.where(keep, classes, 0), idxes, axis=1)
+    bboxes = np.take_along_axis(bboxes, idxes[:, :, np.newaxis], axis=1)
+    if batched:
+        return classes, scores, bboxes
+    n = np.count_nonzero(keep)
+    return classes[0, :n], scores[0, :n], bboxes[0, :n]
+
+
+def bboxes_soft_nms(classes, scores, bboxes, nms_threshold=0.45,
+                    kernel='gaussian', sigma=0.5, score_threshold=0.001):
+    """Apply Soft-NMS to bounding boxes: instead of being removed, boxes
+    overlapping a selected one see their score decayed. Every step decays
+    all the remaining boxes at once, and the loop stops as soon as the
+    remaining max score is below `score_threshold`.
+
+    Args:
+      nms_threshold: Linear kernel only, IoU threshold of decay;
+      kernel: Decay function, 'gaussian' or 'linear';
+      sigma: Gaussian kernel parameter;
+      score_threshold: Minimum decayed score to keep a box.
+    Return:
+      classes, scores, bboxes: Kept boxes, with decayed scores, sorted by
+        decreasing score.
+    """
+    if kernel not in ('gaussian', 'linear'):
+        raise ValueError('Unknown Soft-NMS kernel %s' % kernel)
+    scores = np.array(scores, copy=True)
+    remaining = np.where(scores >= score_threshold)[0]
+    keep_idxes = []
+    while remaining.size > 0:
+        # Select the highest remaining score.
+        j = np.argmax(scores[remaining])
+        idx = remaining[j]
+        keep_idxes.append(idx)
+        remaining = np.delete(remaining, j)
+        # Decay scores of the same class overlapping boxes.
+        overlap = bboxes_jaccard(bboxes[idx], bboxes[remaining])
+        overlap *= classes[remaining] == classes[idx]
+        if kernel == 'gaussian':
+            decay = np.exp(-overlap**2 / sigma)
+        else:
+            decay = np.where(overlap > nms_threshold, 1. - overlap, 1.)
+        scores[remaining] *= decay
+        remaining = remaining[scores[remaining] >= score_threshold]
+
+    idxes = np.array(keep_idxes, dtype=np.int64)
+    return classes[idxes], scores[idxes], bboxes[idxes]
+
+
+def bboxes_nms_method(classes, scores, bboxes, method='greedy',
+                      nms_threshold=0.45, **kwargs):
+    """Apply a non-maximum selection method to bounding boxes.
+
+    Args:
+      method: 'greedy' (c.f. `bboxes_nms_fast`), 'grid' (c.f. `bboxes_nms_grid`),
+        'soft' (c.f. `bboxes_soft_nms`) or 'matrix' (c.f. `bboxes_matrix_nms`,
+        which ignores `nms_threshold`).
+    Return:
+      classes, scores, bboxes: Numpy arrays...
+    """
+    if method == 'greedy':
+        return bboxes_nms_fast(classes, scores, bboxes,
+                               nms_threshold=nms_threshold, **kwargs)
+    elif method == 'grid':
+        return bboxes_nms_grid(classes, scores, bboxes,
+                               nms_threshold=nms_threshold, **kwargs)
+    elif method == 'soft':
+        return bboxes_soft_nms(classes, scores, bboxes,
+                               nms_threshold=nms_threshold, **kwargs)
+    elif method == 'matrix':
+        return bboxes_matrix_nms(classes, scores, bboxes, **kwargs)
+    raise ValueError('Unknown NMS method %s' % method)
+
+
+# =========================================================================== #
+# Merging of detections from overlapping image tiles.
+# =========================================================================== #
+def bboxes_weighted_fusion(classes, scores, bboxes, iou_threshold=0.55,
+                           coverage=None, scale_percentile=99.):
+    """Weighted box fusion: merge clusters of overlapping boxes of the same
+    class into a single box, average of the cluster weighted by the scores.
+
+    Clusters are seeded by a greedy NMS, every suppressed box joining the
+    cluster of the highest scored seed overlapping it. Overlaps are found with
+    the spatial hash grid of `bboxes_overlap_pairs`, in O(N log N). The seeds
+    are then given by the fixed point of `bboxes_nms_pairs`, in O(P) per
+    iteration over the P overlapping pairs: the number of iterations grows
+    with the length of the suppression chains (a few in practice, N at worst).
+
+    Args:
+      coverage: Optional (N,) array: number of sources (tiles, models...)
+        which could have detected every box. The fused score is then
+        the mean score of the cluster, scaled by min(size, coverage) / coverage.
+        Default: mean score of the cluster.
+    Return:
+      classes, scores, bboxes: Fused boxes, sorted by decreasing score.
+    """
+    idxes = np.argsort(-scores, kind='stable')
+    classes = classes[idxes]
+    scores = scores[idxes]
+    bboxes = bboxes[idxes]
+    num_bboxes = scores.size
+    idx_i, idx_j, _ = bboxes_overlap_pairs(classes, bboxes, iou_threshold,
+                                           scale_percentile)
+    seeds = bboxes_nms_pairs(num_bboxes, idx_i, idx_j)
+
+    # Cluster of every box: index of the highest scored seed overlapping it.
+    clusters = np.where(seeds, np.arange(num_bboxes), num_bboxes)
+    mask = np.logical_and(seeds[idx_i], ~seeds[idx_j])
+    np.minimum.at(clusters, idx_j[mask], idx_i[mask])
+
+    # Weighted average of every cluster.
+    sizes = np.bincount(clusters, minlength=num_bboxes)
+    weights = np.bincount(clusters, scores, minlength=num_bboxes)
+    fbboxes = np.stack([np.bincount(clusters, scores * bboxes[:, i],
+                                    minlength=num_bboxes)
+                        for i in range(4)], axis=-1)
+    idxes = np.where(seeds)[0]
+    fbboxes = (fbboxes[idxes] / weights[idxes, np.newaxis]).astype(bboxes.dtype)
+    fscores = weights[idxes] / sizes[idxes]
+    if coverage is not None:
+        coverage = coverage[idxes]
+        fscores = fscores * np.minimum(sizes[idxes], coverage) / coverage
+    fscores = fscores.astype(scores.dtype)
+
+    idxes2 = np.argsort(-fscores, kind='stable')
+    return classes[idxes][idxes2], fscores[idxes2], fbboxes[idxes2]
+
+
+def bboxes_merge_tiles(tiles, tile_shape, img_shape, iou_threshold=0.55,
+                       scale_percentile=99.):
+    """Merge detections from overlapping tiles of a large image into
+    deduplicated full-frame detections, using weighted box fusion.
+
+    Arguments:
+      tiles: List of (classes, scores, bboxes, offset) tuples, with bboxes
+        relative to the tile, and offset the (y, x) pixel position of the
+        tile in the image. Note: crop files are named `<image>_<x>_<y>.jpg`;
+      tile_shape: (height, width) of the tiles, in pixels;
+      img_shape: (height, width) of the full image, in pixels.
+    Return:
+      classes, scores, bboxes: Numpy arrays, bboxes relative to the image.
+    """
+    tile_shape = np.asarray(tile_shape, dtype=np.float64)
+    img_shape = np.asarray(img_shape, dtype=np.float64)
+    if len(tiles) == 0:
+        return (np.zeros((0, ), dtype=np.int64), np.zeros((0, ), dtype=np.float32),
+                np.zeros((0, 4), dtype=np.float32))
+    classes = np.concatenate([t[0] for t in tiles], axis=0)
+    scores = np.concatenate([t[1] for t in tiles], axis=0)
+    bboxes = np.concatenate([t[2] for t in tiles], axis=0)
+    offsets = np.asarray([t[3] for t in tiles], dtype=np.float64)
+    counts = [len(t[1]) for t in tiles]
 
+    # Tile coordinates to image coordinates: one vectorized transform.
+    scale = np.tile(tile_shape / img_shape, 2)
+    shift = np.repeat(np.tile(offsets / img_shape, 2), counts, axis=0)
+    bboxes = (bboxes * scale + shift).astype(bboxes.dtype)
 
+    # Coverage: number of tiles containing every box without truncating it,
+    # i.e. without touching a tile border which is not an image border (one
+    # pixel tolerance). Boxes truncated by a tile are not penalized when
+    # this tile misses them.
+    extents = np.concatenate([offsets, offsets + tile_shape], axis=1) / np.tile(img_shape, 2)
+    eps = np.tile(1. / img_shape, 2) * [1., 1., -1., -1.]
+    borders = np.concatenate([extents[:, :2] <= 0., extents[:, 2:] >= 1.], axis=1)
+    inner = extents + np.where(borders, 0., eps)
+    inside = np.logical_and(
+        np.all(bboxes[:, np.newaxis, :2] >= inner[:, :2], axis=-1),
+        np.all(bboxes[:, np.newaxis, 2:] <= inner[:, 2:], axis=-1))
+    coverage = np.maximum(np.sum(inside, axis=1), 1)
 
+    return bboxes_weighted_fusion(classes, scores, bboxes, iou_threshold,
+                                  coverage=coverage,
+                                  scale_percentile=scale_percentile)
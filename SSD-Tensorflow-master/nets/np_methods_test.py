@@ -0,0 +1,171 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for nets.np_methods.
+"""
+import unittest
+
+import numpy as np
+
+from nets import np_methods
+
+
+def random_bboxes(rng, num_bboxes, num_classes):
+    """Random score-sorted classes, scores and bboxes.
+    """
+    centers = rng.rand(num_bboxes, 2)
+    sizes = 0.02 + 0.2 * rng.rand(num_bboxes, 2)
+    bboxes = np.concatenate([centers - sizes / 2., centers + sizes / 2.], axis=1)
+    scores = np.sort(rng.rand(num_bboxes))[::-1]
+    classes = rng.randint(1, num_classes + 1, size=num_bboxes)
+    return classes, scores, bboxes
+
+
+class BboxesNmsFastTest(unittest.TestCase):
+
+    def assertSameSelection(self, r1, r2):
+        for a1, a2 in zip(r1, r2):
+            np.testing.assert_array_equal(a1, a2)
+
+    def testRandomBboxes(self):
+        rng = np.random.RandomState(0)
+        for num_classes in [1, 3, 10]:
+            classes, scores, bboxes = random_bboxes(rng, 300, num_classes)
+            for nms_threshold in [0.1, 0.3, 0.45, 0.7]:
+                ref = np_methods.bboxes_nms(classes, scores, bboxes, nms_threshold)
+                # Blocks smaller and larger than the number of bboxes.
+                for block_size in [7, 64, 1000]:
+                    r = np_methods.bboxes_nms_fast(classes, scores, bboxes,
+                                                   nms_threshold, block_size)
+                    self.assertSameSelection(ref, r)
+
+    def testSuppressionChain(self):
+        # A suppresses B, B would suppress C: A and C are kept.
+        classes = np.array([1, 1, 1])
+        scores = np.array([0.9, 0.8, 0.7])
+        bboxes = np.array([[0., 0., 1., 1.],
+                           [0., 0.5, 1., 1.5],
+                           [0., 1., 1., 2.]])
+        ref = np_methods.bboxes_nms(classes, scores, bboxes, nms_threshold=0.3)
+        np.testing.assert_array_equal(ref[1], [0.9, 0.7])
+        for block_size in [1, 2, 3, 256]:
+            r = np_methods.bboxes_nms_fast(classes, scores, bboxes,
+                                           nms_threshold=0.3, block_size=block_size)
+            self.assertSameSelection(ref, r)
+
+    def testLongChain(self):
+        # Every bbox overlaps the next one: every other bbox is kept.
+        x = np.arange(600, dtype=np.float32) * 0.5
+        bboxes = np.stack([np.zeros_like(x), x, np.ones_like(x), x + 1.], axis=1)
+        classes = np.ones((600, ), dtype=np.int64)
+        scores = np.linspace(1., 0., 600)
+        ref = np_methods.bboxes_nms(classes, scores, bboxes, nms_threshold=0.3)
+        self.assertEqual(ref[0].size, 300)
+        for block_size in [7, 256]:
+            r = np_methods.bboxes_nms_fast(classes, scores, bboxes,
+                                           nms_threshold=0.3, block_size=block_size)
+            self.assertSameSelection(ref, r)
+
+    def testEmptyBboxes(self):
+        # Zero-area bboxes: NaN IoUs, suppressing as in bboxes_nms.
+        rng = np.random.RandomState(3)
+        bboxes = np.round(8. * rng.rand(200, 4)) / 8.
+        bboxes[:, 2:] = np.maximum(bboxes[:, 2:], bboxes[:, :2])
+        classes = rng.randint(1, 3, size=200)
+        scores = np.sort(rng.rand(200))[::-1]
+        with np.errstate(invalid='ignore'):
+            ref = np_methods.bboxes_nms(classes, scores, bboxes)
+            r = np_methods.bboxes_nms_fast(classes, scores, bboxes, block_size=16)
+        self.assertSameSelection(ref, r)
+
+
+class BboxesNmsGridTest(unittest.TestCase):
+
+    def testRandomBboxes(self):
+        rng = np.random.RandomState(1)
+        classes, scores, bboxes = random_bboxes(rng, 300, 3)
+        # Non-positive thresholds: non-intersecting bboxes suppressed too.
+        for nms_threshold in [-0.1, 0., 0.3, 0.45]:
+            ref = np_methods.bboxes_nms(classes, scores, bboxes, nms_threshold)
+            r = np_methods.bboxes_nms_grid(classes, scores, bboxes, nms_threshold)
+            for a1, a2 in zip(ref, r):
+                np.testing.assert_array_equal(a1, a2)
+
+    def testOverlapPairsThreshold(self):
+        classes, _, bboxes = random_bboxes(np.random.RandomState(2), 10, 1)
+        with self.assertRaises(ValueError):
+            np_methods.bboxes_overlap_pairs(classes, bboxes, threshold=0.)
+
+
+class BboxesMatrixNmsTest(unittest.TestCase):
+
+    def testEmpty(self):
+        classes = np.zeros((0, ), dtype=np.int64)
+        scores = np.zeros((0, ), dtype=np.float32)
+        bboxes = np.zeros((0, 4), dtype=np.float32)
+        for kernel in ['gaussian', 'linear']:
+            r = np_methods.bboxes_matrix_nms(classes, scores, bboxes, kernel=kernel)
+            self.assertEqual([a.shape for a in r], [(0, ), (0, ), (0, 4)])
+            # Batches of empty entries.
+            r = np_methods.bboxes_matrix_nms(classes[np.newaxis], scores[np.newaxis],
+                                             bboxes[np.newaxis], kernel=kernel)
+            self.assertEqual([a.shape for a in r], [(1, 0), (1, 0), (1, 0, 4)])
+
+    def testKnownDecay(self):
+        # IoU(A, B) = 1/3, C of another class: only B is decayed.
+        classes = np.array([1, 1, 2])
+        scores = np.array([0.9, 0.8, 0.7], dtype=np.float32)
+        bboxes = np.array([[0., 0., 1., 1.],
+                           [0., 0.5, 1., 1.5],
+                           [0., 0.25, 1., 1.25]], dtype=np.float32)
+        r = np_methods.bboxes_matrix_nms(classes, scores, bboxes,
+                                         kernel='gaussian', sigma=2.)
+        np.testing.assert_allclose(r[1], [0.9, 0.7, 0.8 * np.exp(-2. / 9.)], rtol=1e-6)
+        np.testing.assert_array_equal(r[0], [1, 2, 1])
+        r = np_methods.bboxes_matrix_nms(classes, scores, bboxes, kernel='linear')
+        np.testing.assert_allclose(r[1], [0.9, 0.7, 0.8 * 2. / 3.], rtol=1e-6)
+
+
+class BboxesMergeTilesTest(unittest.TestCase):
+
+    def merge(self, tiles):
+        # Two 512x512 tiles of a 512x896 image, overlapping on x in [384, 512].
+        tiles = [(np.array([1] * len(b)), np.array(s, dtype=np.float32),
+                  np.array(b, dtype=np.float32) / 512., o) for s, b, o in tiles]
+        return np_methods.bboxes_merge_tiles(tiles, (512, 512), (512, 896))
+
+    def testTruncatedSeamBbox(self):
+        # Box [470, 530] on x: truncated by the first tile, which misses it.
+        _, scores, bboxes = self.merge([([], np.zeros((0, 4)), (0, 0)),
+                                        ([0.9], [[100., 86., 200., 146.]], (0, 384))])
+        np.testing.assert_allclose(scores, [0.9], rtol=1e-6)
+        np.testing.assert_allclose(bboxes * [512, 896, 512, 896],
+                                   [[100., 470., 200., 530.]], rtol=1e-5)
+        # Truncated detection in the first tile too: mean score of the fusion.
+        _, scores, _ = self.merge([([0.7], [[100., 470., 200., 512.]], (0, 0)),
+                                   ([0.9], [[100., 86., 200., 146.]], (0, 384))])
+        np.testing.assert_allclose(scores, [0.8], rtol=1e-6)
+
+    def testCoveredSeamBbox(self):
+        # Box [420, 480] on x: fully inside both tiles, missed by one.
+        _, scores, _ = self.merge([([0.9], [[100., 420., 200., 480.]], (0, 0)),
+                                   ([], np.zeros((0, 4)), (0, 384))])
+        np.testing.assert_allclose(scores, [0.45], rtol=1e-6)
+        _, scores, _ = self.merge([([0.9], [[100., 420., 200., 480.]], (0, 0)),
+                                   ([0.7], [[100., 36., 200., 96.]], (0, 384))])
+        np.testing.assert_allclose(scores, [0.8], rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,8 @@ import numpy as np
 import tensorflow as tf
 import tf_extended as tfe
 
+from nets import np_methods
+
 
 # =========================================================================== #
 # TensorFlow implementation of boxes SSD encoding / decoding.
@@ -37,7 +39,8 @@ def tf_ssd_bboxes_encode_layer(labels,
     Arguments:
       labels: 1D Tensor(int64) containing groundtruth labels;
       bboxes: Nx4 Tensor(float) with bboxes relative coordinates;
-      anchors_layer: Numpy array with layer anchors;
+      anchors_layer: Numpy arrays with layer anchors (y, x, h, w), possibly
+        already broadcasted to the layer grid (c.f. `AnchorTable.layer_grid`);
       matching_threshold: Threshold for positive match with groundtruth bboxes;
       prior_scaling: Scaling of encoded coordinates.
 
@@ -53,7 +56,7 @@ def tf_ssd_bboxes_encode_layer(labels,
     vol_anchors = (xmax - xmin) * (ymax - ymin)
 
     # Initialize tensors...
-    shape = (yref.shape[0], yref.shape[1], href.size)
+    shape = vol_anchors.shape
     feat_labels = tf.zeros(shape, dtype=tf.int64)
     feat_scores = tf.zeros(shape, dtype=dtype)
 
@@ -143,6 +146,20 @@ def tf_ssd_bboxes_encode_layer(labels,
                                            [i, feat_labels, feat_scores,
                                             feat_ymin, feat_xmin,
                                             feat_ymax, feat_xmax])
+    feat_localizations = tf_ssd_bboxes_encode_localizations(
+        feat_ymin, feat_xmin, feat_ymax, feat_xmax, anchors_layer, prior_scaling)
+    return feat_labels, feat_localizations, feat_scores
+
+
+def tf_ssd_bboxes_encode_localizations(feat_ymin, feat_xmin, feat_ymax, feat_xmax,
+                                       anchors_layer,
+                                       prior_scaling=[0.1, 0.1, 0.2, 0.2]):
+    """Encode matched groundtruth bboxes (corners) relatively to anchors.
+
+    Return:
+      Tensor (..., 4) of localization targets, SSD ordering (x, y, w, h).
+    """
+    yref, xref, href, wref = anchors_layer
     # Transform to center / size.
     feat_cy = (feat_ymax + feat_ymin) / 2.
     feat_cx = (feat_xmax + feat_xmin) / 2.
@@ -154,7 +171,83 @@ def tf_ssd_bboxes_encode_layer(labels,
     feat_h = tf.log(feat_h / href) / prior_scaling[2]
     feat_w = tf.log(feat_w / wref) / prior_scaling[3]
     # Use SSD ordering: x / y / w / h instead of ours.
-    feat_localizations = tf.stack([feat_cx, feat_cy, feat_w, feat_h], axis=-1)
+    return tf.stack([feat_cx, feat_cy, feat_w, feat_h], axis=-1)
+
+
+def tf_ssd_bboxes_encode_layer_vectorized(labels,
+                                          bboxes,
+                                          anchors_layer,
+                                          num_classes,
+                                          no_annotation_label,
+                                          ignore_threshold=0.5,
+                                          prior_scaling=[0.1, 0.1, 0.2, 0.2],
+                                          dtype=tf.float32):
+    """Encode groundtruth labels and bounding boxes using SSD anchors from
+    one layer, without looping over the groundtruth objects.
+
+    A single (num_gt, num_anchors) jaccard matrix is computed, and every
+    anchor is matched to its best groundtruth bbox. Targets are identical to
+    `tf_ssd_bboxes_encode_layer`: only 0 < label <= num_classes objects are
+    matched, with strictly positive jaccard, the first one on ties.
+
+    Arguments:
+      labels: 1D Tensor(int64) containing groundtruth labels;
+      bboxes: Nx4 Tensor(float) with bboxes relative coordinates;
+      anchors_layer: Numpy arrays with layer anchors (y, x, h, w), of any
+        shape once broadcasted (grid, or flattened anchors);
+      prior_scaling: Scaling of encoded coordinates.
+
+    Return:
+      (target_labels, target_localizations, target_scores): Target Tensors.
+    """
+    # Anchors coordinates and volume, flattened.
+    yref, xref, href, wref = np.broadcast_arrays(*anchors_layer)
+    shape = yref.shape
+    ymin = np.reshape(yref - href / 2., [1, -1])
+    xmin = np.reshape(xref - wref / 2., [1, -1])
+    ymax = np.reshape(yref + href / 2., [1, -1])
+    xmax = np.reshape(xref + wref / 2., [1, -1])
+    vol_anchors = (xmax - xmin) * (ymax - ymin)
+
+    # Dummy first groundtruth: no match, as in the initial loop values.
+    labels = tf.concat([tf.zeros([1], dtype=tf.int64), labels], axis=0)
+    bboxes = tf.concat([tf.constant([[0., 0., 1., 1.]], dtype=dtype),
+                        tf.cast(bboxes, dtype)], axis=0)
+    bbox_ymin = bboxes[:, 0:1]
+    bbox_xmin = bboxes[:, 1:2]
+    bbox_ymax = bboxes[:, 2:3]
+    bbox_xmax = bboxes[:, 3:4]
+
+    # Jaccard matrix (num_gt + 1, num_anchors).
+    int_ymin = tf.maximum(ymin, bbox_ymin)
+    int_xmin = tf.maximum(xmin, bbox_xmin)
+    int_ymax = tf.minimum(ymax, bbox_ymax)
+    int_xmax = tf.minimum(xmax, bbox_xmax)
+    h = tf.maximum(int_ymax - int_ymin, 0.)
+    w = tf.maximum(int_xmax - int_xmin, 0.)
+    inter_vol = h * w
+    union_vol = vol_anchors - inter_vol \
+        + (bbox_ymax - bbox_ymin) * (bbox_xmax - bbox_xmin)
+    jaccard = tf.div(inter_vol, union_vol)
+    # Mask: no annotations + num_classes, and the dummy groundtruth.
+    mask = tf.logical_and(labels <= num_classes, labels > 0)
+    jaccard = jaccard * tf.expand_dims(tf.cast(mask, dtype), 1)
+
+    # Best groundtruth per anchor: first index reaching the max jaccard,
+    # i.e. the dummy one when there is no positive jaccard.
+    feat_scores = tf.reduce_max(jaccard, axis=0)
+    num_gt = tf.shape(labels)[0]
+    rank = tf.expand_dims(tf.range(num_gt, 0, -1), 1)
+    is_max = tf.cast(tf.equal(jaccard, feat_scores), tf.int32)
+    idxes = num_gt - tf.reduce_max(is_max * rank, axis=0)
+
+    # Gather targets.
+    feat_labels = tf.reshape(tf.gather(labels, idxes), shape)
+    feat_scores = tf.reshape(feat_scores, shape)
+    feat_bboxes = tf.reshape(tf.gather(bboxes, idxes), list(shape) + [4])
+    feat_localizations = tf_ssd_bboxes_encode_localizations(
+        feat_bboxes[..., 0], feat_bboxes[..., 1],
+        feat_bboxes[..., 2], feat_bboxes[..., 3], anchors_layer, prior_scaling)
     return feat_labels, feat_localizations, feat_scores
 
 
@@ -166,6 +259,7 @@ def tf_ssd_bboxes_encode(labels,
                          ignore_threshold=0.5,
                          prior_scaling=[0.1, 0.1, 0.2, 0.2],
                          dtype=tf.float32,
+                         method='vectorized',
                          scope='ssd_bboxes_encode'):
     """Encode groundtruth labels and bounding boxes using SSD net anchors.
     Encoding boxes for all feature layers.
@@ -173,31 +267,232 @@ def tf_ssd_bboxes_encode(labels,
     Arguments:
       labels: 1D Tensor(int64) containing groundtruth labels;
       bboxes: Nx4 Tensor(float) with bboxes relative coordinates;
-      anchors: List of Numpy array with layer anchors;
+      anchors: List of Numpy array with layer anchors, or AnchorTable;
       matching_threshold: Threshold for positive match with groundtruth bboxes;
-      prior_scaling: Scaling of encoded coordinates.
+      prior_scaling: Scaling of encoded coordinates;
+      method: 'vectorized' (one jaccard matrix per layer), 'while_loop'
+        (one iteration per groundtruth object) or 'numpy' (c.f.
+        `tf_ssd_bboxes_encode_numpy`). Same targets.
 
     Return:
       (target_labels, target_localizations, target_scores):
         Each element is a list of target Tensors.
     """
+    if method == 'numpy':
+        return tf_ssd_bboxes_encode_numpy(labels, bboxes, anchors, num_classes,
+                                          prior_scaling, dtype, flat=False,
+                                          scope=scope)
+    encode_methods = {'vectorized': tf_ssd_bboxes_encode_layer_vectorized,
+                      'while_loop': tf_ssd_bboxes_encode_layer}
+    if method not in encode_methods:
+        raise ValueError('Unknown encoding method: %s' % method)
+    encode_layer = encode_methods[method]
     with tf.name_scope(scope):
         target_labels = []
         target_localizations = []
         target_scores = []
         for i, anchors_layer in enumerate(anchors):
+            if isinstance(anchors, np_methods.AnchorTable):
+                anchors_layer = anchors.layer_grid(i)
             with tf.name_scope('bboxes_encode_block_%i' % i):
                 t_labels, t_loc, t_scores = \
-                    tf_ssd_bboxes_encode_layer(labels, bboxes, anchors_layer,
-                                               num_classes, no_annotation_label,
-                                               ignore_threshold,
-                                               prior_scaling, dtype)
+                    encode_layer(labels, bboxes, anchors_layer,
+                                 num_classes, no_annotation_label,
+                                 ignore_threshold,
+                                 prior_scaling, dtype)
                 target_labels.append(t_labels)
                 target_localizations.append(t_loc)
                 target_scores.append(t_scores)
         return target_labels, target_localizations, target_scores
 
 
+def tf_ssd_bboxes_encode_flat(labels,
+                              bboxes,
+                              anchors,
+                              num_classes,
+                              no_annotation_label,
+                              ignore_threshold=0.5,
+                              prior_scaling=[0.1, 0.1, 0.2, 0.2],
+                              dtype=tf.float32,
+                              method='vectorized',
+                              scope='ssd_bboxes_encode_flat'):
+    """Encode groundtruth labels and bounding boxes on all the anchors of a
+    SSD net at once, as a flat set (c.f. `AnchorTable.centers`). Same
+    targets as `tf_ssd_bboxes_encode`, concatenated over the layers.
+
+    Arguments:
+      labels: 1D Tensor(int64) containing groundtruth labels;
+      bboxes: Nx4 Tensor(float) with bboxes relative coordinates;
+      anchors: AnchorTable of the network;
+      prior_scaling: Scaling of encoded coordinates;
+      method: 'vectorized' or 'numpy'.
+
+    Return:
+      (target_labels, target_localizations, target_scores): Tensors of
+        shapes (num_anchors,), (num_anchors, 4) and (num_anchors,).
+    """
+    if not isinstance(anchors, np_methods.AnchorTable):
+        raise ValueError('Flat encoding requires an AnchorTable.')
+    if method == 'numpy':
+        return tf_ssd_bboxes_encode_numpy(labels, bboxes, anchors, num_classes,
+                                          prior_scaling, dtype, flat=True,
+                                          scope=scope)
+    if method != 'vectorized':
+        raise ValueError('Unknown flat encoding method: %s' % method)
+    with tf.name_scope(scope):
+        anchors_flat = tuple(np.transpose(anchors.centers))
+        return tf_ssd_bboxes_encode_layer_vectorized(labels, bboxes, anchors_flat,
+                                                     num_classes, no_annotation_label,
+                                                     ignore_threshold,
+                                                     prior_scaling, dtype)
+
+
+def tf_ssd_bboxes_encode_numpy(labels,
+                               bboxes,
+                               anchors,
+                               num_classes,
+                               prior_scaling=[0.1, 0.1, 0.2, 0.2],
+                               dtype=tf.float32,
+                               flat=True,
+                               scope='ssd_bboxes_encode_numpy'):
+    """Encode groundtruth labels and bounding boxes with the Numpy encoder
+    (c.f. `np_methods.SSDTargetEncoder`) wrapped in a `tf.py_func`: drop-in
+    replacement of the TF encoders, running outside of the TF thread pools.
+
+    Arguments:
+      labels: 1D Tensor(int64) containing groundtruth labels;
+      bboxes: Nx4 Tensor(float) with bboxes relative coordinates;
+      anchors: AnchorTable of the network;
+      flat: Flat targets, or lists of per-layer targets.
+
+    Return:
+      (target_labels, target_localizations, target_scores): flat Tensors, or
+        lists of per-layer Tensors if not `flat`.
+    """
+    if not isinstance(anchors, np_methods.AnchorTable):
+        raise ValueError('Numpy encoding requires an AnchorTable.')
+    encoder = np_methods.SSDTargetEncoder(anchors, num_classes, prior_scaling)
+    fdtype = tf.as_dtype(encoder.dtype)
+    with tf.name_scope(scope):
+        t_labels, t_loc, t_scores = tf.py_func(encoder.encode, [labels, bboxes],
+                                               [tf.int64, fdtype, fdtype],
+                                               stateful=False)
+        t_labels.set_shape([anchors.num_anchors])
+        t_loc = tf.cast(tf.reshape(t_loc, [anchors.num_anchors, 4]), dtype)
+        t_scores = tf.cast(tf.reshape(t_scores, [anchors.num_anchors]), dtype)
+        if flat:
+            return t_labels, t_loc, t_scores
+        return tuple(tf_ssd_bboxes_split(anchors, [t_labels, t_loc, t_scores],
+                                         axis=0))
+
+
+def tf_ssd_bboxes_encode_sparse(labels,
+                                bboxes,
+                                anchors,
+                                num_classes,
+                                no_annotation_label,
+                                max_positives=2048,
+                                positive_threshold=0.5,
+                                ignore_threshold=0.5,
+                                prior_scaling=[0.1, 0.1, 0.2, 0.2],
+                                dtype=tf.float32,
+                                method='vectorized',
+                                scope='ssd_bboxes_encode_sparse'):
+    """Encode groundtruth labels and bounding boxes as sparse rows: only
+    the anchors with a score over `positive_threshold`, padded to
+    `max_positives` rows. The other anchors are implicitly background,
+    with zero score, which is all the SSD losses use of them.
+
+    If more than `max_positives` anchors are positive, the ones with the
+    highest scores are kept. Padding rows are all zeros, hence neutral when
+    scattered back (c.f. `tf_ssd_bboxes_densify`).
+
+    Arguments:
+      labels: 1D Tensor(int64) containing groundtruth labels;
+      bboxes: Nx4 Tensor(float) with bboxes relative coordinates;
+      anchors: AnchorTable of the network;
+      max_positives: Number of rows P;
+      positive_threshold: Minimum score of the encoded anchors, at most
+        the matching threshold of the losses;
+      method: Flat encoding method, 'vectorized' or 'numpy'.
+
+    Return:
+      (indexes, target_labels, target_localizations, target_scores): Tensors
+        of shapes (P,), (P,), (P, 4) and (P,).
+    """
+    with tf.name_scope(scope):
+        t_labels, t_loc, t_scores = tf_ssd_bboxes_encode_flat(
+            labels, bboxes, anchors, num_classes, no_annotation_label,
+            ignore_threshold, prior_scaling, dtype, method=method, scope='flat')
+        # Positive anchors, by decreasing score.
+        pscores = tf.where(t_scores > positive_threshold,
+                           t_scores, tf.zeros_like(t_scores))
+        _, idxes = tf.nn.top_k(pscores, k=max_positives, sorted=False)
+        mask = tf.gather(pscores, idxes) > 0.
+        imask = tf.cast(mask, tf.int64)
+        fmask = tf.cast(mask, dtype)
+        # Sparse rows, zeros for padding.
+        idxes = tf.cast(idxes, tf.int64) * imask
+        t_labels = tf.gather(t_labels, idxes) * imask
+        t_loc = tf.gather(t_loc, idxes) * tf.expand_dims(fmask, -1)
+        t_scores = tf.gather(t_scores, idxes) * fmask
+        return idxes, t_labels, t_loc, t_scores
+
+
+def tf_ssd_bboxes_densify(indexes, labels, localizations, scores, num_anchors,
+                          scope='ssd_bboxes_densify'):
+    """Scatter batched sparse targets (c.f. `tf_ssd_bboxes_encode_sparse`)
+    back to flat dense targets.
+
+    Arguments:
+      indexes, labels, localizations, scores: (B, P, ...) Tensors;
+      num_anchors: Total number of anchors N.
+
+    Return:
+      (target_labels, target_localizations, target_scores): Tensors of
+        shapes (B, N), (B, N, 4) and (B, N).
+    """
+    with tf.name_scope(scope):
+        shape = tfe.get_shape(indexes, 2)
+        bidxes = tf.tile(tf.expand_dims(tf.range(tf.cast(shape[0], tf.int64)), 1),
+                         [1, shape[1]])
+        idxes = tf.stack([bidxes, indexes], axis=-1)
+        dense_shape = tf.stack([tf.cast(shape[0], tf.int64),
+                                tf.constant(num_anchors, tf.int64)])
+        loc_shape = tf.concat([dense_shape, tf.constant([4], tf.int64)], axis=0)
+        # Padding rows are all zeros: summing duplicates is harmless.
+        labels = tf.scatter_nd(idxes, labels, dense_shape)
+        localizations = tf.scatter_nd(idxes, localizations, loc_shape)
+        scores = tf.scatter_nd(idxes, scores, dense_shape)
+        return labels, localizations, scores
+
+
+def tf_ssd_bboxes_split(anchors, tensors, axis=1, scope='ssd_bboxes_split'):
+    """Split flat anchors Tensors (c.f. `tf_ssd_bboxes_encode_flat`) into
+    the usual lists of per-layer Tensors, e.g. for `ssd_losses`.
+
+    Arguments:
+      anchors: AnchorTable of the network;
+      tensors: List of Tensors, with the flat anchors dimension on `axis`
+        (1 for batched targets);
+      axis: Anchors axis.
+
+    Return:
+      List of lists of Tensors, shaped (..., H_i, W_i, A_i, ...) per layer.
+    """
+    sizes = [int(anchors.offsets[i+1] - anchors.offsets[i])
+             for i in range(len(anchors))]
+    with tf.name_scope(scope):
+        l_splits = []
+        for t in tensors:
+            shape = tfe.get_shape(t)
+            splits = tf.split(t, sizes, axis=axis)
+            l_splits.append([tf.reshape(splits[i], shape[:axis] +
+                                        list(anchors.shapes[i]) + shape[axis+1:])
+                             for i in range(len(anchors))])
+        return l_splits
+
+
 def tf_ssd_bboxes_decode_layer(feat_localizations,
                                anchors_layer,
                                prior_scaling=[0.1, 0.1, 0.2, 0.2]):
@@ -236,7 +531,7 @@ def tf_ssd_bboxes_decode(feat_localizations,
 
     Arguments:
       feat_localizations: List of Tensors containing localization features.
-      anchors: List of numpy array containing anchor boxes.
+      anchors: List of numpy array containing anchor boxes, or AnchorTable.
 
     Return:
       List of Tensors Nx4: ymin, xmin, ymax, xmax
@@ -244,6 +539,8 @@ def tf_ssd_bboxes_decode(feat_localizations,
     with tf.name_scope(scope):
         bboxes = []
         for i, anchors_layer in enumerate(anchors):
+            if isinstance(anchors, np_methods.AnchorTable):
+                anchors_layer = anchors.layer_grid(i)
             bboxes.append(
                 tf_ssd_bboxes_decode_layer(feat_localizations[i],
                                            anchors_layer,
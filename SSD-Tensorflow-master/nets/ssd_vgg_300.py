@@ -56,6 +56,7 @@ import tensorflow as tf
 
 import tf_extended as tfe
 from nets import custom_layers
+from nets import np_methods
 from nets import ssd_common
 
 slim = tf.contrib.slim
@@ -139,8 +140,10 @@ class SSDNet(object):
             dropout_keep_prob=0.5,
             prediction_fn=slim.softmax,
             reuse=None,
-            scope='ssd_300_vgg'):
-        """SSD network definition.
+            scope='ssd_300_vgg',
+            data_format='NHWC'):
+        """SSD network definition. `data_format` is the layout of the inputs,
+        which must match the one of the `arg_scope`.
         """
         r = ssd_net(inputs,
                     num_classes=self.params.num_classes,
@@ -152,7 +155,8 @@ class SSDNet(object):
                     dropout_keep_prob=dropout_keep_prob,
                     prediction_fn=prediction_fn,
                     reuse=reuse,
-                    scope=scope)
+                    scope=scope,
+                    data_format=data_format)
         # Update feature shapes (try at least!)
         if update_feat_shapes:
             shapes = ssd_feat_shapes_from_net(r[0], self.params.feat_shapes)
@@ -179,27 +183,76 @@ class SSDNet(object):
 
     def anchors(self, img_shape, dtype=np.float32):
         """Compute the default anchor boxes, given an image shape.
+        Memoized per (img_shape, params): return the shared AnchorTable,
+        which can also be used as the list of layers anchors.
         """
-        return ssd_anchors_all_layers(img_shape,
-                                      self.params.feat_shapes,
-                                      self.params.anchor_sizes,
-                                      self.params.anchor_ratios,
-                                      self.params.anchor_steps,
-                                      self.params.anchor_offset,
-                                      dtype)
+        return np_methods.ssd_anchor_table(
+            (tuple(img_shape), self.params, np.dtype(dtype).name),
+            lambda: ssd_anchors_all_layers(img_shape,
+                                           self.params.feat_shapes,
+                                           self.params.anchor_sizes,
+                                           self.params.anchor_ratios,
+                                           self.params.anchor_steps,
+                                           self.params.anchor_offset,
+                                           dtype))
 
     def bboxes_encode(self, labels, bboxes, anchors,
-                      scope=None):
+                      method='vectorized', flat=False, scope=None):
         """Encode labels and bounding boxes.
+        If `flat`, encode all the anchors of the AnchorTable at once, and
+        return single flat Tensors (c.f. `bboxes_split`).
         """
+        if flat:
+            return ssd_common.tf_ssd_bboxes_encode_flat(
+                labels, bboxes, anchors,
+                self.params.num_classes,
+                self.params.no_annotation_label,
+                ignore_threshold=0.5,
+                prior_scaling=self.params.prior_scaling,
+                method=method,
+                scope=scope)
         return ssd_common.tf_ssd_bboxes_encode(
             labels, bboxes, anchors,
             self.params.num_classes,
             self.params.no_annotation_label,
             ignore_threshold=0.5,
             prior_scaling=self.params.prior_scaling,
+            method=method,
             scope=scope)
 
+    def bboxes_encode_sparse(self, labels, bboxes, anchors,
+                             max_positives=2048, positive_threshold=0.5,
+                             method='vectorized', scope=None):
+        """Encode labels and bounding boxes as sparse positive rows
+        (c.f. `bboxes_densify`).
+        """
+        return ssd_common.tf_ssd_bboxes_encode_sparse(
+            labels, bboxes, anchors,
+            self.params.num_classes,
+            self.params.no_annotation_label,
+            max_positives=max_positives,
+            positive_threshold=positive_threshold,
+            ignore_threshold=0.5,
+            prior_scaling=self.params.prior_scaling,
+            method=method,
+            scope=scope)
+
+    def bboxes_densify(self, gindexes, gclasses, glocalisations, gscores,
+                       anchors, scope='ssd_bboxes_densify'):
+        """Scatter batched sparse targets back to per-layer lists of targets.
+        """
+        with tf.name_scope(scope):
+            gclasses, glocalisations, gscores = ssd_common.tf_ssd_bboxes_densify(
+                gindexes, gclasses, glocalisations, gscores, anchors.num_anchors)
+            return self.bboxes_split(gclasses, glocalisations, gscores, anchors)
+
+    def bboxes_split(self, gclasses, glocalisations, gscores, anchors,
+                     scope='ssd_bboxes_split'):
+        """Split batched flat targets into per-layer lists of targets.
+        """
+        return ssd_common.tf_ssd_bboxes_split(
+            anchors, [gclasses, glocalisations, gscores], axis=1, scope=scope)
+
     def bboxes_decode(self, feat_localizations, anchors,
                       scope='ssd_bboxes_decode'):
         """Encode labels and bounding boxes.
@@ -211,8 +264,10 @@ class SSDNet(object):
 
     def detected_bboxes(self, predictions, localisations,
                         select_threshold=None, nms_threshold=0.5,
-                        clipping_bbox=None, top_k=400, keep_top_k=200):
+                        clipping_bbox=None, top_k=400, keep_top_k=200,
+                        soft_nms=False):
         """Get the detected bounding boxes from the SSD network output.
+        Soft-NMS (gaussian kernel) is used instead of NMS if `soft_nms`.
         """
         # Select top_k bboxes from predictions, and clip
         rscores, rbboxes = \
@@ -222,10 +277,16 @@ class SSDNet(object):
         rscores, rbboxes = \
             tfe.bboxes_sort(rscores, rbboxes, top_k=top_k)
         # Apply NMS algorithm.
-        rscores, rbboxes = \
-            tfe.bboxes_nms_batch(rscores, rbboxes,
-                                 nms_threshold=nms_threshold,
-                                 keep_top_k=keep_top_k)
+        if soft_nms:
+            rscores, rbboxes = \
+                tfe.bboxes_soft_nms_batch(rscores, rbboxes,
+                                          nms_threshold=nms_threshold,
+                                          keep_top_k=keep_top_k)
+        else:
+            rscores, rbboxes = \
+                tfe.bboxes_nms_batch(rscores, rbboxes,
+                                     nms_threshold=nms_threshold,
+                                     keep_top_k=keep_top_k)
         if clipping_bbox is not None:
             rbboxes = tfe.bboxes_clip(clipping_bbox, rbboxes)
         return rscores, rbboxes
@@ -453,11 +514,11 @@ def ssd_net(inputs,
             dropout_keep_prob=0.5,
             prediction_fn=slim.softmax,
             reuse=None,
-            scope='ssd_300_vgg'):
-    """SSD net definition.
+            scope='ssd_300_vgg',
+            data_format='NHWC'):
+    """SSD net definition. `data_format` is the layout of the inputs, set on
+    all the layers by `ssd_arg_scope`.
     """
-    # if data_format == 'NCHW':
-    #     inputs = tf.transpose(inputs, perm=(0, 3, 1, 2))
 
     # End_points collect relevant activations for external use.
     #用于收集每一层输出结果
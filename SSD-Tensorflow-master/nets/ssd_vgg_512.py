@@ -36,6 +36,7 @@ import tensorflow as tf
 
 import tf_extended as tfe
 from nets import custom_layers
+from nets import np_methods
 from nets import ssd_common
 from nets import ssd_vgg_300
 
@@ -124,8 +125,10 @@ class SSDNet(object):
             prediction_fn=slim.softmax,
             reuse=None,
             scope='ssd_512_vgg',
-            DSSD_FLAG  = False):
-        """Network definition.
+            DSSD_FLAG  = False,
+            data_format='NHWC'):
+        """Network definition. `data_format` is the layout of the inputs,
+        which must match the one of the `arg_scope`.
         """
         r = ssd_net(inputs,
                     num_classes=self.params.num_classes,
@@ -138,7 +141,8 @@ class SSDNet(object):
                     prediction_fn=prediction_fn,
                     reuse=reuse,
                     scope=scope,
-                    DSSD_FLAG=DSSD_FLAG)
+                    DSSD_FLAG=DSSD_FLAG,
+                    data_format=data_format)
         # Update feature shapes (try at least!)
         if update_feat_shapes:
             shapes = ssd_feat_shapes_from_net(r[0], self.params.feat_shapes)
@@ -158,27 +162,76 @@ class SSDNet(object):
     # ======================================================================= #
     def anchors(self, img_shape, dtype=np.float32):
         """Compute the default anchor boxes, given an image shape.
+        Memoized per (img_shape, params): return the shared AnchorTable,
+        which can also be used as the list of layers anchors.
         """
-        return ssd_anchors_all_layers(img_shape,
-                                      self.params.feat_shapes,
-                                      self.params.anchor_sizes,
-                                      self.params.anchor_ratios,
-                                      self.params.anchor_steps,
-                                      self.params.anchor_offset,
-                                      dtype)
+        return np_methods.ssd_anchor_table(
+            (tuple(img_shape), self.params, np.dtype(dtype).name),
+            lambda: ssd_anchors_all_layers(img_shape,
+                                           self.params.feat_shapes,
+                                           self.params.anchor_sizes,
+                                           self.params.anchor_ratios,
+                                           self.params.anchor_steps,
+                                           self.params.anchor_offset,
+                                           dtype))
 
     def bboxes_encode(self, labels, bboxes, anchors,
-                      scope=None):
+                      method='vectorized', flat=False, scope=None):
         """Encode labels and bounding boxes.
+        If `flat`, encode all the anchors of the AnchorTable at once, and
+        return single flat Tensors (c.f. `bboxes_split`).
         """
+        if flat:
+            return ssd_common.tf_ssd_bboxes_encode_flat(
+                labels, bboxes, anchors,
+                self.params.num_classes,
+                self.params.no_annotation_label,
+                ignore_threshold=0.5,
+                prior_scaling=self.params.prior_scaling,
+                method=method,
+                scope=scope)
         return ssd_common.tf_ssd_bboxes_encode(
             labels, bboxes, anchors,
             self.params.num_classes,
             self.params.no_annotation_label,
             ignore_threshold=0.5,
             prior_scaling=self.params.prior_scaling,
+            method=method,
             scope=scope)
 
+    def bboxes_encode_sparse(self, labels, bboxes, anchors,
+                             max_positives=2048, positive_threshold=0.5,
+                             method='vectorized', scope=None):
+        """Encode labels and bounding boxes as sparse positive rows
+        (c.f. `bboxes_densify`).
+        """
+        return ssd_common.tf_ssd_bboxes_encode_sparse(
+            labels, bboxes, anchors,
+            self.params.num_classes,
+            self.params.no_annotation_label,
+            max_positives=max_positives,
+            positive_threshold=positive_threshold,
+            ignore_threshold=0.5,
+            prior_scaling=self.params.prior_scaling,
+            method=method,
+            scope=scope)
+
+    def bboxes_densify(self, gindexes, gclasses, glocalisations, gscores,
+                       anchors, scope='ssd_bboxes_densify'):
+        """Scatter batched sparse targets back to per-layer lists of targets.
+        """
+        with tf.name_scope(scope):
+            gclasses, glocalisations, gscores = ssd_common.tf_ssd_bboxes_densify(
+                gindexes, gclasses, glocalisations, gscores, anchors.num_anchors)
+            return self.bboxes_split(gclasses, glocalisations, gscores, anchors)
+
+    def bboxes_split(self, gclasses, glocalisations, gscores, anchors,
+                     scope='ssd_bboxes_split'):
+        """Split batched flat targets into per-layer lists of targets.
+        """
+        return ssd_common.tf_ssd_bboxes_split(
+            anchors, [gclasses, glocalisations, gscores], axis=1, scope=scope)
+
     def bboxes_decode(self, feat_localizations, anchors,
                       scope='ssd_bboxes_decode'):
         """Encode labels and bounding boxes.
@@ -190,8 +243,10 @@ class SSDNet(object):
 
     def detected_bboxes(self, predictions, localisations,
                         select_threshold=None, nms_threshold=0.5,
-                        clipping_bbox=None, top_k=400, keep_top_k=200):
+                        clipping_bbox=None, top_k=400, keep_top_k=200,
+                        soft_nms=False):
         """Get the detected bounding boxes from the SSD network output.
+        Soft-NMS (gaussian kernel) is used instead of NMS if `soft_nms`.
         """
         # Select top_k bboxes from predictions, and clip
         rscores, rbboxes = \
@@ -201,10 +256,16 @@ class SSDNet(object):
         rscores, rbboxes = \
             tfe.bboxes_sort(rscores, rbboxes, top_k=top_k)
         # Apply NMS algorithm.
-        rscores, rbboxes = \
-            tfe.bboxes_nms_batch(rscores, rbboxes,
-                                 nms_threshold=nms_threshold,
-                                 keep_top_k=keep_top_k)
+        if soft_nms:
+            rscores, rbboxes = \
+                tfe.bboxes_soft_nms_batch(rscores, rbboxes,
+                                          nms_threshold=nms_threshold,
+                                          keep_top_k=keep_top_k)
+        else:
+            rscores, rbboxes = \
+                tfe.bboxes_nms_batch(rscores, rbboxes,
+                                     nms_threshold=nms_threshold,
+                                     keep_top_k=keep_top_k)
         # if clipping_bbox is not None:
         #     rbboxes = tfe.bboxes_clip(clipping_bbox, rbboxes)
         return rscores, rbboxes
@@ -395,16 +456,15 @@ def ssd_net(inputs,
             prediction_fn=slim.softmax,
             reuse=None,
             scope='ssd_512_vgg',
-            DSSD_FLAG = False
+            DSSD_FLAG = False,
+            data_format='NHWC'
             ):
-    """SSD net definition.
+    """SSD net definition. `data_format` is the layout of the inputs: the
+    convolution and padding layers get it from `ssd_arg_scope`, the DSSD
+    batch normalizations from here.
     """
     # End_points collect relevant activations for external use.
     end_points = {}
-    if inputs.shape[2] == inputs.shape[3] :
-        mode = 'bnwh'
-    else:
-        mode ='bwhn'
     with tf.variable_scope(scope, 'ssd_512_vgg', [inputs], reuse=reuse):
         # Original VGG-16 blocks.
         net = slim.repeat(inputs, 2, slim.conv2d, 64, [3, 3], scope='conv1')
@@ -516,13 +576,13 @@ def ssd_net(inputs,
 
                 de_12 = slim.conv2d_transpose(end_points['block12'],512,[3,3],stride=2,scope="de_12")
                 con_12 = slim.conv2d(de_12,512,[3,3],scope='conv_12')
-                bn_12 = slim.batch_norm(con_12, is_training=is_training)
+                bn_12 = slim.batch_norm(con_12, is_training=is_training, data_format=data_format)
 
                 con_11 = slim.conv2d(end_points["block11"],512,[3,3],scope="conv11")
-                bn_11 = slim.batch_norm(con_11, is_training=is_training)
+                bn_11 = slim.batch_norm(con_11, is_training=is_training, data_format=data_format)
                 relu_11 = tf.nn.relu(bn_11)
                 con_11 = slim.conv2d(relu_11,512,[3,3],scope="conv11_2")
-                bn_11 = slim.batch_norm(con_11, is_training=is_training)
+                bn_11 = slim.batch_norm(con_11, is_training=is_training, data_format=data_format)
 
                 end_points["block11"] = tf.nn.relu(tf.multiply(bn_12,bn_11))
 
@@ -530,13 +590,13 @@ def ssd_net(inputs,
 
                 de_11 = slim.conv2d_transpose(end_points['block11'],512,[3,3],stride=2,scope="de_11")
                 con_11 = slim.conv2d(de_11,512,[3,3],scope='conv_11')
-                bn_11 = slim.batch_norm(con_11, is_training=is_training)
+                bn_11 = slim.batch_norm(con_11, is_training=is_training, data_format=data_format)
 
                 con_10 = slim.conv2d(end_points["block10"],512,[3,3],scope="conv10")
-                bn_10 = slim.batch_norm(con_10, is_training=is_training)
+                bn_10 = slim.batch_norm(con_10, is_training=is_training, data_format=data_format)
                 relu_10 = tf.nn.relu(bn_10)
                 con_10 = slim.conv2d(relu_10,512,[3,3],scope="conv10_2")
-                bn_10 = slim.batch_norm(con_10, is_training=is_training)
+                bn_10 = slim.batch_norm(con_10, is_training=is_training, data_format=data_format)
 
                 end_points["block10"] = tf.nn.relu(tf.multiply(bn_11,bn_10))
 
@@ -545,13 +605,13 @@ def ssd_net(inputs,
 
                 de_10 = slim.conv2d_transpose(end_points['block10'],512,[3,3],stride=2,scope="de_10")
                 con_10 = slim.conv2d(de_10,512,[3,3],scope='conv_10')
-                bn_10 = slim.batch_norm(con_10, is_training=is_training)
+                bn_10 = slim.batch_norm(con_10, is_training=is_training, data_format=data_format)
 
                 con_9 = slim.conv2d(end_points["block9"],512,[3,3],scope="conv9")
-                bn_9 = slim.batch_norm(con_9, is_training=is_training)
+                bn_9 = slim.batch_norm(con_9, is_training=is_training, data_format=data_format)
                 relu_9 = tf.nn.relu(bn_9)
                 con_9 = slim.conv2d(relu_9,512,[3,3],scope="conv9_2")
-                bn_9= slim.batch_norm(con_9, is_training=is_training)
+                bn_9= slim.batch_norm(con_9, is_training=is_training, data_format=data_format)
 
                 end_points["block9"] = tf.nn.relu(tf.multiply(bn_10,bn_9))
 
@@ -559,13 +619,13 @@ def ssd_net(inputs,
 
                 de_9 = slim.conv2d_transpose(end_points['block9'],512,[3,3],stride=2,scope="de_9")
                 con_9 = slim.conv2d(de_9,512,[3,3],scope='conv_9')
-                bn_9 = slim.batch_norm(con_9, is_training=is_training)
+                bn_9 = slim.batch_norm(con_9, is_training=is_training, data_format=data_format)
 
                 con_8 = slim.conv2d(end_points["block8"],512,[3,3],scope="conv8")
-                bn_8 = slim.batch_norm(con_8, is_training=is_training)
+                bn_8 = slim.batch_norm(con_8, is_training=is_training, data_format=data_format)
                 relu_8 = tf.nn.relu(bn_8)
                 con_8= slim.conv2d(relu_8,512,[3,3],scope="conv8_2")
-                bn_8= slim.batch_norm(con_8, is_training=is_training)
+                bn_8= slim.batch_norm(con_8, is_training=is_training, data_format=data_format)
 
                 end_points["block8"] = tf.nn.relu(tf.multiply(bn_9,bn_8))
 
@@ -574,13 +634,13 @@ def ssd_net(inputs,
 
                 de_8 = slim.conv2d_transpose(end_points['block8'],512,[3,3],stride=2,scope="de_8")
                 con_8 = slim.conv2d(de_8,512,[3,3],scope='conv_8')
-                bn_8 = slim.batch_norm(con_8, is_training=is_training)
+                bn_8 = slim.batch_norm(con_8, is_training=is_training, data_format=data_format)
 
                 con_7 = slim.conv2d(end_points["block7"],512,[3,3],scope="conv7")
-                bn_7 = slim.batch_norm(con_7, is_training=is_training)
+                bn_7 = slim.batch_norm(con_7, is_training=is_training, data_format=data_format)
                 relu_7 = tf.nn.relu(bn_7)
                 con_7= slim.conv2d(relu_7,512,[3,3],scope="conv7_2")
-                bn_7= slim.batch_norm(con_7, is_training=is_training)
+                bn_7= slim.batch_norm(con_7, is_training=is_training, data_format=data_format)
 
                 end_points["block7"] = tf.nn.relu(tf.multiply(bn_8,bn_7))
 
@@ -589,13 +649,13 @@ def ssd_net(inputs,
 
                 de_7 = slim.conv2d_transpose(end_points['block7'],512,[3,3],stride=2,scope="de_7")
                 con_7 = slim.conv2d(de_7,512,[3,3],scope='conv_7')
-                bn_7 = slim.batch_norm(con_7, is_training=is_training)
+                bn_7 = slim.batch_norm(con_7, is_training=is_training, data_format=data_format)
 
                 con_4 = slim.conv2d(end_points["block4"],512,[3,3],scope="conv4")
-                bn_4 = slim.batch_norm(con_4, is_training=is_training)
+                bn_4 = slim.batch_norm(con_4, is_training=is_training, data_format=data_format)
                 relu_4 = tf.nn.relu(bn_4)
                 con_4= slim.conv2d(relu_4,512,[3,3],scope="conv4_2")
-                bn_4= slim.batch_norm(con_4, is_training=is_training)
+                bn_4= slim.batch_norm(con_4, is_training=is_training, data_format=data_format)
 
                 end_points["block4"] = tf.nn.relu(tf.multiply(bn_7,bn_4))
 
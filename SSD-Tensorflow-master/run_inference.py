@@ -0,0 +1,336 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Batched inference of a SSD model on a directory of images, writing
+VisDrone result files.
+
+The pipeline overlaps its stages: images are decoded and warped to the
+network shape in a threads pool, batches are fed to a batched placeholder,
+post-processing runs in a second threads pool and result files are
+written by an asynchronous writer.
+
+Usage:
+    python run_inference.py --image_dir ./VisDrone2018-DET-val/images \
+        --checkpoint_path ./checkpoints/model.ckpt-44019 \
+        --output_dir ./result --batch_size 16
+"""
+import io
+import os
+import threading
+import time
+from concurrent import futures
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from inference import cpu
+from inference import manifest
+from inference import sequence
+from nets import nets_factory
+from nets import np_methods
+from preprocessing import ssd_vgg_preprocessing
+
+slim = tf.contrib.slim
+
+# Image files processed in the images directory.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# =========================================================================== #
+# Inference Flags.
+# =========================================================================== #
+tf.app.flags.DEFINE_string(
+    'image_dir', None, 'Directory of the images to process.')
+tf.app.flags.DEFINE_string(
+    'output_dir', './result/', 'Directory of the VisDrone result files.')
+tf.app.flags.DEFINE_boolean(
+    'resume', True, 'Skip the images completed by a previous run, as recorded '
+    'in the progress manifest of the output directory.')
+tf.app.flags.DEFINE_string(
+    'checkpoint_path', './checkpoints/model.ckpt-44019',
+    'The directory where the model was written to or an absolute path to a '
+    'checkpoint file.')
+tf.app.flags.DEFINE_string(
+    'model_name', 'ssd_512_vgg', 'The name of the architecture to use.')
+tf.app.flags.DEFINE_integer(
+    'num_classes', 11, 'Number of classes to use in the dataset.')
+tf.app.flags.DEFINE_string(
+    'data_format', None, 'Network data format: NHWC or NCHW. NCHW if a GPU '
+    'is available, NHWC otherwise, by default.')
+tf.app.flags.DEFINE_boolean(
+    'cpu', False, 'CPU inference profile: NHWC layout, no GPU.')
+tf.app.flags.DEFINE_integer(
+    'intra_op_threads', 0, 'intra_op_parallelism_threads (0: default).')
+tf.app.flags.DEFINE_integer(
+    'inter_op_threads', 0, 'inter_op_parallelism_threads (0: default).')
+tf.app.flags.DEFINE_boolean(
+    'autotune_threads', False,
+    'CPU profile: pick the fastest threads configuration on the host first.')
+tf.app.flags.DEFINE_integer(
+    'batch_size', 16, 'The number of images in each batch.')
+tf.app.flags.DEFINE_integer(
+    'num_readers', 4, 'The number of threads decoding images.')
+tf.app.flags.DEFINE_integer(
+    'num_postprocessing_threads', 4,
+    'The number of threads post-processing the network outputs.')
+tf.app.flags.DEFINE_float(
+    'select_threshold', 0.5, 'Selection threshold.')
+tf.app.flags.DEFINE_integer(
+    'select_top_k', 400, 'Select top-k detected bounding boxes.')
+tf.app.flags.DEFINE_float(
+    'nms_threshold', 0.45, 'Non-Maximum Selection threshold.')
+tf.app.flags.DEFINE_string(
+    'nms_method', 'greedy', 'NMS method: greedy, grid, soft or matrix.')
+tf.app.flags.DEFINE_float(
+    'gpu_memory_fraction', 0.9, 'GPU memory fraction to use.')
+tf.app.flags.DEFINE_float(
+    'sequence_threshold', 0.,
+    'Sequence mode: reuse the detections of the last processed frame of a '
+    'sequence when the frame difference score is under this threshold '
+    '(0: disabled).')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+# =========================================================================== #
+# Pipeline stages.
+# =========================================================================== #
+class StageTimer(object):
+    """Thread-safe collection of per-stage latencies.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def add(self, stage, duration):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(duration)
+
+    def summary(self):
+        lines = []
+        for stage, timings in sorted(self.timings.items()):
+            t = 1000. * np.asarray(timings)
+            lines.append('%14s | %6i calls | mean %8.2f ms | p50 %8.2f ms | p95 %8.2f ms'
+                         % (stage, t.size, np.mean(t),
+                            np.percentile(t, 50), np.percentile(t, 95)))
+        return '\n'.join(lines)
+
+
+def decode_image(path, net_shape, timer):
+    """Decode an image and warp it to the network shape.
+
+    Return:
+      original image shape, (H, W, 3) RGB uint8 resized image.
+    """
+    start = time.time()
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Can not read the image %s' % path)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    resized = cv2.resize(image, (net_shape[1], net_shape[0]),
+                         interpolation=cv2.INTER_LINEAR)
+    timer.add('decode', time.time() - start)
+    return image.shape[:2], resized
+
+
+def postprocess_batch(rpredictions, rlocalisations, anchors, img_shapes, net_shape, timer):
+    """Post-process the network outputs of a batch of images.
+
+    Return:
+      List of VisDrone rows per image, c.f. `np_methods.bboxes_visdrone_rows`.
+    """
+    start = time.time()
+    rclasses, rscores, rbboxes, offsets = np_methods.ssd_bboxes_select_batch(
+        rpredictions, rlocalisations, anchors,
+        select_threshold=FLAGS.select_threshold,
+        img_shape=net_shape, num_classes=FLAGS.num_classes, decode=True)
+    rbboxes = np_methods.bboxes_clip([0., 0., 1., 1.], rbboxes)
+    l_rows = []
+    for i, img_shape in enumerate(img_shapes):
+        classes = rclasses[offsets[i]:offsets[i+1]]
+        scores = rscores[offsets[i]:offsets[i+1]]
+        bboxes = rbboxes[offsets[i]:offsets[i+1]]
+        classes, scores, bboxes = np_methods.bboxes_sort(
+            classes, scores, bboxes, top_k=FLAGS.select_top_k)
+        classes, scores, bboxes = np_methods.bboxes_nms_method(
+            classes, scores, bboxes, method=FLAGS.nms_method,
+            nms_threshold=FLAGS.nms_threshold)
+        l_rows.append(np_methods.bboxes_visdrone_rows(classes, scores, bboxes,
+                                                      img_shape))
+    timer.add('postprocess', time.time() - start)
+    return l_rows
+
+
+def write_results(progress, names, fnames, l_rows, timer):
+    """Write atomically the VisDrone result files of a batch of images, and
+    record them in the progress manifest.
+    """
+    start = time.time()
+    for name, fname, rows in zip(names, fnames, l_rows):
+        data = io.BytesIO()
+        np_methods.bboxes_write_visdrone(data, rows)
+        progress.write(name, fname, data.getvalue())
+    timer.add('write', time.time() - start)
+
+
+# =========================================================================== #
+# Main inference routine.
+# =========================================================================== #
+def main(_):
+    if not FLAGS.image_dir:
+        raise ValueError('You must supply the images directory with --image_dir')
+    if not tf.gfile.Exists(FLAGS.output_dir):
+        tf.gfile.MakeDirs(FLAGS.output_dir)
+    if FLAGS.cpu:
+        if FLAGS.data_format not in [None, cpu.CPU_DATA_FORMAT]:
+            raise ValueError('The CPU profile only supports the %s data format'
+                             % cpu.CPU_DATA_FORMAT)
+        data_format = cpu.CPU_DATA_FORMAT
+    else:
+        data_format = FLAGS.data_format or cpu.default_data_format()
+    names = sorted(n for n in os.listdir(FLAGS.image_dir)
+                   if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS)
+    manifest_fname = os.path.join(FLAGS.output_dir, 'manifest.jsonl')
+    if not FLAGS.resume and os.path.exists(manifest_fname):
+        os.remove(manifest_fname)
+    progress = manifest.ProgressManifest(manifest_fname)
+    num_images = len(names)
+    names = [n for n in names if not progress.is_done(n)]
+    if len(names) < num_images:
+        print('Resuming: %i / %i images already completed.'
+              % (num_images - len(names), num_images))
+    batches = [names[i:i+FLAGS.batch_size]
+               for i in range(0, len(names), FLAGS.batch_size)]
+
+    # SSD network on a batched placeholder.
+    ssd_class = nets_factory.get_network(FLAGS.model_name)
+    ssd_params = ssd_class.default_params._replace(num_classes=FLAGS.num_classes)
+    ssd_net = ssd_class(ssd_params)
+    net_shape = ssd_net.params.img_shape
+    img_input = tf.placeholder(tf.uint8, shape=(None, net_shape[0], net_shape[1], 3))
+    image = tf.to_float(img_input)
+    image = image - tf.constant([ssd_vgg_preprocessing._R_MEAN,
+                                 ssd_vgg_preprocessing._G_MEAN,
+                                 ssd_vgg_preprocessing._B_MEAN],
+                                dtype=image.dtype)
+    if data_format == 'NCHW':
+        image = tf.transpose(image, perm=(0, 3, 1, 2))
+    with slim.arg_scope(ssd_net.arg_scope(data_format=data_format)):
+        predictions, localisations, _, _ = \
+            ssd_net.net(image, is_training=False, data_format=data_format)
+    anchors = ssd_net.anchors(net_shape)
+    saver = tf.train.Saver()
+
+    intra_op_threads = FLAGS.intra_op_threads
+    inter_op_threads = FLAGS.inter_op_threads
+    if FLAGS.cpu and FLAGS.autotune_threads:
+        images = np.zeros((FLAGS.batch_size, net_shape[0], net_shape[1], 3), dtype=np.uint8)
+        (intra_op_threads, inter_op_threads), _ = cpu.autotune_threads(
+            tf.get_default_graph(), [predictions, localisations], {img_input: images},
+            init_fn=lambda sess: saver.restore(sess, FLAGS.checkpoint_path))
+        print('Threads configuration: intra_op %i, inter_op %i.'
+              % (intra_op_threads, inter_op_threads))
+    if FLAGS.cpu:
+        config = cpu.cpu_session_config(intra_op_threads, inter_op_threads)
+    else:
+        gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=FLAGS.gpu_memory_fraction)
+        config = tf.ConfigProto(log_device_placement=False, gpu_options=gpu_options,
+                                intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+    timer = StageTimer()
+    readers = futures.ThreadPoolExecutor(FLAGS.num_readers)
+    postprocessors = futures.ThreadPoolExecutor(FLAGS.num_postprocessing_threads)
+    writer = futures.ThreadPoolExecutor(1)
+    with tf.Session(config=config) as sess:
+        saver.restore(sess, FLAGS.checkpoint_path)
+
+        def decode_batch(batch):
+            return [readers.submit(decode_image, os.path.join(FLAGS.image_dir, n),
+                                   net_shape, timer) for n in batch]
+
+        start = time.time()
+        pending = []
+        # Sequence mode: whole-frame reuse policy.
+        reuse = None
+        if FLAGS.sequence_threshold > 0.:
+            reuse = sequence.FrameReuse(FLAGS.sequence_threshold)
+        num_skipped = 0
+        next_images = decode_batch(batches[0]) if batches else []
+        for i, batch in enumerate(batches):
+            images = next_images
+            # Decode next batch while the network runs on this one.
+            if i + 1 < len(batches):
+                next_images = decode_batch(batches[i+1])
+            # Unreadable images are skipped, and not recorded as completed.
+            decoded = []
+            for name, f in zip(batch, images):
+                try:
+                    decoded.append((name, f.result()))
+                except ValueError as e:
+                    print('Skipping %s: %s' % (name, e))
+                    num_skipped += 1
+            batch = [name for name, _ in decoded]
+            images = [image for _, image in decoded]
+
+            # Source of the results of every image: [rows future, index].
+            sources = []
+            run = []
+            for name, (img_shape, image) in zip(batch, images):
+                source = [None, len(run)]
+                if reuse is not None:
+                    # Reused frame: source of its reference frame.
+                    ref = reuse.reference(name, image, source, img_shape)
+                    if ref is not source:
+                        sources.append(ref)
+                        continue
+                sources.append(source)
+                run.append((img_shape, image))
+
+            if run:
+                t = time.time()
+                rpredictions, rlocalisations = sess.run(
+                    [predictions, localisations],
+                    feed_dict={img_input: np.stack([im for _, im in run], axis=0)})
+                timer.add('forward', time.time() - t)
+                l_rows = postprocessors.submit(postprocess_batch, rpredictions, rlocalisations,
+                                               anchors, [s for s, _ in run], net_shape, timer)
+                for source in sources:
+                    if source[0] is None:
+                        source[0] = l_rows
+
+            fnames = [os.path.join(FLAGS.output_dir, os.path.splitext(n)[0] + '.txt')
+                      for n in batch]
+            pending.append(writer.submit(
+                lambda n, f, s: write_results(progress, n, f, [r.result()[k] for r, k in s], timer),
+                batch, fnames, sources))
+        for f in pending:
+            f.result()
+        duration = time.time() - start
+
+    for executor in [readers, postprocessors, writer]:
+        executor.shutdown()
+    # Images processed by this run: neither resumed nor unreadable ones.
+    num_processed = len(names) - num_skipped
+    print('Processed %i images in %.2f s: %.2f images/sec.'
+          % (num_processed, duration, num_processed / max(duration, 1e-12)))
+    if num_skipped:
+        print('Skipped %i unreadable images.' % num_skipped)
+    if reuse is not None:
+        print('Sequence mode: %i / %i frames reused (forward passes saved).'
+              % (reuse.num_frames_reused, reuse.num_frames))
+    print(timer.summary())
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -0,0 +1,209 @@
+# Copyright 2017 Paul Balanca. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Local HTTP detection service, running offline on CPU.
+
+Concurrent requests are grouped by a dynamic batcher (up to --batch_size
+images, waiting at most --max_wait_ms) and run together through the SSD
+network.
+
+Endpoints:
+    POST /detect   Encoded image (JPEG, PNG...) as request body. Returns the
+                   JSON list of detections: category, score and VisDrone
+                   bbox (left, top, width, height) in pixels.
+    GET /metrics   Requests counts, latency percentiles and batch sizes
+                   histogram.
+
+Usage:
+    python serve_detections.py --checkpoint_path ./checkpoints/model.ckpt-44019 \
+        --port 8000
+    curl --data-binary @image.jpg http://localhost:8000/detect
+"""
+import json
+from http import server
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from inference import batching
+from inference import cpu
+from nets import nets_factory
+from nets import np_methods
+from preprocessing import ssd_vgg_preprocessing
+
+slim = tf.contrib.slim
+
+# =========================================================================== #
+# Service Flags.
+# =========================================================================== #
+tf.app.flags.DEFINE_string(
+    'host', '127.0.0.1', 'Address to bind.')
+tf.app.flags.DEFINE_integer(
+    'port', 8000, 'Port to listen on.')
+tf.app.flags.DEFINE_string(
+    'checkpoint_path', './checkpoints/model.ckpt-44019',
+    'The directory where the model was written to or an absolute path to a '
+    'checkpoint file.')
+tf.app.flags.DEFINE_string(
+    'model_name', 'ssd_512_vgg', 'The name of the architecture to use.')
+tf.app.flags.DEFINE_integer(
+    'num_classes', 11, 'Number of classes to use in the dataset.')
+tf.app.flags.DEFINE_integer(
+    'batch_size', 8, 'Maximum number of images in a batch.')
+tf.app.flags.DEFINE_float(
+    'max_wait_ms', 10., 'Maximum batching wait after a first request, in ms.')
+tf.app.flags.DEFINE_integer(
+    'intra_op_threads', 0, 'intra_op_parallelism_threads (0: default).')
+tf.app.flags.DEFINE_integer(
+    'inter_op_threads', 0, 'inter_op_parallelism_threads (0: default).')
+tf.app.flags.DEFINE_float(
+    'select_threshold', 0.5, 'Selection threshold.')
+tf.app.flags.DEFINE_integer(
+    'select_top_k', 400, 'Select top-k detected bounding boxes.')
+tf.app.flags.DEFINE_float(
+    'nms_threshold', 0.45, 'Non-Maximum Selection threshold.')
+
+FLAGS = tf.app.flags.FLAGS
+
+
+# =========================================================================== #
+# Batched detector.
+# =========================================================================== #
+class BatchDetector(object):
+    """SSD network on CPU, on batches of images warped to the network shape.
+    """
+    def __init__(self):
+        ssd_class = nets_factory.get_network(FLAGS.model_name)
+        ssd_params = ssd_class.default_params._replace(num_classes=FLAGS.num_classes)
+        self.ssd_net = ssd_class(ssd_params)
+        self.net_shape = self.ssd_net.params.img_shape
+        data_format = cpu.CPU_DATA_FORMAT
+
+        self.img_input = tf.placeholder(
+            tf.uint8, shape=(None, self.net_shape[0], self.net_shape[1], 3))
+        image = tf.to_float(self.img_input)
+        image = image - tf.constant([ssd_vgg_preprocessing._R_MEAN,
+                                     ssd_vgg_preprocessing._G_MEAN,
+                                     ssd_vgg_preprocessing._B_MEAN],
+                                    dtype=image.dtype)
+        with slim.arg_scope(self.ssd_net.arg_scope(data_format=data_format)):
+            self.predictions, self.localisations, _, _ = \
+                self.ssd_net.net(image, is_training=False, data_format=data_format)
+        self.anchors = self.ssd_net.anchors(self.net_shape)
+
+        config = cpu.cpu_session_config(FLAGS.intra_op_threads, FLAGS.inter_op_threads)
+        self.sess = tf.Session(config=config)
+        tf.train.Saver().restore(self.sess, FLAGS.checkpoint_path)
+
+    def decode(self, data):
+        """Decode an encoded image and warp it to the network shape.
+        """
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError('Can not decode the image')
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        resized = cv2.resize(image, (self.net_shape[1], self.net_shape[0]),
+                             interpolation=cv2.INTER_LINEAR)
+        return image.shape[:2], resized
+
+    def detect(self, items):
+        """Run a batch of decoded images (c.f. `decode`).
+
+        Return:
+          List of VisDrone rows per image.
+        """
+        rpredictions, rlocalisations = self.sess.run(
+            [self.predictions, self.localisations],
+            feed_dict={self.img_input: np.stack([im for _, im in items], axis=0)})
+        rclasses, rscores, rbboxes, offsets = np_methods.ssd_bboxes_select_batch(
+            rpredictions, rlocalisations, self.anchors,
+            select_threshold=FLAGS.select_threshold,
+            img_shape=self.net_shape, num_classes=FLAGS.num_classes, decode=True)
+        rbboxes = np_methods.bboxes_clip([0., 0., 1., 1.], rbboxes)
+        l_rows = []
+        for i, (img_shape, _) in enumerate(items):
+            classes, scores, bboxes = np_methods.bboxes_sort(
+                rclasses[offsets[i]:offsets[i+1]],
+                rscores[offsets[i]:offsets[i+1]],
+                rbboxes[offsets[i]:offsets[i+1]], top_k=FLAGS.select_top_k)
+            classes, scores, bboxes = np_methods.bboxes_nms_fast(
+                classes, scores, bboxes, nms_threshold=FLAGS.nms_threshold)
+            l_rows.append(np_methods.bboxes_visdrone_rows(classes, scores, bboxes,
+                                                          img_shape))
+        return l_rows
+
+
+def make_handler(detector, batcher):
+    """HTTP requests handler class, bound to a detector and a batcher.
+    """
+    class DetectionHandler(server.BaseHTTPRequestHandler):
+        def send_json(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(200, batcher.metrics.summary())
+            else:
+                self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/detect':
+                self.send_json(404, {'error': 'Unknown path %s' % self.path})
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                item = detector.decode(self.rfile.read(length))
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            try:
+                rows = batcher.submit(item).result()
+            except Exception as e:
+                # Inference error of the whole batch.
+                self.send_json(500, {'error': str(e)})
+                return
+            detections = [{'category': int(r[5]),
+                           'score': float(r[4]),
+                           'bbox': [int(v) for v in r[:4]]} for r in rows]
+            self.send_json(200, {'detections': detections})
+
+        def log_message(self, format, *args):
+            pass
+    return DetectionHandler
+
+
+def main(_):
+    detector = BatchDetector()
+    batcher = batching.DynamicBatcher(detector.detect,
+                                      max_batch_size=FLAGS.batch_size,
+                                      max_wait=FLAGS.max_wait_ms / 1000.)
+    httpd = server.ThreadingHTTPServer((FLAGS.host, FLAGS.port),
+                                       make_handler(detector, batcher))
+    print('Serving detections on http://%s:%i' % (FLAGS.host, FLAGS.port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+    batcher.close()
+
+
+if __name__ == '__main__':
+    tf.app.run()
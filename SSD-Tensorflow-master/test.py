@@ -12,6 +12,7 @@ import matplotlib.image as mpimg
 import sys
 sys.path.append('./')
 
+from inference import cpu
 from nets import ssd_vgg_512, ssd_common, np_methods
 from preprocessing import ssd_vgg_preprocessing
 from notebooks import visualization
@@ -21,7 +22,8 @@ config = tf.ConfigProto(log_device_placement=False, gpu_options=gpu_options)
 isess = tf.InteractiveSession(config=config)
 
 net_shape = (512, 512)
-data_format = 'NCHW'
+# NCHW on GPU, NHWC on CPU (most CPU kernels do not support NCHW).
+data_format = cpu.default_data_format()
 img_input = tf.placeholder(tf.uint8, shape=(None, None, 3))
 
 
@@ -38,7 +40,8 @@ arg_scope = ssd_net.arg_scope(weight_decay=0.05,
                               data_format=data_format)
 
 with slim.arg_scope(arg_scope):
-    predictions, localisations, _, _ = ssd_net.net(image_4d, is_training=False, reuse=False)
+    predictions, localisations, _, _ = ssd_net.net(image_4d, is_training=False, reuse=False,
+                                                   data_format=data_format)
 
 
 
@@ -52,7 +55,8 @@ saver.restore(isess, ckpt_filename)
 
 ssd_anchors = ssd_net.anchors(net_shape)
 
-def process_image(img, select_threshold=0.5, nms_threshold=.45, net_shape=(512, 512)):
+def process_image(img, select_threshold=0.5, nms_threshold=.45, net_shape=(512, 512),
+                  method='greedy'):
     # Run SSD network.
     rimg, rpredictions, rlocalisations, rbbox_img = isess.run([image_4d, predictions, localisations, bbox_img],
                                                               feed_dict={img_input: img})
@@ -67,39 +71,23 @@ def process_image(img, select_threshold=0.5, nms_threshold=.45, net_shape=(512,
 
     rbboxes = np_methods.bboxes_clip(rbbox_img, rbboxes)
     rclasses, rscores, rbboxes = np_methods.bboxes_sort(rclasses, rscores, rbboxes, top_k=400)
-    rclasses, rscores, rbboxes = np_methods.bboxes_nms(rclasses, rscores, rbboxes, nms_threshold=nms_threshold)
-    # Resize bboxes to original image shape. Note: useless for Resize.WARP!
-    rbboxes = np_methods.bboxes_resize(rbbox_img, rbboxes)
-    return rclasses, rscores, rbboxes
+    rclasses, rscores, rbboxes = np_methods.bboxes_nms_method(rclasses, rscores, rbboxes, method=method,
+                                                              nms_threshold=nms_threshold)
+    return rclasses, rscores, rbboxes, rbbox_img
 
 path = '/home/z840/Desktop/ECCV-task1/VisDrone2018-DET-val/images/'
 image_names = sorted(os.listdir(path))
 out_put_dir = "./result/"
 for i in range(len(image_names)):
     img = mpimg.imread(path + image_names[i])
-    rclasses, rscores, rbboxes =  process_image(img)
+    rclasses, rscores, rbboxes, rbbox_img = process_image(img)
     name = image_names[i][:-4] + ".txt"
-    file = open(out_put_dir + name,"w")
-
-    height = img.shape[0]
-    width = img.shape[1]
-    # for j in range(rclasses.shape[0]):
-    #     ymin = int(rbboxes[j, 0] * height)
-    #     xmin = int(rbboxes[j, 1] * width)
-    #     ymax = int(rbboxes[j, 2] * height)
-    #     xmax = int(rbboxes[j, 3] * width)
-    #
-    #     # visualization.bboxes_draw_on_img(img, rclasses, rscores, rbboxes, visualization.colors_plasma)
-    #     bbox_left = str(xmin)
-    #     bbox_top  = str(ymin)
-    #     bbox_width = str(xmax - xmin)
-    #     bbox_height = str(ymax - ymin)
-    #     score = str(rscores[j])
-    #     object_category = str(rclasses[j])
-    #     truncation = str(-1)
-    #     occlusion = str(-1)
-    #     file.write(bbox_left+","+bbox_top+","+bbox_width+","+bbox_height+","+score+","+object_category+","+truncation+","+occlusion+"\n")
+
+    # Clip, resize to original image shape and write VisDrone rows.
+    rows = np_methods.bboxes_visdrone_rows(rclasses, rscores, rbboxes,
+                                           img.shape[:2], rbbox_img)
+    np_methods.bboxes_write_visdrone(out_put_dir + name, rows)
     print("rclasses",rclasses)
     print("rbboxes",rbboxes)
     print("rscores",rscores)
-    visualization.plt_bboxes(img, rclasses, rscores, rbboxes)
\ No newline at end of file
+    visualization.plt_bboxes(img, rclasses, rscores, rbboxes)
@@ -232,6 +232,165 @@ def bboxes_nms_batch(scores, bboxes, nms_threshold=0.5, keep_top_k=200,
         return scores, bboxes
 
 
+def bboxes_soft_nms(scores, bboxes, nms_threshold=0.5, keep_top_k=200,
+                    kernel='gaussian', sigma=0.5, score_threshold=0.001,
+                    scope=None):
+    """Apply Soft-NMS to bounding boxes: scores of boxes overlapping a
+    selected one are decayed instead of being removed. Every step decays all
+    scores at once, and the loop stops as soon as the max remaining score
+    is below `score_threshold`.
+    Should only be used on single-entries. Use batch version otherwise.
+
+    Args:
+      scores: N Tensor containing float scores.
+      bboxes: N x 4 Tensor containing boxes coordinates.
+      nms_threshold: Linear kernel only, IoU threshold of decay;
+      keep_top_k: Number of total object to keep after NMS;
+      kernel: Decay function, 'gaussian' or 'linear';
+      sigma: Gaussian kernel parameter;
+      score_threshold: Minimum decayed score to keep a box.
+    Return:
+      scores, bboxes Tensors, sorted by decayed score.
+        Padded with zero if necessary.
+    """
+    if kernel not in ('gaussian', 'linear'):
+        raise ValueError('Unknown Soft-NMS kernel %s' % kernel)
+    with tf.name_scope(scope, 'bboxes_soft_nms_single', [scores, bboxes]):
+        num_bboxes = tf.shape(scores)[0]
+        max_steps = tf.minimum(num_bboxes, keep_top_k)
+        rng = tf.range(num_bboxes)
+
+        def m_condition(i, scores, ta_idxes, ta_scores):
+            r = tf.logical_and(tf.less(i, max_steps),
+                               tf.reduce_max(scores) >= score_threshold)
+            return r
+
+        def m_body(i, scores, ta_idxes, ta_scores):
+            # Select the highest score.
+            idx = tf.cast(tf.argmax(scores, axis=0), tf.int32)
+            ta_idxes = ta_idxes.write(i, idx)
+            ta_scores = ta_scores.write(i, scores[idx])
+            # Decay scores of overlapping boxes.
+            overlap = bboxes_jaccard(bboxes[idx], bboxes)
+            if kernel == 'gaussian':
+                decay = tf.exp(-overlap * overlap / sigma)
+            else:
+                decay = tf.where(overlap > nms_threshold,
+                                 1. - overlap, tf.ones_like(overlap))
+            # Selected bbox: negative score, never selected again.
+            scores = tf.where(tf.equal(rng, idx),
+                              -tf.ones_like(scores), scores * decay)
+            return [i+1, scores, ta_idxes, ta_scores]
+
+        i = 0
+        ta_idxes = tf.TensorArray(tf.int32, size=0, dynamic_size=True,
+                                  element_shape=tf.TensorShape([]))
+        ta_scores = tf.TensorArray(scores.dtype, size=0, dynamic_size=True,
+                                   element_shape=tf.TensorShape([]))
+        [_, _, ta_idxes, ta_scores] = \
+            tf.while_loop(m_condition, m_body,
+                          [i, scores, ta_idxes, ta_scores],
+                          back_prop=False)
+        idxes = ta_idxes.stack()
+        scores = ta_scores.stack()
+        bboxes = tf.gather(bboxes, idxes)
+        # Pad results.
+        scores = tfe_tensors.pad_axis(scores, 0, keep_top_k, axis=0)
+        bboxes = tfe_tensors.pad_axis(bboxes, 0, keep_top_k, axis=0)
+        return scores, bboxes
+
+
+def bboxes_soft_nms_batch(scores, bboxes, nms_threshold=0.5, keep_top_k=200,
+                          kernel='gaussian', sigma=0.5, score_threshold=0.001,
+                          scope=None):
+    """Apply Soft-NMS to bounding boxes. Use only on batched-inputs.
+    Use zero-padding in order to batch output results.
+
+    Args:
+      scores: Batch x N Tensor/Dictionary containing float scores.
+      bboxes: Batch x N x 4 Tensor/Dictionary containing boxes coordinates.
+      nms_threshold, kernel, sigma, score_threshold: c.f. `bboxes_soft_nms`;
+      keep_top_k: Number of total object to keep after NMS.
+    Return:
+      scores, bboxes Tensors/Dictionaries, sorted by score.
+        Padded with zero if necessary.
+    """
+    # Dictionaries as inputs.
+    if isinstance(scores, dict) or isinstance(bboxes, dict):
+        with tf.name_scope(scope, 'bboxes_soft_nms_batch_dict'):
+            d_scores = {}
+            d_bboxes = {}
+            for c in scores.keys():
+                s, b = bboxes_soft_nms_batch(scores[c], bboxes[c],
+                                             nms_threshold=nms_threshold,
+                                             keep_top_k=keep_top_k,
+                                             kernel=kernel, sigma=sigma,
+                                             score_threshold=score_threshold)
+                d_scores[c] = s
+                d_bboxes[c] = b
+            return d_scores, d_bboxes
+
+    # Tensors inputs.
+    with tf.name_scope(scope, 'bboxes_soft_nms_batch'):
+        r = tf.map_fn(lambda x: bboxes_soft_nms(x[0], x[1],
+                                                nms_threshold, keep_top_k,
+                                                kernel, sigma,
+                                                score_threshold),
+                      (scores, bboxes),
+                      dtype=(scores.dtype, bboxes.dtype),
+                      parallel_iterations=10,
+                      back_prop=False,
+                      swap_memory=False,
+                      infer_shape=True)
+        scores, bboxes = r
+        return scores, bboxes
+
+
+def bboxes_flatten_classes(scores, bboxes, keep_top_k=200, scope=None):
+    """Merge per class dictionaries of scores and bboxes (c.f. outputs of
+    `bboxes_nms_batch`) into zero padded batched Tensors, sorted by score.
+
+    Args:
+      scores: Dictionary of Batch x N Tensors, with classes as keys.
+      bboxes: Dictionary of Batch x N x 4 Tensors, with classes as keys.
+      keep_top_k: Number of total object to keep.
+    Return:
+      classes: Batch x keep_top_k int64 Tensor, 0 for padding;
+      scores: Batch x keep_top_k Tensor;
+      bboxes: Batch x keep_top_k x 4 Tensor;
+      num_detections: Batch int32 Tensor, number of non padded detections.
+    """
+    with tf.name_scope(scope, 'bboxes_flatten_classes'):
+        keys = sorted(scores.keys())
+        l_classes = [tf.fill(tf.shape(scores[c]), tf.constant(c, dtype=tf.int64))
+                     for c in keys]
+        classes = tf.concat(l_classes, axis=1)
+        scores_all = tf.concat([scores[c] for c in keys], axis=1)
+        bboxes_all = tf.concat([bboxes[c] for c in keys], axis=1)
+        # Merge classes by decreasing score.
+        k = tf.minimum(keep_top_k, tf.shape(scores_all)[1])
+        scores, idxes = tf.nn.top_k(scores_all, k=k, sorted=True)
+
+        def fn_gather(classes, bboxes, idxes):
+            return [tf.gather(classes, idxes), tf.gather(bboxes, idxes)]
+        r = tf.map_fn(lambda x: fn_gather(x[0], x[1], x[2]),
+                      [classes, bboxes_all, idxes],
+                      dtype=[classes.dtype, bboxes_all.dtype],
+                      parallel_iterations=10,
+                      back_prop=False,
+                      swap_memory=False,
+                      infer_shape=True)
+        classes, bboxes = r
+        # Zero padding.
+        mask = scores > 0.
+        classes = tf.where(mask, classes, tf.zeros_like(classes))
+        scores = tfe_tensors.pad_axis(scores, 0, keep_top_k, axis=1)
+        classes = tfe_tensors.pad_axis(classes, 0, keep_top_k, axis=1)
+        bboxes = tfe_tensors.pad_axis(bboxes, 0, keep_top_k, axis=1)
+        num_detections = tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
+        return classes, scores, bboxes, num_detections
+
+
 # def bboxes_fast_nms(classes, scores, bboxes,
 #                     nms_threshold=0.5, eta=3., num_classes=21,
 #                     pad_output=True, scope=None):
@@ -38,6 +38,20 @@ tf.app.flags.DEFINE_float(
     'match_threshold', 0.5, 'Matching threshold in the loss function.')
 tf.app.flags.DEFINE_bool(
     'DSSD_FLAG', False, 'Train SSD or DSSD')  #SSD_15760开始训练DSSD
+tf.app.flags.DEFINE_string(
+    'encode_method', 'vectorized',
+    'Groundtruth encoding: vectorized / while_loop / numpy (same targets).')
+tf.app.flags.DEFINE_boolean(
+    'flat_encoding', False,
+    'Encode the groundtruth on all anchors at once, and queue flat targets '
+    'split per layer only for the losses.')
+tf.app.flags.DEFINE_boolean(
+    'sparse_encoding', False,
+    'Queue the groundtruth as sparse positive anchors rows, scattered back '
+    'to dense targets only for the losses.')
+tf.app.flags.DEFINE_integer(
+    'sparse_max_positives', 2048,
+    'Number of rows of the sparse groundtruth (positive anchors kept).')
 
 # =========================================================================== #
 # General Flags.
@@ -245,22 +259,34 @@ def main(_):
 
             # Encode groundtruth labels and bboxes.
             ###############################################################没看懂
-            gclasses, glocalisations, gscores = ssd_net.bboxes_encode(glabels, gbboxes, ssd_anchors)
-            batch_shape = [1] + [len(ssd_anchors)] * 3
+            if FLAGS.sparse_encoding:
+                gtargets = ssd_net.bboxes_encode_sparse(
+                    glabels, gbboxes, ssd_anchors,
+                    max_positives=FLAGS.sparse_max_positives,
+                    positive_threshold=FLAGS.match_threshold,
+                    method=FLAGS.encode_method)
+                batch_shape = [1] * 5
+            else:
+                gtargets = ssd_net.bboxes_encode(
+                    glabels, gbboxes, ssd_anchors, method=FLAGS.encode_method,
+                    flat=FLAGS.flat_encoding)
+                if FLAGS.flat_encoding:
+                    batch_shape = [1] * 4
+                else:
+                    batch_shape = [1] + [len(ssd_anchors)] * 3
 
             # Training batches and queue.
             r = tf.train.batch(
-                tf_utils.reshape_list([image, gclasses, glocalisations, gscores]),
+                tf_utils.reshape_list([image] + list(gtargets)),
                 batch_size=FLAGS.batch_size,
                 num_threads=FLAGS.num_preprocessing_threads,
                 capacity=5 * FLAGS.batch_size)
-            b_image, b_gclasses, b_glocalisations, b_gscores = \
-                tf_utils.reshape_list(r, batch_shape)
+            b_inputs = tf_utils.reshape_list(r, batch_shape)
 
             # Intermediate queueing: unique batch computation pipeline for all
             # GPUs running the training.
             batch_queue = slim.prefetch_queue.prefetch_queue(
-                tf_utils.reshape_list([b_image, b_gclasses, b_glocalisations, b_gscores]),
+                tf_utils.reshape_list(b_inputs),
                 capacity=2 * deploy_config.num_clones)
 
         # =================================================================== #
@@ -270,15 +296,25 @@ def main(_):
             """Allows data parallelism by creating multiple
             clones of network_fn."""
             # Dequeue batch.
-            b_image, b_gclasses, b_glocalisations, b_gscores = \
-                tf_utils.reshape_list(batch_queue.dequeue(), batch_shape)
+            b_inputs = tf_utils.reshape_list(batch_queue.dequeue(), batch_shape)
+            if FLAGS.sparse_encoding:
+                b_image = b_inputs[0]
+                b_gclasses, b_glocalisations, b_gscores = \
+                    ssd_net.bboxes_densify(*b_inputs[1:], anchors=ssd_anchors)
+            else:
+                b_image, b_gclasses, b_glocalisations, b_gscores = b_inputs
+                if FLAGS.flat_encoding:
+                    b_gclasses, b_glocalisations, b_gscores = \
+                        ssd_net.bboxes_split(b_gclasses, b_glocalisations,
+                                             b_gscores, ssd_anchors)
 
             # Construct SSD network.
             arg_scope = ssd_net.arg_scope(weight_decay=FLAGS.weight_decay,
                                           data_format=DATA_FORMAT)
             with slim.arg_scope(arg_scope):
                 predictions, localisations, logits, end_points = \
-                    ssd_net.net(b_image, is_training=True,DSSD_FLAG = FLAGS.DSSD_FLAG)
+                    ssd_net.net(b_image, is_training=True,DSSD_FLAG = FLAGS.DSSD_FLAG,
+                                data_format=DATA_FORMAT)
             # print( [image, glabels, gbboxes])
 
 